@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Usage: python bin/bench_envelope.py [--attachment-size N] [--chunk-size N]
+#
+# Measures how long it takes to parse an envelope with an event and a large
+# attachment, all at once and fed in chunks like the envelope view does.
+
+import argparse
+import json
+import time
+
+from kent.utils import EnvelopeParser, parse_envelope
+
+
+def timeit(fun, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fun()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark parsing envelopes")
+    parser.add_argument("--attachment-size", type=int, default=50_000_000)
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    event = json.dumps({"message": "hello world", "level": "error"}).encode("utf-8")
+    attachment = b"\n" * args.attachment_size
+    envelope = b"".join(
+        [
+            b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\n',
+            json.dumps({"type": "event", "length": len(event)}).encode("utf-8"),
+            b"\n",
+            event,
+            b"\n",
+            json.dumps({"type": "attachment", "length": len(attachment)}).encode(
+                "utf-8"
+            ),
+            b"\n",
+            attachment,
+            b"\n",
+        ]
+    )
+    chunks = [
+        envelope[i : i + args.chunk_size]
+        for i in range(0, len(envelope), args.chunk_size)
+    ]
+    print(f"envelope: {len(envelope):,} bytes in {len(chunks):,} chunks")
+
+    elapsed = timeit(lambda: list(parse_envelope(envelope, decode=False)), args.runs)
+    print(f"all at once: {elapsed * 1000:8.1f} ms")
+
+    def parse_chunks():
+        parser = EnvelopeParser(decode=False)
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+
+    elapsed = timeit(parse_chunks, args.runs)
+    print(f"in chunks:   {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Usage: python bin/bench_eventlist.py [--events N] [--runs N]
+#
+# Measures how long it takes to render the event list API, the index page and
+# an event with a full event manager.
+
+import argparse
+import json
+import logging
+import time
+import uuid
+
+from kent.app import create_app, EVENTS
+
+
+PAYLOAD = {
+    "breadcrumbs": {"values": [{"message": f"crumb {i}"} for i in range(50)]},
+    "exception": {
+        "values": [
+            {
+                "type": "KeyError",
+                "value": "'foo'",
+                "stacktrace": {
+                    "frames": [
+                        {"filename": f"app/module{i}.py", "lineno": i, "vars": {}}
+                        for i in range(30)
+                    ]
+                },
+            }
+        ]
+    },
+    "sdk": {"name": "sentry.python", "version": "2.2.0"},
+    "timestamp": "2024-05-19T02:22:32.086845Z",
+}
+
+
+def timeit(fun, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fun()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark rendering event lists")
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    app = create_app({"TESTING": True, "KENT_MAX_EVENTS": args.events})
+    logging.getLogger("kent").setLevel(logging.WARNING)
+    raw_body = json.dumps(PAYLOAD).encode("utf-8")
+
+    start = time.perf_counter()
+    for _ in range(args.events):
+        EVENTS.add_event(event_id=str(uuid.uuid4()), project_id=1, raw_body=raw_body)
+    ingest_time = time.perf_counter() - start
+    print(f"add_event:          {ingest_time / args.events * 1_000_000:8.1f} us/event")
+
+    with app.test_client() as client:
+        elapsed = timeit(lambda: client.get("/api/eventlist/"), args.runs)
+        print(f"GET /api/eventlist/ {elapsed * 1000:8.1f} ms ({args.events} events)")
+
+        elapsed = timeit(lambda: client.get("/"), args.runs)
+        print(f"GET /               {elapsed * 1000:8.1f} ms ({args.events} events)")
+
+        etag = client.get("/api/eventlist/").headers["ETag"]
+        elapsed = timeit(
+            lambda: client.get("/api/eventlist/", headers={"If-None-Match": etag}),
+            args.runs,
+        )
+        print(f"GET /api/eventlist/ {elapsed * 1000:8.1f} ms (not modified)")
+
+        event_id = EVENTS.get_events()[-1].event_id
+        elapsed = timeit(lambda: client.get(f"/api/event/{event_id}"), args.runs)
+        print(f"GET /api/event/ID   {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Usage: python bin/bench_json.py [--size N] [--runs N]
+#
+# Compares the JSON backends in kent.codec decoding and encoding an event
+# payload of about N bytes.
+
+import argparse
+import json
+import time
+
+from kent import codec
+
+
+def make_payload(size):
+    frame = {
+        "filename": "app/module.py",
+        "function": "handler",
+        "lineno": 42,
+        "vars": {"request": "<Request 'http://localhost/' [GET]>", "count": 1.5},
+    }
+    frames = [frame] * max(1, size // len(json.dumps(frame)))
+    return {
+        "exception": {
+            "values": [{"type": "KeyError", "stacktrace": {"frames": frames}}]
+        },
+        "message": "café",
+        "sdk": {"name": "sentry.python", "version": "2.2.0"},
+    }
+
+
+def timeit(fun, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        fun()
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark JSON backends")
+    parser.add_argument("--size", type=int, default=4_000_000)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    payload = make_payload(args.size)
+    data = json.dumps(payload).encode("utf-8")
+    print(f"payload: {len(data):,} bytes")
+
+    for backend in codec.get_available_backends():
+        codec.set_backend(backend)
+        elapsed = timeit(lambda: codec.loads(data), args.runs)
+        print(f"{backend:<8} loads {elapsed * 1000:8.1f} ms")
+        elapsed = timeit(lambda: codec.dumps(payload, sort_keys=True), args.runs)
+        print(f"{backend:<8} dumps {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Policies for envelope item types and counters for items that aren't stored.
+
+Each item type has a policy:
+
+``store``
+    Store each item as an event. This is the default.
+``aggregate``
+    Add the item to the project's counters instead of storing it. Sessions and
+    client reports are rolled up; other item types are counted.
+``drop``
+    Count the item and throw it away.
+``sample:RATE``
+    Store a random fraction ``RATE`` of the items and drop the rest.
+
+"""
+
+import random
+import threading
+
+from kent import codec
+
+
+POLICIES = ["store", "aggregate", "drop", "sample"]
+
+# Action -> name of the counter for items of a type
+ACTION_COUNTERS = {"store": "stored", "aggregate": "aggregated", "drop": "dropped"}
+
+# Session statuses that are counted; "ok" means the session isn't over yet
+SESSION_STATUSES = ["exited", "errored", "crashed", "abnormal"]
+
+# Lists of outcomes in client reports
+CLIENT_REPORT_KEYS = [
+    "discarded_events",
+    "rate_limited_events",
+    "filtered_events",
+    "filtered_sampling_events",
+]
+
+
+class ItemPolicy:
+    """What to do with envelope items of a type
+
+    :arg action: ``store``, ``aggregate`` or ``drop``
+    :arg sample_rate: fraction of items to store when the action is ``store``
+
+    """
+
+    def __init__(self, action, sample_rate=1.0):
+        self.action = action
+        self.sample_rate = sample_rate
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ItemPolicy)
+            and self.action == other.action
+            and self.sample_rate == other.sample_rate
+        )
+
+    def __repr__(self):
+        return f"<ItemPolicy {self}>"
+
+    def __str__(self):
+        if self.sample_rate < 1:
+            return f"sample:{self.sample_rate}"
+        return self.action
+
+    @classmethod
+    def parse(cls, value):
+        """Returns an ItemPolicy for a policy string like ``sample:0.1``
+
+        :raises ValueError: if it's not a valid policy
+
+        """
+        name, _, rate = value.strip().partition(":")
+        if name not in POLICIES or bool(rate) != (name == "sample"):
+            raise ValueError(f"unknown item policy: {value!r}")
+        if name != "sample":
+            return cls(name)
+        try:
+            sample_rate = float(rate)
+        except ValueError:
+            sample_rate = -1
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample rate must be between 0 and 1: {value!r}")
+        return cls("store", sample_rate)
+
+    def get_action(self):
+        """Returns what to do with an item: ``store``, ``aggregate`` or ``drop``"""
+        if self.action == "store" and self.sample_rate < 1:
+            return "store" if random.random() < self.sample_rate else "drop"
+        return self.action
+
+
+STORE = ItemPolicy("store")
+
+
+def parse_item_policies(value):
+    """Parses item policies like ``session=aggregate,transaction=sample:0.1``
+
+    :arg value: comma-separated ``ITEM_TYPE=POLICY`` pairs or a dict of item
+        type to policy string
+
+    :returns: dict of item type to ItemPolicy
+
+    :raises ValueError: if a policy isn't valid
+
+    """
+    if isinstance(value, dict):
+        pairs = list(value.items())
+    else:
+        pairs = []
+        for part in value.split(","):
+            if not part.strip():
+                continue
+            item_type, sep, policy = part.partition("=")
+            if not sep:
+                raise ValueError(f"item policy must be ITEM_TYPE=POLICY: {part!r}")
+            pairs.append((item_type, policy))
+    return {item_type.strip(): ItemPolicy.parse(policy) for item_type, policy in pairs}
+
+
+def add_session(project, body):
+    """Counts a session update
+
+    Sessions are counted when they start and when they end with the status they
+    ended with. Sessions that exited with errors count as errored.
+
+    """
+    sessions = project["sessions"]
+    if body.get("init"):
+        sessions["started"] += 1
+    status = body.get("status", "ok")
+    if status == "exited" and body.get("errors"):
+        status = "errored"
+    if status in SESSION_STATUSES:
+        sessions[status] += 1
+
+
+def add_session_aggregates(project, body):
+    """Counts pre-aggregated sessions from a ``sessions`` item"""
+    sessions = project["sessions"]
+    for bucket in body.get("aggregates") or []:
+        if not isinstance(bucket, dict):
+            continue
+        for status in SESSION_STATUSES:
+            count = bucket.get(status)
+            if isinstance(count, int):
+                sessions["started"] += count
+                sessions[status] += count
+
+
+def add_client_report(project, body):
+    """Sums client report outcomes by reason and category"""
+    for key in CLIENT_REPORT_KEYS:
+        for outcome in body.get(key) or []:
+            if not isinstance(outcome, dict):
+                continue
+            quantity = outcome.get("quantity")
+            if not isinstance(quantity, int):
+                continue
+            name = f"{outcome.get('reason', key)}:{outcome.get('category')}"
+            outcomes = project["client_reports"].setdefault(key, {})
+            outcomes[name] = outcomes.get(name, 0) + quantity
+
+
+# Item type -> function that adds an item's body to the project's counters
+AGGREGATORS = {
+    "session": add_session,
+    "sessions": add_session_aggregates,
+    "client_report": add_client_report,
+}
+
+
+class Aggregates:
+    """Counters for envelope items for each project
+
+    Counts items by item type and what was done with them and rolls up items
+    that are aggregated.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._projects = {}
+
+    def _get_project(self, project_id):
+        project = self._projects.get(project_id)
+        if project is None:
+            project = self._projects[project_id] = new_counters()
+        return project
+
+    def count(self, project_id, item_type, action):
+        """Counts an item
+
+        :arg project_id: the project id
+        :arg item_type: the envelope item type
+        :arg action: what was done with it: ``store``, ``aggregate`` or
+            ``drop``
+
+        """
+        with self._lock:
+            items = self._get_project(project_id)["items"]
+            counts = items.get(item_type)
+            if counts is None:
+                counts = items[item_type] = {key: 0 for key in ACTION_COUNTERS.values()}
+            counts[ACTION_COUNTERS[action]] += 1
+
+    def add(self, project_id, item_type, body):
+        """Rolls up an item in the project's counters
+
+        Use ``count`` to count the item, too.
+
+        :arg project_id: the project id
+        :arg item_type: the envelope item type
+        :arg body: the JSON-encoded item body
+
+        """
+        aggregator = AGGREGATORS.get(item_type)
+        data = None
+        if aggregator is not None:
+            try:
+                data = codec.loads(body)
+            except ValueError:
+                pass
+
+        if isinstance(data, dict):
+            with self._lock:
+                aggregator(self._get_project(project_id), data)
+
+    def get(self, project_id=None):
+        """Returns the counters for one project or all of them by project id"""
+        with self._lock:
+            if project_id is not None:
+                return copy_counters(self._projects.get(project_id) or new_counters())
+            return {
+                str(project_id): copy_counters(project)
+                for project_id, project in self._projects.items()
+            }
+
+    def flush(self, project_id=None):
+        """Removes counters
+
+        :arg project_id: if specified, only removes counters for this project
+
+        """
+        with self._lock:
+            if project_id is None:
+                self._projects.clear()
+            else:
+                self._projects.pop(project_id, None)
+
+
+def new_counters():
+    return {
+        "items": {},
+        "sessions": {"started": 0, **{key: 0 for key in SESSION_STATUSES}},
+        "client_reports": {},
+    }
+
+
+def copy_counters(data):
+    if isinstance(data, dict):
+        return {key: copy_counters(value) for key, value in data.items()}
+    return data
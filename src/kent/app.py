@@ -2,36 +2,89 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from dataclasses import dataclass
+import atexit
+import dataclasses
 import datetime
-import gzip
-import json
+import functools
+import io
 import logging
 from logging.config import dictConfig
 import os
-from typing import Optional, Union
+import queue
+import random
+import threading
+import time
 import uuid
 import zlib
 
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, Response, send_file
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import HTTPException
+
+from kent import __version__, codec
+from kent.aggregates import Aggregates, parse_item_policies, STORE
+from kent.attachments import AttachmentStore, get_attachment_ref
+from kent.decoders import (
+    get_decoder,
+    iter_body,
+    iter_decoded,
+    limit_size,
+    PayloadTooLarge,
+    read_body,
+    UnsupportedEncoding,
+)
+from kent.events import (
+    compile_path,
+    DECODE_ERROR_BODY,
+    decode_raw_body,
+    encode_json,
+    estimate_size,
+    Event,
+)
+from kent.ratelimit import (
+    get_category,
+    get_rate_limit_headers,
+    RateLimit,
+    RateLimited,
+    RateLimiter,
+)
+from kent.server import DETACH_KEY
+from kent.storage import get_storage_class
+from kent.utils import EnvelopeParser, iter_lines
+
+
+LOGGER = logging.getLogger(__name__)
 
-from kent import __version__
-from kent.utils import parse_envelope
+# Per-event logging: one record for every event, for a sample of events, or off
+EVENT_LOG_LEVELS = ["all", "sampled", "off"]
+
+# Logger for the one record logged for each event
+EVENT_LOGGER = logging.getLogger("kent.ingest")
 
 
 dictConfig(
     {
         "version": 1,
         "formatters": {
-            "default": {
+            "text": {
                 "format": "[%(asctime)s] %(levelname)s: %(name)s %(message)s",
-            }
+            },
+            "json": {
+                "()": "kent.logs.JSONFormatter",
+            },
         },
         "handlers": {
+            # Logs are written as text or, with KENT_LOG_FORMAT=json, as JSON
+            # lines.
+            #
+            # NOTE: Records are written in a background thread, so
+            # there's no request context and wsgi_errors_stream is stderr.
             "wsgi": {
-                "class": "logging.StreamHandler",
+                "class": "kent.logs.BackgroundHandler",
                 "stream": "ext://flask.logging.wsgi_errors_stream",
-                "formatter": "default",
+                "formatter": (
+                    "json" if os.environ.get("KENT_LOG_FORMAT") == "json" else "text"
+                ),
             },
         },
         "loggers": {
@@ -49,146 +102,731 @@ dictConfig(
 BANNER = None
 
 
-def deep_get(structure, path, default=None):
-    node = structure
-    for part in path.split("."):
-        if part.startswith("["):
-            index = int(part[1:-1])
-            node = node[index]
-        elif part in node:
-            node = node[part]
-        else:
-            return default
-    return node
+# Number of events EventManager.import_events adds to storage at a time
+IMPORT_BATCH_SIZE = 500
 
 
-@dataclass
-class Event:
-    project_id: int
-    event_id: str
+class Subscription:
+    """Queue of new events for a subscriber
 
-    # envelope_header when the envelope API is used
-    envelope_header: Optional[dict] = None
-    # item header
-    header: Optional[dict] = None
-    # item
-    # attachments will be stored as bytes, non-attachments as python
-    # datastructures
-    body: Optional[Union[dict, bytes]] = None
+    The queue is bounded so a slow subscriber can't hold on to an unbounded
+    number of events or slow down adding events. When the queue is full,
+    events are dropped and ``missed`` is set to the highest ``seq`` that was
+    dropped. The subscriber can get missed events from the storage.
 
-    @property
-    def summary(self):
-        if not self.body:
-            return "no summary"
-
-        if isinstance(self.body, dict):
-            # Kent body parsing errors
-            kent_error = self.body.get("error")
-            if kent_error:
-                return kent_error
-
-            # Sentry exceptions events
-            exceptions = deep_get(self.body, "exception.values", default=[])
-            if exceptions:
-                first = exceptions[0]
-                return f"{first['type']}: {first['value']}"
-
-            # Sentry message
-            msg = deep_get(self.body, "message", default=None)
-            if msg:
-                return msg
-
-            # CSP security report (older browsers--single report per payload)
-            if "csp-report" in self.body:
-                directive = deep_get(
-                    self.body, "csp-report.violated-directive", default="unknown"
-                )
-                summary = f"csp-report: {directive}"
-                return summary
+    """
 
-            if self.body.get("type") == "csp-violation":
-                directive = deep_get(
-                    self.body, "body.effectiveDirective", default="unknown"
-                )
-                summary = f"csp-report: {directive}"
-                return summary
+    def __init__(self, project_id=None, maxsize=1000):
+        self.project_id = project_id
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.missed = 0
+        self._missed_lock = threading.Lock()
 
-        return "no summary"
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            with self._missed_lock:
+                self.missed = max(self.missed, event.seq)
 
-    @property
-    def timestamp(self):
-        # NOTE(willkg): timestamp is a string
-        return self.body.get("timestamp") or str(datetime.datetime.now())
+    def get(self, timeout=None):
+        """Returns the next event or None if the timeout passed"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
-    def to_dict(self):
-        return {
-            "project_id": self.project_id,
-            "event_id": self.event_id,
-            "payload": {
-                "envelope_header": self.envelope_header,
-                "header": self.header,
-                "body": self.body,
-            },
-        }
+    def drain(self):
+        """Removes and returns all events in the queue"""
+        events = []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
 
 
 class EventManager:
+    """Keeps the most recent events for each project
+
+    Events are kept in a storage backend. See ``kent.storage``.
+
+    """
+
     MAX_EVENTS = 100
 
-    def __init__(self):
-        # List of Event instances
-        self.events = []
+    # Seconds between checks for new events when waiting on storage that other
+    # processes add events to
+    SHARED_WAIT_INTERVAL = 0.25
+
+    # Maximum number of events queued for each subscriber
+    SUBSCRIBER_QUEUE_SIZE = 1000
+
+    def __init__(
+        self,
+        max_events=None,
+        max_bytes=None,
+        max_project_bytes=None,
+        storage="memory",
+        path=None,
+        **storage_options,
+    ):
+        self.storage = None
+        # Notified when events are added; the generation goes up with each one
+        self._new_events = threading.Condition()
+        self._generation = 0
+        # Subscriptions to new events; this is replaced rather than changed so
+        # add_event can go through it without a lock
+        self._subscriptions = ()
+        self._subscriptions_lock = threading.Lock()
+        self.configure(
+            max_events=max_events,
+            max_bytes=max_bytes,
+            max_project_bytes=max_project_bytes,
+            storage=storage,
+            path=path,
+            **storage_options,
+        )
+
+    def configure(
+        self,
+        max_events=None,
+        max_bytes=None,
+        max_project_bytes=None,
+        storage="memory",
+        path=None,
+        **storage_options,
+    ):
+        """Changes the retention settings and storage backend
+
+        The event count and project byte limits apply to each project
+        separately so a noisy project can't push out another project's events.
+        The byte limit applies to all projects together so memory use doesn't
+        grow with the number of projects.
+
+        :arg max_events: maximum number of events to keep per project; defaults
+            to ``MAX_EVENTS``
+        :arg max_bytes: maximum total size of events to keep for all projects;
+            None means there's no limit
+        :arg max_project_bytes: maximum total size of events to keep per
+            project; None means there's no limit
+        :arg storage: name of the storage backend; see
+            ``kent.storage.STORAGE_BACKENDS``
+        :arg path: path for storage backends that keep events on disk
+        :arg storage_options: any additional arguments for the storage backend
+
+        """
+        self.max_events = max_events or self.MAX_EVENTS
+        self.max_bytes = max_bytes or None
+        self.max_project_bytes = max_project_bytes or None
+        if self.storage is not None:
+            self.storage.close()
+        storage_class = get_storage_class(storage)
+        self.storage = storage_class(
+            max_events=self.max_events,
+            max_bytes=self.max_bytes,
+            max_project_bytes=self.max_project_bytes,
+            path=path,
+            **storage_options,
+        )
 
     def add_event(
-        self, event_id, project_id, envelope_header=None, header=None, body=None
+        self,
+        event_id,
+        project_id,
+        envelope_header=None,
+        header=None,
+        body=None,
+        size=None,
+        raw_body=None,
+        encoding=None,
     ):
+        """Adds an event
+
+        Pass either ``body`` with the decoded body (or bytes for attachments)
+        or ``raw_body`` with the JSON-encoded body. Raw bodies are decoded when
+        they're needed. ``encoding`` is the compression of ``raw_body``, if
+        any.
+
+        If you already decoded the raw body, pass both; ``body`` is then only
+        used to extract the fields events are listed and searched by.
+
+        """
+        if size is None:
+            size = len(raw_body) if raw_body is not None else estimate_size(body)
         event = Event(
             project_id=project_id,
             event_id=event_id,
             envelope_header=envelope_header,
             header=header,
             body=body,
+            size=size,
+            raw_body=raw_body,
+            encoding=encoding,
         )
-        self.events.append(event)
-
-        while len(self.events) > self.MAX_EVENTS:
-            self.events.pop(0)
+        event = self.storage.add_event(event)
+        self._notify([event])
         return event
 
+    def import_events(self, events, batch_size=IMPORT_BATCH_SIZE):
+        """Adds Event instances in batches
+
+        Events with an event id that's already stored are skipped.
+
+        :arg events: iterable of Event instances
+        :arg batch_size: number of events to add to storage at a time
+
+        :returns: ``(imported, skipped)`` counts
+
+        """
+        imported = skipped = 0
+        batch = []
+        batch_ids = set()
+
+        # NOTE: if getting the next event raises an exception, the
+        # events before it are still added
+        try:
+            for event in events:
+                if (
+                    event.event_id in batch_ids
+                    or self.storage.get_event(event.event_id) is not None
+                ):
+                    skipped += 1
+                    continue
+                batch.append(event)
+                batch_ids.add(event.event_id)
+                if len(batch) >= batch_size:
+                    to_add, batch, batch_ids = batch, [], set()
+                    imported += len(self._add_batch(to_add))
+        finally:
+            if batch:
+                imported += len(self._add_batch(batch))
+        return imported, skipped
+
+    def _add_batch(self, events):
+        events = self.storage.add_events(events)
+        self._notify(events)
+        return events
+
+    def _notify(self, events):
+        # Wake up anything waiting for new events
+        with self._new_events:
+            self._generation += 1
+            self._new_events.notify_all()
+
+        for subscription in self._subscriptions:
+            for event in events:
+                if subscription.project_id in (None, event.project_id):
+                    subscription.put(event)
+
     def get_event(self, event_id):
-        for event in self.events:
-            if event.event_id == event_id:
-                return event
-        return None
+        return self.storage.get_event(event_id)
+
+    def get_events(self, project_id=None):
+        """Returns events in the order they were added
+
+        :arg project_id: if specified, only returns events for this project
+
+        :returns: list of Event instances
+
+        """
+        return self.storage.get_events(project_id=project_id)
+
+    def get_cursor(self):
+        """Returns a cursor for events added after now"""
+        return self.storage.get_watermark()
+
+    def get_events_since(self, cursor, project_id=None, limit=None):
+        """Returns events added after a cursor
+
+        :arg cursor: the cursor from a previous call, ``get_cursor()`` or 0 for
+            all events
+        :arg project_id: if specified, only returns events for this project
+        :arg limit: if specified, returns at most this many events
+
+        :returns: ``(events, cursor)`` where cursor is what to pass in next time
+
+        """
+        return self.search(cursor, project_id=project_id, limit=limit)
 
-    def get_events(self):
-        return self.events
+    def search(
+        self, cursor=0, project_id=None, terms=None, start=None, end=None, limit=None
+    ):
+        """Returns events added after a cursor that match all the criteria
+
+        Storage backends keep indexes for this that are updated when events
+        are added. See ``kent.storage.Storage.search`` for the criteria.
+
+        :arg cursor: the cursor from a previous call, ``get_cursor()`` or 0 for
+            all events
+
+        :returns: ``(events, cursor)`` where cursor is what to pass in next time
+
+        """
+        watermark = self.storage.get_watermark()
+        events = self.storage.search(
+            project_id=project_id,
+            terms=terms,
+            start=start,
+            end=end,
+            since=cursor,
+            limit=limit,
+        )
+        if limit is not None and len(events) == limit and events[-1].seq <= watermark:
+            # There may be more events, so continue after the last one
+            return events, events[-1].seq
+
+        events = [event for event in events if event.seq <= watermark]
+        return events, max(cursor, watermark)
+
+    def wait_for_events(self, cursor, project_id=None, timeout=None):
+        """Waits until there are events after a cursor
+
+        :arg cursor: the cursor from a previous call or ``get_cursor()``
+        :arg project_id: if specified, only waits for events for this project
+        :arg timeout: seconds to wait; None waits forever
+
+        :returns: ``(events, cursor)`` like ``get_events_since()``; events is
+            empty if the timeout passed
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # NOTE: get the generation before looking at events so an
+            # event added while we're looking wakes us up
+            with self._new_events:
+                generation = self._generation
+
+            events, cursor = self.get_events_since(cursor, project_id=project_id)
+            if events:
+                return events, cursor
+
+            with self._new_events:
+                if self._generation != generation:
+                    continue
+
+                wait_time = None
+                if deadline is not None:
+                    wait_time = deadline - time.monotonic()
+                    if wait_time <= 0:
+                        return events, cursor
+                if self.storage.shared and (
+                    wait_time is None or wait_time > self.SHARED_WAIT_INTERVAL
+                ):
+                    # Other processes can add events without notifying us, so
+                    # check again every so often
+                    wait_time = self.SHARED_WAIT_INTERVAL
+                self._new_events.wait(wait_time)
+
+    def subscribe(self, project_id=None):
+        """Returns a Subscription that gets events as they're added
+
+        Call ``unsubscribe()`` with the subscription when you're done with it.
+
+        :arg project_id: if specified, only gets events for this project
+
+        """
+        subscription = Subscription(
+            project_id=project_id, maxsize=self.SUBSCRIBER_QUEUE_SIZE
+        )
+        with self._subscriptions_lock:
+            self._subscriptions = self._subscriptions + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._subscriptions_lock:
+            self._subscriptions = tuple(
+                item for item in self._subscriptions if item is not subscription
+            )
+
+    def get_generation(self):
+        """Returns a string that changes whenever events are added or removed"""
+        return self.storage.get_generation()
+
+    def get_usage(self):
+        projects = self.storage.get_usage()
+        return {
+            "events": sum(project["events"] for project in projects.values()),
+            "max_events": self.max_events,
+            "bytes": sum(project["bytes"] for project in projects.values()),
+            "max_bytes": self.max_bytes,
+            "max_project_bytes": self.max_project_bytes,
+            "projects": projects,
+        }
+
+    def flush(self, project_id=None):
+        """Removes events
 
-    def flush(self):
-        self.events = []
+        :arg project_id: if specified, only removes events for this project
+
+        """
+        self.storage.flush(project_id=project_id)
 
 
 EVENTS = EventManager()
 
 
+class IngestQueueFull(Exception):
+    """Raised when the ingest queue is full"""
+
+
+class IngestQueue:
+    """Bounded queue of request bodies that worker threads process
+
+    When there are workers, the ingestion views read the request body, put it
+    on the queue, and respond right away. The workers decompress, parse and
+    store the events.
+
+    """
+
+    # Maximum number of request bodies waiting to be processed
+    QUEUE_SIZE = 1000
+
+    def __init__(self):
+        self.queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self.configure()
+
+        # NOTE: Threads don't survive a fork, so workers forked by
+        # kent-server serve start their own
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork_in_child)
+        # Process the queued request bodies before exiting
+        atexit.register(self.stop)
+
+    def _after_fork_in_child(self):
+        workers = len(self._threads)
+        self._threads = []
+        self.queue = None
+        self._lock = threading.Lock()
+        self._start(workers)
+
+    def configure(self, workers=0, maxsize=None):
+        """Stops the current workers and starts new ones
+
+        :arg workers: number of worker threads; 0 means request bodies are
+            processed when they're received
+        :arg maxsize: maximum number of request bodies waiting to be
+            processed; defaults to ``QUEUE_SIZE``
+
+        """
+        self.stop()
+        self.maxsize = maxsize or self.QUEUE_SIZE
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        # Seconds between accepting the last request body and processing it,
+        # and the most seconds for any request body
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+        self._start(workers)
+
+    def _start(self, workers):
+        if workers:
+            self.queue = queue.Queue(maxsize=self.maxsize)
+            self._threads = [
+                threading.Thread(
+                    target=self._run,
+                    args=(self.queue,),
+                    name=f"kent-ingest-{i}",
+                    daemon=True,
+                )
+                for i in range(workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    @property
+    def enabled(self):
+        return bool(self._threads)
+
+    def submit(self, func, *args):
+        """Queues ``func(*args)`` to be run by a worker
+
+        :raises IngestQueueFull: if the queue is full
+
+        """
+        try:
+            self.queue.put_nowait((time.monotonic(), func, args))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise IngestQueueFull(
+                f"ingest queue has {self.maxsize} request bodies waiting"
+            ) from None
+        with self._lock:
+            self.accepted += 1
+
+    def _run(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                work_queue.task_done()
+                return
+
+            accepted, func, args = item
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                failed = True
+                LOGGER.exception("exception when processing request body")
+            lag = time.monotonic() - accepted
+            with self._lock:
+                self.processed += 1
+                self.failed += failed
+                self.lag = lag
+                self.max_lag = max(self.max_lag, lag)
+            work_queue.task_done()
+
+    def join(self):
+        """Waits until all the queued request bodies are processed"""
+        if self.queue is not None:
+            self.queue.join()
+
+    def stop(self):
+        """Processes the queued request bodies and stops the workers"""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.queue = None
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "workers": len(self._threads),
+                "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "queue_size": self.maxsize,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+                "lag": self.lag,
+                "max_lag": self.max_lag,
+            }
+
+
+INGEST = IngestQueue()
+
+
+RATE_LIMITER = RateLimiter()
+
+
+AGGREGATES = Aggregates()
+
+
+ATTACHMENTS = AttachmentStore()
+
+
+def delete_evicted_attachment(event):
+    """Deletes the file for an attachment event that storage evicted"""
+    if event.item_type != "attachment":
+        return
+    ref = get_attachment_ref(event.body)
+    if ref is not None:
+        ATTACHMENTS.delete(event.project_id, ref.get("id"))
+
+
+def parse_rate_limits(data):
+    """Returns RateLimit instances for a list of rate limits as dicts
+
+    :arg data: list of dicts or a JSON-encoded list of dicts
+
+    :raises ValueError: if the rate limits aren't valid
+
+    """
+    if isinstance(data, str):
+        data = codec.loads(data)
+    if not isinstance(data, list):
+        raise ValueError(f"rate limits must be a list: {data!r}")
+    return [RateLimit.from_dict(item) for item in data]
+
+
+# Views that ingest request bodies; KENT_MAX_COMPRESSED_BYTES limits their size
+INGEST_ENDPOINTS = {"store_view", "envelope_view", "security_view"}
+
+
+def get_max_body_bytes(app, method, path):
+    """Returns the most bytes a server should read for a request body
+
+    Ingestion bodies are limited by ``KENT_MAX_COMPRESSED_BYTES``. Other
+    requests, like imports, aren't limited.
+
+    :arg app: the Flask app
+    :arg method: the request method
+    :arg path: the request path
+
+    :returns: number of bytes or None for no limit
+
+    """
+    try:
+        endpoint, _ = app.url_map.bind("").match(path, method)
+    except HTTPException:
+        return None
+    if endpoint not in INGEST_ENDPOINTS:
+        return None
+    return app.config["KENT_MAX_COMPRESSED_BYTES"] or None
+
+
+# Arguments for /api/events/search/ that match event fields; see
+# kent.events.get_terms
+SEARCH_FIELDS = [
+    "item_type",
+    "exception_type",
+    "sdk_name",
+    "sdk_version",
+    "release",
+    "environment",
+]
+
+# Number of events /api/export/ gets from storage at a time
+EXPORT_BATCH_SIZE = 500
+
+# Bytes /api/import/ reads from the request at a time
+IMPORT_CHUNK_SIZE = 64 * 1024
+
+# Bytes the ingestion views read from the request at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# Maximum sizes in bytes of a request body as received and decompressed; the
+# same as Relay's defaults for API payloads and envelopes
+MAX_COMPRESSED_BYTES = 20 * 1024 * 1024
+MAX_DECOMPRESSED_BYTES = 100 * 1024 * 1024
+
+# Attachments bigger than this many bytes are written to files instead of kept
+# in memory
+ATTACHMENT_SPILL_BYTES = 1024 * 1024
+
+# Seconds clients are told to wait before retrying when the ingest queue is full
+INGEST_RETRY_AFTER = 1
+
+# Seconds /api/wait/ waits for events by default and at most
+DEFAULT_WAIT_TIMEOUT = 5
+MAX_WAIT_TIMEOUT = 60
+
+# Seconds between keep-alive comments in /api/stream/
+STREAM_KEEP_ALIVE = 15
+
+
+# Fraction of events logged when KENT_EVENT_LOG is "sampled"
+EVENT_LOG_SAMPLE_RATE = 0.1
+
+
 INTERESTING_HEADERS = [
     "User-Agent",
     "X-Sentry-Auth",
 ]
 
 
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that uses kent.codec"""
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return codec.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Pretty-printed responses use json
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            data = encode_json(obj)
+        except TypeError:
+            # Let json use Flask's handling for dates, decimals, and so on
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data, mimetype=self.mimetype)
+
+
 def create_app(test_config=None):
     dev_mode = os.environ.get("KENT_DEV", "0") == "1"
 
-    # Always start an app with an empty error manager
-    EVENTS.flush()
-
     app = Flask(__name__, instance_relative_config=True)
-    app.config.from_mapping(SECRET_KEY="dev")
+    app.config.from_mapping(
+        SECRET_KEY="dev",
+        KENT_MAX_EVENTS=int(os.environ.get("KENT_MAX_EVENTS", EventManager.MAX_EVENTS)),
+        KENT_MAX_BYTES=int(os.environ.get("KENT_MAX_BYTES", 0)) or None,
+        KENT_MAX_PROJECT_BYTES=int(os.environ.get("KENT_MAX_PROJECT_BYTES", 0)) or None,
+        KENT_STORAGE=os.environ.get("KENT_STORAGE", "memory"),
+        KENT_STORAGE_PATH=os.environ.get("KENT_STORAGE_PATH"),
+        KENT_LOG_SEGMENT_BYTES=int(os.environ.get("KENT_LOG_SEGMENT_BYTES", 0)) or None,
+        KENT_LOG_MAX_BYTES=int(os.environ.get("KENT_LOG_MAX_BYTES", 0)) or None,
+        KENT_KEEP_COMPRESSED=os.environ.get("KENT_KEEP_COMPRESSED", "0") == "1",
+        KENT_MAX_COMPRESSED_BYTES=int(
+            os.environ.get("KENT_MAX_COMPRESSED_BYTES", MAX_COMPRESSED_BYTES)
+        )
+        or None,
+        KENT_MAX_DECOMPRESSED_BYTES=int(
+            os.environ.get("KENT_MAX_DECOMPRESSED_BYTES", MAX_DECOMPRESSED_BYTES)
+        )
+        or None,
+        KENT_JSON_BACKEND=os.environ.get("KENT_JSON_BACKEND", "auto"),
+        KENT_EVENT_LOG=os.environ.get("KENT_EVENT_LOG", "all"),
+        KENT_EVENT_LOG_SAMPLE_RATE=float(
+            os.environ.get("KENT_EVENT_LOG_SAMPLE_RATE", EVENT_LOG_SAMPLE_RATE)
+        ),
+        KENT_RATE_LIMITS=os.environ.get("KENT_RATE_LIMITS", "[]"),
+        KENT_ITEM_POLICIES=os.environ.get("KENT_ITEM_POLICIES", ""),
+        KENT_ATTACHMENT_SPILL_BYTES=int(
+            os.environ.get("KENT_ATTACHMENT_SPILL_BYTES", ATTACHMENT_SPILL_BYTES)
+        )
+        or None,
+        KENT_ATTACHMENT_PATH=os.environ.get("KENT_ATTACHMENT_PATH"),
+        KENT_ATTACHMENT_MAX_BYTES=int(os.environ.get("KENT_ATTACHMENT_MAX_BYTES", 0))
+        or None,
+        KENT_INGEST_WORKERS=int(os.environ.get("KENT_INGEST_WORKERS", 0)),
+        KENT_INGEST_QUEUE_SIZE=int(
+            os.environ.get("KENT_INGEST_QUEUE_SIZE", IngestQueue.QUEUE_SIZE)
+        ),
+    )
 
     if test_config is not None:
         app.config.from_mapping(test_config)
 
+    codec.set_backend(app.config["KENT_JSON_BACKEND"])
+    if app.config["KENT_EVENT_LOG"] not in EVENT_LOG_LEVELS:
+        raise ValueError(f"unknown KENT_EVENT_LOG: {app.config['KENT_EVENT_LOG']!r}")
+    app.json = JSONProvider(app)
+
+    # Configure attachments first; storage backends that keep events on disk
+    # can evict events with attachments when they start up
+    ATTACHMENTS.configure(
+        path=app.config["KENT_ATTACHMENT_PATH"],
+        max_bytes=app.config["KENT_ATTACHMENT_MAX_BYTES"],
+    )
+
+    # Always start an app with a fresh event manager; storage backends that
+    # keep events on disk keep their events
+    storage_options = {}
+    if app.config["KENT_STORAGE"] == "log":
+        storage_options = {
+            "segment_bytes": app.config["KENT_LOG_SEGMENT_BYTES"],
+            "max_log_bytes": app.config["KENT_LOG_MAX_BYTES"],
+        }
+    EVENTS.configure(
+        max_events=app.config["KENT_MAX_EVENTS"],
+        max_bytes=app.config["KENT_MAX_BYTES"],
+        max_project_bytes=app.config["KENT_MAX_PROJECT_BYTES"],
+        storage=app.config["KENT_STORAGE"],
+        path=app.config["KENT_STORAGE_PATH"],
+        on_evict=delete_evicted_attachment,
+        **storage_options,
+    )
+    RATE_LIMITER.configure(parse_rate_limits(app.config["KENT_RATE_LIMITS"]))
+    item_policies = parse_item_policies(app.config["KENT_ITEM_POLICIES"])
+    AGGREGATES.flush()
+    INGEST.configure(
+        workers=app.config["KENT_INGEST_WORKERS"],
+        maxsize=app.config["KENT_INGEST_QUEUE_SIZE"],
+    )
+
     if BANNER:
         app.logger.info(BANNER)
 
@@ -196,212 +834,766 @@ def create_app(test_config=None):
         logging.getLogger("kent").setLevel(logging.DEBUG)
         app.logger.debug("Dev mode on.")
 
+    def get_int_arg(name):
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an integer: {value!r}") from None
+
+    def get_time_arg(name):
+        """Returns a time argument as seconds since the epoch
+
+        Times can be seconds since the epoch, negative seconds relative to now,
+        or ISO 8601 datetimes. Datetimes without a timezone are in UTC.
+
+        """
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            pass
+        else:
+            return time.time() + seconds if seconds < 0 else seconds
+
+        try:
+            dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError(f"{name} must be a time: {value!r}") from None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt.timestamp()
+
+    def get_fields_arg():
+        """Returns the compiled paths in the fields argument or None
+
+        Paths are separated by commas and the argument can be passed more than
+        once.
+
+        """
+        fields = request.args.getlist("fields")
+        if not fields:
+            return None
+        return [
+            (path, compile_path(path))
+            for value in fields
+            for path in value.split(",")
+            if path
+        ]
+
+    def detach_request():
+        """Tells the server that this request is going to wait a long time
+
+        Kent's servers stop counting the request against ``--threads`` so
+        long polls and event streams don't hold up other requests.
+
+        """
+        detach = request.environ.get(DETACH_KEY)
+        if detach is not None:
+            detach()
+
+    def conditional(view):
+        """Adds an ETag to responses based on the event generation
+
+        Requests with an ``If-None-Match`` header with the current ETag get a
+        304 without running the view.
+
+        """
+
+        @functools.wraps(view)
+        def _conditional(*args, **kwargs):
+            # NOTE: get the generation before the view gets events so
+            # the ETag is never newer than the response
+            etag = EVENTS.get_generation()
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            return response
+
+        return _conditional
+
     @app.route("/", methods=["GET"])
+    @conditional
     def index_view():
         host = request.scheme + "://" + request.headers["host"]
         dsn = request.scheme + "://public@" + request.headers["host"] + "/1"
 
+        # Get the cursor first so the page reloads for events added after it
+        cursor = EVENTS.get_cursor()
         return render_template(
             "index.html",
             host=host,
             dsn=dsn,
+            cursor=cursor,
             events=EVENTS.get_events(),
+            usage=EVENTS.get_usage(),
             version=__version__,
         )
 
     @app.route("/api/event/<event_id>", methods=["GET"])
     def api_event_view(event_id):
         app.logger.info(f"GET /api/event/{event_id}")
+        try:
+            paths = get_fields_arg()
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+
         event = EVENTS.get_event(event_id)
         if event is None:
             return {"error": f"Event {event_id} not found"}, 404
 
-        return event.to_dict()
+        if paths is not None:
+            return event.to_dict(paths=paths)
+        return app.response_class(event.to_json(), mimetype="application/json")
 
-    @app.route("/api/eventlist/", methods=["GET"])
-    def api_event_list_view():
-        app.logger.info("GET /api/eventlist/")
-        event_ids = [
-            {
+    @app.route("/api/event/<event_id>/attachment", methods=["GET"])
+    def api_event_attachment_view(event_id):
+        app.logger.info(f"GET /api/event/{event_id}/attachment")
+        event = EVENTS.get_event(event_id)
+        if event is None:
+            return {"error": f"Event {event_id} not found"}, 404
+        if event.item_type != "attachment":
+            return {"error": f"Event {event_id} is not an attachment"}, 404
+
+        header = event.header or {}
+        kwargs = {
+            "mimetype": header.get("content_type") or "application/octet-stream",
+            "as_attachment": True,
+            "download_name": header.get("filename") or event_id,
+            "conditional": True,
+        }
+        body = event.body
+        ref = get_attachment_ref(body)
+        if ref is None:
+            if not isinstance(body, bytes):
+                return {"error": f"Event {event_id} has no attachment"}, 404
+            return send_file(io.BytesIO(body), etag=False, **kwargs)
+
+        path = ATTACHMENTS.find(event.project_id, ref)
+        if path is None:
+            return {"error": f"Attachment for event {event_id} was removed"}, 404
+        # send_file streams the file and handles Range requests
+        return send_file(path, **kwargs)
+
+    def event_list_response(events, paths=None):
+        event_ids = []
+        for event in events:
+            item = {
                 "project_id": event.project_id,
                 "event_id": event.event_id,
                 "summary": event.summary,
             }
-            for event in EVENTS.get_events()
-        ]
+            if paths is not None:
+                item["fields"] = event.get_fields(paths)
+            event_ids.append(item)
         return {"events": event_ids}
 
+    def paginated_event_list_response(project_id=None):
+        try:
+            since = get_int_arg("since")
+            limit = get_int_arg("limit")
+            paths = get_fields_arg()
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+        if limit is not None and limit < 1:
+            return {"error": f"limit must be at least 1: {limit}"}, 400
+
+        events, cursor = EVENTS.get_events_since(
+            since or 0, project_id=project_id, limit=limit
+        )
+        response = event_list_response(events, paths=paths)
+        response["cursor"] = cursor
+        return response
+
+    @app.route("/api/eventlist/", methods=["GET"])
+    @conditional
+    def api_event_list_view():
+        app.logger.info("GET /api/eventlist/")
+        return paginated_event_list_response()
+
+    @app.route("/api/<int:project_id>/eventlist/", methods=["GET"])
+    @conditional
+    def api_project_event_list_view(project_id):
+        app.logger.info(f"GET /api/{project_id}/eventlist/")
+        return paginated_event_list_response(project_id=project_id)
+
+    def get_search_args():
+        """Returns search arguments for EventManager.search from the request
+
+        :raises ValueError: if an argument isn't valid
+
+        """
+        terms = [
+            (field, request.args[field])
+            for field in SEARCH_FIELDS
+            if field in request.args
+        ]
+        for tag in request.args.getlist("tag"):
+            key, sep, value = tag.partition(":")
+            if not sep:
+                raise ValueError(f"tag must be KEY:VALUE: {tag!r}")
+            terms.append((f"tag:{key}", value))
+
+        return {
+            "project_id": get_int_arg("project_id"),
+            "terms": terms,
+            "start": get_time_arg("start"),
+            "end": get_time_arg("end"),
+        }
+
+    @app.route("/api/events/search/", methods=["GET"])
+    def api_search_view():
+        app.logger.info("GET /api/events/search/")
+        try:
+            search_args = get_search_args()
+            since = get_int_arg("since")
+            limit = get_int_arg("limit")
+            paths = get_fields_arg()
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+        if limit is not None and limit < 1:
+            return {"error": f"limit must be at least 1: {limit}"}, 400
+
+        events, cursor = EVENTS.search(since or 0, limit=limit, **search_args)
+        response = event_list_response(events, paths=paths)
+        response["cursor"] = cursor
+        return response
+
+    @app.route("/api/export/", methods=["GET"])
+    def api_export_view():
+        app.logger.info("GET /api/export/")
+        try:
+            search_args = get_search_args()
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+
+        def export_lines():
+            # Export events that are stored now; get them from storage a batch
+            # at a time so memory use stays flat
+            last = EVENTS.get_cursor()
+            cursor = 0
+            while True:
+                events, cursor = EVENTS.search(
+                    cursor, limit=EXPORT_BATCH_SIZE, **search_args
+                )
+                for event in events:
+                    if event.seq > last:
+                        return
+                    yield encode_json(event.to_export())
+                if len(events) < EXPORT_BATCH_SIZE:
+                    return
+
+        def compress(lines):
+            compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+            for line in lines:
+                data = compressor.compress(line)
+                if data:
+                    yield data
+            yield compressor.flush()
+
+        use_gzip = "gzip" in request.accept_encodings
+        body = compress(export_lines()) if use_gzip else export_lines()
+        response = Response(body, mimetype="application/x-ndjson")
+        response.headers["Vary"] = "Accept-Encoding"
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+        return response
+
+    @app.route("/api/import/", methods=["POST"])
+    def api_import_view():
+        app.logger.info("POST /api/import/")
+        chunks = iter(lambda: request.stream.read(IMPORT_CHUNK_SIZE), b"")
+        decoder = get_decoder(request.headers.get("content-encoding"))
+        if decoder is not None:
+            chunks = iter_decoded(chunks, decoder)
+
+        def imported_events():
+            for lineno, line in enumerate(iter_lines(chunks), start=1):
+                try:
+                    yield Event.from_export(codec.loads(line))
+                except ValueError as exc:
+                    raise ValueError(f"line {lineno}: {exc}") from exc
+
+        try:
+            imported, skipped = EVENTS.import_events(imported_events())
+        except ValueError as exc:
+            app.logger.error("import failed: %s", exc)
+            return {"error": str(exc)}, 400
+
+        app.logger.info("imported %s events; skipped %s", imported, skipped)
+        return {"success": True, "imported": imported, "skipped": skipped}
+
+    @app.route("/api/wait/", methods=["GET"])
+    def api_wait_view():
+        app.logger.info("GET /api/wait/")
+        try:
+            project_id = get_int_arg("project_id")
+            cursor = get_int_arg("after")
+            timeout = float(request.args.get("timeout", DEFAULT_WAIT_TIMEOUT))
+            paths = get_fields_arg()
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+
+        # Without a cursor, wait for the next event
+        if cursor is None:
+            cursor = EVENTS.get_cursor()
+        timeout = max(0, min(timeout, MAX_WAIT_TIMEOUT))
+
+        detach_request()
+        events, cursor = EVENTS.wait_for_events(
+            cursor, project_id=project_id, timeout=timeout
+        )
+        response = event_list_response(events, paths=paths)
+        response["cursor"] = cursor
+        return response
+
+    @app.route("/api/stream/", methods=["GET"])
+    def api_stream_view():
+        app.logger.info("GET /api/stream/")
+        try:
+            project_id = get_int_arg("project_id")
+            cursor = get_int_arg("after")
+            if "Last-Event-ID" in request.headers:
+                cursor = int(request.headers["Last-Event-ID"])
+        except ValueError as exc:
+            return {"error": str(exc)}, 400
+
+        # Subscribe before getting events from storage so no events fall
+        # between the two. Without a cursor, the stream starts with the next
+        # event.
+        if cursor is None:
+            cursor = EVENTS.get_cursor()
+        subscription = EVENTS.subscribe(project_id=project_id)
+
+        def format_event(event):
+            data = codec.dumps(
+                {
+                    "project_id": event.project_id,
+                    "event_id": event.event_id,
+                    "summary": event.summary,
+                }
+            )
+            return f"id: {event.seq}\ndata: {data.decode('utf-8')}\n\n"
+
+        def stream(cursor):
+            # Send something right away so clients and proxies know the stream
+            # has started
+            yield ": stream started\n\n"
+
+            # NOTE: events are always sent from storage. It returns them in
+            # seq order up to the watermark and the cursor moves past every
+            # event that's sent, so events added concurrently or dropped by a
+            # subscriber that fell behind aren't skipped or sent twice. The
+            # subscription only wakes the stream up.
+            wait_time = STREAM_KEEP_ALIVE
+            if EVENTS.storage.shared:
+                # Other processes can add events without notifying us, so
+                # check again every so often
+                wait_time = EVENTS.SHARED_WAIT_INTERVAL
+
+            last_sent = time.monotonic()
+            while True:
+                subscription.drain()
+                events, cursor = EVENTS.get_events_since(cursor, project_id=project_id)
+                for event in events:
+                    yield format_event(event)
+                if events:
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= STREAM_KEEP_ALIVE:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+                subscription.get(timeout=wait_time)
+
+        detach_request()
+        response = Response(stream(cursor), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.call_on_close(lambda: EVENTS.unsubscribe(subscription))
+        return response
+
+    @app.route("/api/<int:project_id>/flush/", methods=["POST"])
+    def api_project_flush_view(project_id):
+        app.logger.info(f"POST /api/{project_id}/flush/")
+        EVENTS.flush(project_id=project_id)
+        AGGREGATES.flush(project_id=project_id)
+        ATTACHMENTS.flush(project_id=project_id)
+        return {"success": True}
+
+    @app.route("/api/usage/", methods=["GET"])
+    def api_usage_view():
+        app.logger.info("GET /api/usage/")
+        return EVENTS.get_usage()
+
     @app.route("/api/flush/", methods=["POST"])
     def api_flush_view():
         app.logger.info("POST /api/flush")
         EVENTS.flush()
+        AGGREGATES.flush()
+        ATTACHMENTS.flush()
         return {"success": True}
 
-    def log_headers(dev_mode, error_id, headers):
-        # Log headers
+    def get_request_chunks():
+        """Returns an iterator of chunks of the request body as received
+
+        :raises PayloadTooLarge: if the request says it's over the limit
+
+        """
+        max_compressed = app.config["KENT_MAX_COMPRESSED_BYTES"]
+        # Reject bodies that say they're too big before reading them
+        if max_compressed and (request.content_length or 0) > max_compressed:
+            raise PayloadTooLarge(f"body is larger than {max_compressed} bytes")
+        return iter(lambda: request.stream.read(READ_CHUNK_SIZE), b"")
+
+    def get_body_kwargs(encoding):
+        return {
+            "encoding": encoding,
+            "max_compressed": app.config["KENT_MAX_COMPRESSED_BYTES"],
+            "max_decompressed": app.config["KENT_MAX_DECOMPRESSED_BYTES"],
+        }
+
+    @app.errorhandler(PayloadTooLarge)
+    def payload_too_large(exc):
+        app.logger.warning("%s %s: %s", request.method, request.path, exc)
+        # The rest of the body wasn't read, so the connection can't be reused
+        return {"error": str(exc)}, 413, {"Connection": "close"}
+
+    @app.errorhandler(UnsupportedEncoding)
+    def unsupported_encoding(exc):
+        app.logger.warning("%s %s: %s", request.method, request.path, exc)
+        return {"error": str(exc)}, 415, {"Connection": "close"}
+
+    @app.errorhandler(IngestQueueFull)
+    def ingest_queue_full(exc):
+        app.logger.warning("%s %s: %s", request.method, request.path, exc)
+        return {"error": str(exc)}, 429, {"Retry-After": str(INGEST_RETRY_AFTER)}
+
+    @app.errorhandler(RateLimited)
+    def rate_limited(exc):
+        app.logger.warning("%s %s: %s", request.method, request.path, exc)
+        # The body might not have been read, so the connection can't be reused
+        headers = get_rate_limit_headers(exc.rejections)
+        headers["Connection"] = "close"
+        return {"error": str(exc)}, 429, headers
+
+    def get_origin():
+        """Returns what log_event needs to know about the request"""
         if dev_mode:
-            for key, val in headers.items():
-                app.logger.info("%s: header: %s: %s", error_id, key, val)
+            headers = dict(request.headers)
         else:
-            for key in INTERESTING_HEADERS:
-                if key in headers:
-                    app.logger.info(
-                        "%s: header: %s: %s", error_id, key, request.headers[key]
-                    )
+            headers = {
+                key: request.headers[key]
+                for key in INTERESTING_HEADERS
+                if key in request.headers
+            }
+        return {"url_root": f"{request.scheme}://{request.host}", "headers": headers}
+
+    def log_event(event, origin):
+        """Logs one record for an ingested event
+
+        Depending on KENT_EVENT_LOG, every event, a sample of events, or none
+        of them are logged.
+
+        """
+        level = app.config["KENT_EVENT_LOG"]
+        if level == "off" or not EVENT_LOGGER.isEnabledFor(logging.INFO):
+            return
+        if (
+            level == "sampled"
+            and random.random() >= (app.config["KENT_EVENT_LOG_SAMPLE_RATE"])
+        ):
+            return
+
+        fields = {
+            "event_id": event.event_id,
+            "project_id": event.project_id,
+            "type": event.item_type,
+            "sdk": (
+                f"{event.sdk_name} {event.sdk_version}" if event.sdk_name else None
+            ),
+            "summary": event.summary,
+            "url": f"{origin['url_root']}/api/event/{event.event_id}",
+            "headers": origin["headers"],
+        }
+        # The message is formatted by the handler, not here
+        EVENT_LOGGER.info(
+            "%s: project id: %s type: %s sdk: %s summary: %s url: %s headers: %s",
+            fields["event_id"],
+            fields["project_id"],
+            fields["type"],
+            fields["sdk"],
+            fields["summary"],
+            fields["url"],
+            fields["headers"],
+            extra={"event": fields},
+        )
 
-    @app.route("/api/<int:project_id>/store/", methods=["POST"])
-    def store_view(project_id):
-        app.logger.info(f"POST /api/{project_id}/store/")
-        event_id = str(uuid.uuid4())
-        log_headers(dev_mode, event_id, request.headers)
+    def ingest(process, project_id, categories=(None,)):
+        """Processes the request body with an ingest function
 
-        # Decompress it
-        if request.headers.get("content-encoding") == "gzip":
-            body = gzip.decompress(request.data)
-        elif request.headers.get("content-encoding") == "deflate":
-            body = zlib.decompress(request.data)
-        else:
-            body = request.data
+        Without ingest workers, the body is processed as it's read. With
+        workers, the body is read and queued for a worker to process.
 
-        app.logger.debug(f"{body}")
+        :arg process: ingest function that takes the project id, an iterable
+            of body chunks, the Content-Encoding and the request's origin
+        :arg project_id: the project id
+        :arg categories: rate limit categories for the payload; see
+            ``kent.ratelimit.RateLimiter.take``
 
-        # JSON decode payload
-        try:
-            json_body = json.loads(body)
-        except Exception:
-            app.logger.exception("%s: exception when JSON-decoding body.", event_id)
-            app.logger.error("%s: %s", event_id, json_body)
-            EVENTS.add_event(
-                event_id=event_id,
-                project_id=project_id,
-                body={"error": "Kent could not decode body; see logs"},
-            )
-            raise
+        :returns: what the ingest function returns or None if the body was
+            queued
 
-        event = EVENTS.add_event(
-            event_id=event_id, project_id=project_id, body=json_body
-        )
+        :raises RateLimited: if the payload is over a rate limit
+        :raises UnsupportedEncoding: if Kent can't decode the Content-Encoding
+        :raises PayloadTooLarge: if the body is over the configured limits
+        :raises IngestQueueFull: if there are too many queued bodies
+
+        """
+        RATE_LIMITER.take(project_id, categories)
 
-        # Log sentry sdk information from payload
-        app.logger.info(
-            "%s: sdk: %s %s",
-            event_id,
-            deep_get(json_body, "sdk.name"),
-            deep_get(json_body, "sdk.version"),
+        encoding = request.headers.get("content-encoding")
+        origin = get_origin()
+        if not INGEST.enabled:
+            return process(project_id, get_request_chunks(), encoding, origin)
+
+        # Check the Content-Encoding and compressed size now; the worker checks
+        # the decompressed size
+        get_decoder(encoding)
+        raw_body = b"".join(
+            limit_size(get_request_chunks(), app.config["KENT_MAX_COMPRESSED_BYTES"])
         )
+        INGEST.submit(process, project_id, [raw_body], encoding, origin)
 
-        # Log event summary
-        app.logger.info("%s: summary: %s", event_id, event.summary)
+    def ingest_store(project_id, chunks, encoding, origin):
+        event_id = str(uuid.uuid4())
 
-        # Log event url
-        event_url = f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
-        app.logger.info("%s: project id: %s", event_id, project_id)
-        app.logger.info("%s: url: %s", event_id, event_url)
+        # Decompress it
+        raw_body, body = read_body(chunks, **get_body_kwargs(encoding))
 
-        return {"success": True}
+        app.logger.debug("%s", body)
 
-    @app.route("/api/<int:project_id>/envelope/", methods=["POST"])
-    def envelope_view(project_id):
-        app.logger.info(f"POST /api/{project_id}/envelope/")
-        request_id = str(uuid.uuid4())
-        log_headers(dev_mode, request_id, request.headers)
+        # Decode it once to extract the fields events are listed and searched
+        # by; the event keeps the raw body and decodes it again when it's
+        # needed
+        try:
+            decoded = codec.loads(body)
+        except ValueError:
+            decoded = None
+        if not isinstance(decoded, (dict, list)):
+            app.logger.error("%s: body is not JSON: %r", event_id, body[:1000])
+            EVENTS.add_event(
+                event_id=event_id, project_id=project_id, body=DECODE_ERROR_BODY
+            )
+            raise ValueError(f"{event_id}: body is not JSON")
 
-        # Decompress it
-        if request.headers.get("content-encoding") == "gzip":
-            body = gzip.decompress(request.data)
-        elif request.headers.get("content-encoding") == "deflate":
-            body = zlib.decompress(request.data)
+        if raw_body is not body and app.config["KENT_KEEP_COMPRESSED"]:
+            event = EVENTS.add_event(
+                event_id=event_id,
+                project_id=project_id,
+                body=decoded,
+                raw_body=raw_body,
+                encoding=encoding,
+                size=len(body),
+            )
         else:
-            body = request.data
+            event = EVENTS.add_event(
+                event_id=event_id, project_id=project_id, body=decoded, raw_body=body
+            )
+        log_event(event, origin)
+
+    def delete_attachments(project_id, items):
+        """Deletes the files for attachments in items that were written to files"""
+        for item in items:
+            ref = get_attachment_ref(item.body)
+            if ref is not None:
+                ATTACHMENTS.delete(project_id, ref["id"])
+
+    def ingest_envelope(project_id, chunks, encoding, origin):
+        """Adds the items in an envelope
+
+        Items are stored, aggregated or dropped depending on the policy for
+        their item type; see ``kent.aggregates``.
+
+        :returns: ``(accepted, rejections)`` with the number of items that
+            weren't rate limited and the rate limits that dropped items
+
+        """
+        # Decompress and parse it as it's read; the items are added once the
+        # whole envelope has been read so a bad envelope doesn't add anything
+        parser = EnvelopeParser(decode=False)
+        items = []
+        spill_bytes = app.config["KENT_ATTACHMENT_SPILL_BYTES"]
+
+        def spill(new_items):
+            # Write big attachments to files as soon as they're parsed
+            for item in new_items:
+                if (
+                    spill_bytes
+                    and item.header.get("type") == "attachment"
+                    and item.size > spill_bytes
+                ):
+                    item = dataclasses.replace(
+                        item, body=ATTACHMENTS.write(project_id, item.body)
+                    )
+                items.append(item)
+
+        try:
+            for piece in iter_body(chunks, **get_body_kwargs(encoding)):
+                spill(parser.feed(piece))
+            spill(parser.close())
+        except Exception:
+            delete_attachments(project_id, items)
+            raise
 
-        app.logger.debug(f"{body}")
+        accepted = 0
+        # limit -> longest wait for items it dropped
+        rejections = {}
+        for item in items:
+            item_type = item.header.get("type", "event")
+            try:
+                RATE_LIMITER.take(project_id, (get_category(item_type),))
+            except RateLimited as exc:
+                for limit, wait in exc.rejections:
+                    rejections[limit] = max(wait, rejections.get(limit, 0))
+                delete_attachments(project_id, [item])
+                continue
+            accepted += 1
+
+            action = item_policies.get(item_type, STORE).get_action()
+            AGGREGATES.count(project_id, item_type, action)
+            if action == "aggregate":
+                AGGREGATES.add(project_id, item_type, item.body)
+            if action != "store":
+                delete_attachments(project_id, [item])
+                continue
 
-        for item in parse_envelope(body):
             event_id = str(uuid.uuid4())
+            app.logger.debug("%s: item header: %s", event_id, item.header)
+            # Attachments are kept as bytes; everything else is kept as the
+            # JSON it was sent as and decoded once now to extract fields
+            size = item.size
+            if isinstance(item.body, dict):
+                # Attachment that was written to a file; the event only holds
+                # the reference, so that's what counts against the size limit
+                body_kwargs = {"body": item.body}
+                size = None
+            elif item.header.get("type") == "attachment":
+                # NOTE: The attachment body is a view of the request
+                # body; copy it so the event doesn't keep the chunk around
+                body_kwargs = {"body": bytes(item.body)}
+            else:
+                body_kwargs = {
+                    "body": decode_raw_body(event_id, item.body),
+                    "raw_body": item.body,
+                }
             event = EVENTS.add_event(
                 event_id=event_id,
                 project_id=project_id,
                 envelope_header=item.envelope_header,
                 header=item.header,
-                body=item.body,
-            )
-
-            # Log sentry sdk information from payload
-            app.logger.info(
-                "%s: sdk: %s %s",
-                event_id,
-                deep_get(item.body, "sdk.name"),
-                deep_get(item.body, "sdk.version"),
-            )
-
-            # Log event summary
-            app.logger.info("%s: summary: %s", event_id, event.summary)
-
-            # Log event url
-            event_url = (
-                f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
+                size=size,
+                **body_kwargs,
             )
-            app.logger.info("%s: project id: %s", event_id, project_id)
-            app.logger.info("%s: url: %s", event_id, event_url)
+            log_event(event, origin)
 
-        return {"success": True}
+        return accepted, list(rejections.items())
 
-    @app.route("/api/<int:project_id>/security/", methods=["POST"])
-    def security_view(project_id):
-        app.logger.info(f"POST /api/{project_id}/security/")
+    def ingest_security(project_id, chunks, encoding, origin):
         event_id = str(uuid.uuid4())
-        log_headers(dev_mode, event_id, request.headers)
 
-        body = request.data
+        _, body = read_body(chunks, **get_body_kwargs(encoding))
 
-        app.logger.debug(f"{body}")
+        app.logger.debug("%s", body)
 
         # Decode the JSON payload
         try:
-            json_body = json.loads(body)
+            json_body = codec.loads(body)
         except Exception:
             app.logger.exception("%s: exception when JSON-decoding body.", event_id)
             app.logger.error("%s: %s", event_id, body)
             EVENTS.add_event(
-                event_id=event_id,
-                project_id=project_id,
-                body={"error": "Kent could not decode body; see logs"},
+                event_id=event_id, project_id=project_id, body=DECODE_ERROR_BODY
             )
             raise
 
         if isinstance(json_body, list):
             # Single payload with multiple reports per CSP 3
-            for csp_report in json_body:
+            for i, csp_report in enumerate(json_body):
+                # Each report gets its own event id so they can be looked up
+                if i > 0:
+                    event_id = str(uuid.uuid4())
                 event = EVENTS.add_event(
                     event_id=event_id, project_id=project_id, body=csp_report
                 )
-
-                # Log event summary
-                app.logger.info("%s: summary: %s", event_id, event.summary)
-
-                # Log event url
-                event_url = (
-                    f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
-                )
-                app.logger.info("%s: project id: %s", event_id, project_id)
-                app.logger.info("%s: url: %s", event_id, event_url)
+                log_event(event, origin)
 
         else:
             # Old CSP report format where it's a single report
             event = EVENTS.add_event(
-                event_id=event_id, project_id=project_id, body=json_body
+                event_id=event_id, project_id=project_id, body=json_body, size=len(body)
             )
+            log_event(event, origin)
 
-            # Log event summary
-            app.logger.info("%s: summary: %s", event_id, event.summary)
+    @app.route("/api/<int:project_id>/store/", methods=["POST"])
+    def store_view(project_id):
+        ingest(ingest_store, project_id, (None, "error"))
+        return {"success": True}
 
-            # Log event url
-            event_url = (
-                f"{request.scheme}://{request.headers['host']}/api/event/{event_id}"
-            )
-            app.logger.info("%s: project id: %s", event_id, project_id)
-            app.logger.info("%s: url: %s", event_id, event_url)
+    @app.route("/api/<int:project_id>/envelope/", methods=["POST"])
+    def envelope_view(project_id):
+        result = ingest(ingest_envelope, project_id)
+        if result is not None:
+            accepted, rejections = result
+            if rejections:
+                # Like Relay, it's a 429 if all the items were dropped and the
+                # SDK is told about the limits either way
+                if not accepted:
+                    raise RateLimited(rejections)
+                headers = get_rate_limit_headers(rejections)
+                return {"success": True}, 200, headers
+        return {"success": True}
 
+    @app.route("/api/<int:project_id>/security/", methods=["POST"])
+    def security_view(project_id):
+        ingest(ingest_security, project_id, (None, "security"))
         return {"success": True}
 
+    @app.route("/api/aggregates/", methods=["GET"])
+    def api_aggregates_view():
+        app.logger.info("GET /api/aggregates/")
+        return {"projects": AGGREGATES.get()}
+
+    @app.route("/api/<int:project_id>/aggregates/", methods=["GET"])
+    def api_project_aggregates_view(project_id):
+        app.logger.info(f"GET /api/{project_id}/aggregates/")
+        return AGGREGATES.get(project_id=project_id)
+
+    @app.route("/api/ratelimits/", methods=["GET", "POST"])
+    def api_rate_limits_view():
+        app.logger.info(f"{request.method} /api/ratelimits/")
+        if request.method == "POST":
+            data = request.get_json(silent=True)
+            try:
+                if not isinstance(data, dict) or "limits" not in data:
+                    raise ValueError('body must be JSON like {"limits": [...]}')
+                RATE_LIMITER.configure(parse_rate_limits(data["limits"]))
+            except ValueError as exc:
+                return {"error": str(exc)}, 400
+
+        return {
+            "limits": [limit.to_dict() for limit in RATE_LIMITER.limits],
+            "stats": RATE_LIMITER.get_stats(),
+        }
+
+    @app.route("/api/ingest/", methods=["GET"])
+    def api_ingest_view():
+        app.logger.info("GET /api/ingest/")
+        return INGEST.get_stats()
+
     return app
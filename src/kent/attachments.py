@@ -0,0 +1,204 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Store for attachments that are too big to keep in memory.
+
+Attachments bigger than a threshold are written to files in a directory and
+the event's body is a reference to the file::
+
+    {"kent_attachment": {"id": "ATTACHMENT_ID", "size": SIZE}}
+
+Files are removed, oldest first, when the store gets bigger than its limit.
+
+"""
+
+import atexit
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Key in the body of events for attachments Kent keeps somewhere other than the
+# event
+ATTACHMENT_KEY = "kent_attachment"
+
+
+def get_attachment_ref(body):
+    """Returns the reference in an attachment's body or None"""
+    if isinstance(body, dict) and isinstance(body.get(ATTACHMENT_KEY), dict):
+        return body[ATTACHMENT_KEY]
+    return None
+
+
+def is_attachment_id(value):
+    """Returns whether value could be an id Kent made
+
+    The id is part of a path, so this makes sure ids that come from event
+    bodies can't point outside the store.
+
+    """
+    return isinstance(value, str) and value.isalnum() and value.isascii()
+
+
+class AttachmentStore:
+    """Keeps attachments in files in a directory
+
+    Files are in ``PATH/PROJECT_ID/ATTACHMENT_ID``.
+
+    """
+
+    # Maximum total size in bytes of the files in the store
+    MAX_BYTES = 1024 * 1024 * 1024
+
+    def __init__(self, path=None, max_bytes=None):
+        self._lock = threading.Lock()
+        self._temp_path = None
+        # NOTE: Don't make a temporary directory until the store is
+        # configured or used
+        self._reset(path, max_bytes)
+        if path is not None:
+            self._load()
+
+    def configure(self, path=None, max_bytes=None):
+        """Changes the directory and size limit
+
+        :arg path: directory to keep the files in; files that are already
+            there are kept; None means a temporary directory that's removed
+            when Kent exits
+        :arg max_bytes: maximum total size in bytes of the files; defaults to
+            ``MAX_BYTES``
+
+        """
+        with self._lock:
+            self._reset(path, max_bytes)
+            if path is not None:
+                self._load()
+            else:
+                # NOTE: Make the directory now so worker processes
+                # forked after this share it
+                self._get_root()
+
+    def _reset(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        # (project_id, attachment_id) -> size, oldest first
+        self._files = collections.OrderedDict()
+        self.total_bytes = 0
+
+    def _load(self):
+        """Adds files that are already in the directory to the index"""
+        if not os.path.isdir(self.path):
+            return
+        found = []
+        for project_dir in os.scandir(self.path):
+            if not project_dir.is_dir() or not project_dir.name.isdigit():
+                continue
+            for entry in os.scandir(project_dir.path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    key = (int(project_dir.name), entry.name)
+                    found.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(found):
+            self._files[key] = size
+            self.total_bytes += size
+
+    def _get_root(self):
+        if self.path is not None:
+            return self.path
+        if self._temp_path is None:
+            self._temp_path = tempfile.mkdtemp(prefix="kent-attachments-")
+            atexit.register(self._remove_temp_path, os.getpid())
+        return self._temp_path
+
+    def _remove_temp_path(self, pid):
+        # NOTE: Forked workers share the directory with the process
+        # that made it, so only that process removes it
+        if os.getpid() == pid and self._temp_path is not None:
+            shutil.rmtree(self._temp_path, ignore_errors=True)
+
+    def get_path(self, project_id, attachment_id):
+        return os.path.join(self._get_root(), str(project_id), attachment_id)
+
+    def write(self, project_id, data):
+        """Writes an attachment to a file
+
+        :arg project_id: the project id
+        :arg data: bytes-like object with the attachment
+
+        :returns: the reference to put in the event body
+
+        """
+        attachment_id = uuid.uuid4().hex
+        path = self.get_path(project_id, attachment_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name so readers never see part of a file
+        tmp_path = os.path.join(os.path.dirname(path), f".{attachment_id}")
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+
+        size = len(data) if isinstance(data, bytes) else memoryview(data).nbytes
+        with self._lock:
+            self._files[(project_id, attachment_id)] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._files) > 1:
+                key, old_size = self._files.popitem(last=False)
+                self.total_bytes -= old_size
+                self._remove(*key)
+
+        return {ATTACHMENT_KEY: {"id": attachment_id, "size": size}}
+
+    def _remove(self, project_id, attachment_id):
+        try:
+            os.remove(self.get_path(project_id, attachment_id))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, project_id, attachment_id):
+        """Removes an attachment"""
+        if not is_attachment_id(attachment_id):
+            return
+        with self._lock:
+            size = self._files.pop((project_id, attachment_id), None)
+            if size is not None:
+                self.total_bytes -= size
+        self._remove(project_id, attachment_id)
+
+    def find(self, project_id, ref):
+        """Returns the path of the file for a reference or None if it's gone
+
+        :arg project_id: the project id
+        :arg ref: the reference from the event body; see ``get_attachment_ref``
+
+        """
+        attachment_id = ref.get("id")
+        if not is_attachment_id(attachment_id):
+            return None
+        path = self.get_path(project_id, attachment_id)
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    def flush(self, project_id=None):
+        """Removes attachments
+
+        :arg project_id: if specified, only removes attachments for this
+            project
+
+        """
+        with self._lock:
+            keys = [
+                key for key in self._files if project_id is None or key[0] == project_id
+            ]
+            for key in keys:
+                self.total_bytes -= self._files.pop(key)
+        for key in keys:
+            self._remove(*key)
@@ -2,13 +2,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
 import os
 import sys
 
-import kent.app
-
+import click
 from flask import cli
 
+import kent.app
+import kent.server
+from kent.storage import get_storage_class
+
 
 os.environ["FLASK_APP"] = "kent.app"
 
@@ -17,6 +21,19 @@ os.environ["FLASK_APP"] = "kent.app"
 cli.show_server_banner = lambda *args, **kwargs: True
 
 
+def set_banner(host, port):
+    # Convert any adapter to localhost
+    if host == "0.0.0.0":
+        host = "localhost"
+    elif host == "::":
+        host = "::1"
+
+    if ":" in host:
+        host = f"[{host}]"
+
+    kent.app.BANNER = f"Listening on http://{host}:{port}/"
+
+
 def maybe_show_banner():
     ctx = cli.cli.make_context(info_name=None, args=sys.argv)
     args = cli.cli.parse_args(ctx, args=sys.argv)
@@ -27,19 +44,78 @@ def maybe_show_banner():
         cmd = cli.cli.get_command(ctx, name="run")
         parser = cmd.make_parser(ctx)
         opts, _, _ = parser.parse_args(args[1:])
-        port = opts.get("port", 5000)
-        host = opts.get("host", "127.0.0.1")
+        set_banner(opts.get("host", "127.0.0.1"), opts.get("port", 5000))
+
+
+@click.command("serve")
+@click.option("--host", "-h", default="127.0.0.1", help="The interface to bind to.")
+@click.option("--port", "-p", default=5000, help="The port to bind to.")
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Number of worker processes. More than one needs KENT_STORAGE=sqlite.",
+)
+@click.option(
+    "--threads",
+    default=kent.server.AsyncServer.THREADS,
+    show_default=True,
+    help="Number of requests each worker handles at once.",
+)
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Handle connections with asyncio. Use this for many concurrent clients.",
+)
+@click.option(
+    "--backlog",
+    default=kent.server.AsyncServer.BACKLOG,
+    show_default=True,
+    help="Maximum number of connections waiting to be accepted.",
+)
+@click.option(
+    "--keep-alive",
+    default=kent.server.AsyncServer.KEEP_ALIVE,
+    show_default=True,
+    help="Seconds to keep an idle connection open.",
+)
+@click.option(
+    "--graceful-timeout",
+    default=kent.server.AsyncServer.SHUTDOWN_TIMEOUT,
+    show_default=True,
+    help="Seconds to wait for requests to finish when shutting down.",
+)
+def serve(
+    host, port, workers, threads, use_async, backlog, keep_alive, graceful_timeout
+):
+    """Run Kent with a server for sustained load."""
+    storage = os.environ.get("KENT_STORAGE", "memory")
+    if workers > 1 and not get_storage_class(storage).shared:
+        raise click.UsageError(
+            f"--workers needs storage that workers can share, but {storage!r} "
+            + "storage isn't; use KENT_STORAGE=sqlite"
+        )
 
-        # Convert any adapter to localhost
-        if host == "0.0.0.0":
-            host = "localhost"
-        elif host == "::":
-            host = "::1"
+    set_banner(host, port)
+    app = kent.app.create_app()
+    kent.server.serve(
+        app,
+        host=host,
+        port=port,
+        workers=workers,
+        use_async=use_async,
+        threads=threads,
+        keep_alive=keep_alive,
+        backlog=backlog,
+        shutdown_timeout=graceful_timeout,
+        max_body_bytes=functools.partial(kent.app.get_max_body_bytes, app),
+        # Process request bodies that are still queued before exiting
+        on_exit=kent.app.INGEST.stop,
+    )
 
-        if ":" in host:
-            host = f"[{host}]"
 
-        kent.app.BANNER = f"Listening on http://{host}:{port}/"
+cli.cli.add_command(serve)
 
 
 def main():
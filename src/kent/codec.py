@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+JSON encoding and decoding for ingestion, API responses and export.
+
+Kent uses orjson when it's installed and the stdlib json module otherwise. Set
+``KENT_JSON_BACKEND`` to ``json`` or ``orjson`` to pick one.
+
+Decoding gives the same values with either backend; orjson falls back to json
+for the things it doesn't decode the same way. Encoding gives equivalent JSON:
+orjson doesn't escape non-ASCII characters and writes float exponents without
+a ``+`` (``1e16`` instead of ``1e+16``). NaN and Infinity aren't valid JSON and
+orjson writes them as ``null``, so data that has them is encoded with json,
+which writes them as is.
+
+"""
+
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKENDS = ["json", "orjson"]
+
+# The backend in use; see set_backend
+BACKEND = "json"
+
+# orjson decodes integers that don't fit in 64 bits as floats; they have at
+# least 20 digits, so bodies with a run of 20 digits are decoded with json
+_DIGITS = bytes(ord("0") if ord("0") <= i <= ord("9") else ord("x") for i in range(256))
+_BIG_INT = b"0" * 20
+
+
+def get_available_backends():
+    """Returns the names of the backends that are installed"""
+    return [name for name in BACKENDS if name == "json" or orjson is not None]
+
+
+def set_backend(name="auto"):
+    """Sets the JSON backend
+
+    :arg name: ``auto``, ``json`` or ``orjson``; ``auto`` uses orjson if it's
+        installed
+
+    :raises ValueError: if the backend doesn't exist or isn't installed
+
+    """
+    global BACKEND
+
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in BACKENDS:
+        raise ValueError(f"unknown JSON backend: {name!r}")
+    if name not in get_available_backends():
+        raise ValueError(f"JSON backend {name!r} isn't installed")
+    BACKEND = name
+
+
+def loads(data):
+    """Decodes JSON
+
+    :arg data: str or bytes-like object
+
+    :returns: the decoded data
+
+    :raises ValueError: if it's not valid JSON
+
+    """
+    if BACKEND == "orjson":
+        raw = data.encode("utf-8", "surrogatepass") if isinstance(data, str) else data
+        if _BIG_INT not in bytes(raw).translate(_DIGITS):
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # json decodes NaN, Infinity, lone surrogates and numbers too
+                # big for a float, so let it have a go
+                pass
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def _has_non_finite(data):
+    """Returns whether data has NaN or Infinity floats"""
+    if isinstance(data, float):
+        return not math.isfinite(data)
+    if isinstance(data, dict):
+        return any(
+            _has_non_finite(key) or _has_non_finite(value)
+            for key, value in data.items()
+        )
+    if isinstance(data, (list, tuple)):
+        return any(_has_non_finite(item) for item in data)
+    return False
+
+
+def dumps(data, sort_keys=False):
+    """Encodes data as compact JSON
+
+    :arg data: the data to encode
+    :arg sort_keys: whether to sort the keys of dicts
+
+    :returns: bytes
+
+    :raises TypeError: if the data has things that can't be encoded
+
+    """
+    if BACKEND == "orjson":
+        option = (
+            orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_SUBCLASS
+        )
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            encoded = orjson.dumps(data, option=option)
+        except TypeError:
+            # orjson can't encode integers that don't fit in 64 bits or
+            # subclasses of builtin types, but json can
+            pass
+        else:
+            # orjson writes NaN and Infinity as null, so only data with a null
+            # in it needs checking
+            if b"null" not in encoded or not _has_non_finite(data):
+                return encoded
+
+    return json.dumps(data, sort_keys=sort_keys, separators=(",", ":")).encode("utf-8")
+
+
+set_backend()
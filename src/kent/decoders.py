@@ -0,0 +1,283 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Streaming decoders for request bodies with a Content-Encoding.
+
+Every decoder has the same interface:
+
+``decompress(data, max_length=0)``
+    Takes more compressed data and returns decompressed bytes. If
+    ``max_length`` isn't 0, it returns at most ``max_length`` bytes and keeps
+    the rest for the next call.
+
+``needs_input``
+    False if the decoder has more output for the data it has been given; call
+    ``decompress(b"")`` to get it.
+
+``eof``
+    True once the end of the compressed stream has been reached.
+
+``br`` and ``zstd`` need optional libraries. If they're not installed, those
+encodings aren't registered.
+
+"""
+
+import zlib
+
+
+class PayloadTooLarge(Exception):
+    """A request body is bigger than Kent allows"""
+
+
+class DecodeError(ValueError):
+    """A request body can't be decompressed"""
+
+
+class UnsupportedEncoding(Exception):
+    """There's no decoder for a Content-Encoding"""
+
+
+class ZlibDecoder:
+    """Decoder for gzip and deflate"""
+
+    def __init__(self, wbits):
+        self._decompressor = zlib.decompressobj(wbits=wbits)
+
+    def decompress(self, data, max_length=0):
+        tail = self._decompressor.unconsumed_tail
+        try:
+            return self._decompressor.decompress(tail + data, max_length)
+        except zlib.error as exc:
+            raise DecodeError(str(exc)) from exc
+
+    @property
+    def needs_input(self):
+        return not self._decompressor.unconsumed_tail
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+
+class BrotliDecoder:
+    """Decoder for br using the brotli library"""
+
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+        # NOTE: brotli before 1.1.0 can't limit how much output it
+        # returns, so output is only limited by how much input it gets
+        self._can_limit = hasattr(self._decompressor, "can_accept_more_data")
+
+    def decompress(self, data, max_length=0):
+        try:
+            if max_length and self._can_limit:
+                return self._decompressor.process(data, output_buffer_limit=max_length)
+            return self._decompressor.process(data)
+        except brotli.error as exc:
+            raise DecodeError(str(exc)) from exc
+
+    @property
+    def needs_input(self):
+        if self._can_limit:
+            return self._decompressor.can_accept_more_data()
+        return True
+
+    @property
+    def eof(self):
+        return self._decompressor.is_finished()
+
+
+class ZstdDecoder:
+    """Decoder for zstd using compression.zstd (Python 3.14+) or zstandard"""
+
+    def __init__(self):
+        if zstd is not None:
+            self._decompressor = zstd.ZstdDecompressor()
+        else:
+            # NOTE: zstandard can't limit how much output it returns, so
+            # output is only limited by how much input it gets
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data, max_length=0):
+        try:
+            if zstd is not None:
+                return self._decompressor.decompress(data, max_length or -1)
+            return self._decompressor.decompress(data)
+        except (zstd or zstandard).ZstdError as exc:
+            raise DecodeError(str(exc)) from exc
+
+    @property
+    def needs_input(self):
+        if zstd is not None:
+            return self._decompressor.needs_input
+        return True
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+
+# Map of Content-Encoding -> function that returns a new decoder
+DECODERS = {
+    "gzip": lambda: ZlibDecoder(zlib.MAX_WBITS | 16),
+    "x-gzip": lambda: ZlibDecoder(zlib.MAX_WBITS | 16),
+    "deflate": lambda: ZlibDecoder(zlib.MAX_WBITS),
+}
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+else:
+    DECODERS["br"] = BrotliDecoder
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+if zstd is not None or zstandard is not None:
+    DECODERS["zstd"] = ZstdDecoder
+
+
+def register_decoder(encoding, factory):
+    """Registers a decoder for a Content-Encoding
+
+    :arg encoding: the Content-Encoding value
+    :arg factory: function that takes no arguments and returns a new decoder
+
+    """
+    DECODERS[encoding.lower()] = factory
+
+
+def get_decoder(encoding):
+    """Returns a new decoder for a Content-Encoding
+
+    :arg encoding: the Content-Encoding value
+
+    :returns: a decoder or None if the body isn't encoded
+
+    :raises UnsupportedEncoding: if there's no decoder for the encoding
+
+    """
+    if encoding is None:
+        return None
+    encoding = encoding.strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    if encoding not in DECODERS:
+        raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+    return DECODERS[encoding]()
+
+
+def iter_decoded(chunks, decoder, max_decompressed=None):
+    """Yields decompressed pieces of a body as it's read
+
+    Each piece is decompressed only as far as the limit allows, so a zip bomb
+    doesn't get inflated all at once.
+
+    :arg chunks: iterable of compressed bytes chunks
+    :arg decoder: decoder from ``get_decoder``
+    :arg max_decompressed: maximum size in bytes of the decompressed body; None
+        means there's no limit
+
+    :raises PayloadTooLarge: if the decompressed body is over the limit
+    :raises DecodeError: if the body can't be decompressed
+
+    """
+    size = 0
+    for chunk in chunks:
+        if decoder.eof:
+            # Ignore anything after the end of the compressed stream
+            continue
+        data = chunk
+        while True:
+            max_length = 0
+            if max_decompressed:
+                max_length = max_decompressed - size + 1
+            out = decoder.decompress(data, max_length)
+            size += len(out)
+            if max_decompressed and size > max_decompressed:
+                raise PayloadTooLarge(
+                    f"decompressed body is larger than {max_decompressed} bytes"
+                )
+            if out:
+                yield out
+            if decoder.needs_input or decoder.eof:
+                break
+            data = b""
+
+    if not decoder.eof:
+        raise DecodeError("compressed body is incomplete")
+
+
+def limit_size(chunks, max_size):
+    """Yields chunks and raises PayloadTooLarge once there's more than max_size bytes
+
+    :arg chunks: iterable of bytes chunks
+    :arg max_size: maximum size in bytes; None means there's no limit
+
+    """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise PayloadTooLarge(f"body is larger than {max_size} bytes")
+        yield chunk
+
+
+def iter_body(chunks, encoding=None, max_compressed=None, max_decompressed=None):
+    """Yields pieces of a body as it's read and decompressed
+
+    :arg chunks: iterable of bytes chunks as received
+    :arg encoding: Content-Encoding of the body
+    :arg max_compressed: maximum size in bytes of the body as received; None
+        means there's no limit
+    :arg max_decompressed: maximum size in bytes of the decompressed body; None
+        means there's no limit
+
+    :raises UnsupportedEncoding: if there's no decoder for the encoding
+    :raises PayloadTooLarge: if the body is over either limit
+    :raises DecodeError: if the body can't be decompressed
+
+    """
+    decoder = get_decoder(encoding)
+    chunks = limit_size(chunks, max_compressed)
+    if decoder is None:
+        return chunks
+    return iter_decoded(chunks, decoder, max_decompressed)
+
+
+def read_body(chunks, encoding=None, max_compressed=None, max_decompressed=None):
+    """Reads and decompresses a body incrementally
+
+    Arguments are the same as for ``iter_body``.
+
+    :returns: ``(raw, body)`` tuple of the body as received and decompressed;
+        if the body isn't encoded, they're the same bytes
+
+    :raises UnsupportedEncoding: if there's no decoder for the encoding
+    :raises PayloadTooLarge: if the body is over either limit
+    :raises DecodeError: if the body can't be decompressed
+
+    """
+    decoder = get_decoder(encoding)
+    chunks = limit_size(chunks, max_compressed)
+    if decoder is None:
+        raw = b"".join(chunks)
+        return raw, raw
+
+    received = []
+
+    def received_chunks():
+        for chunk in chunks:
+            received.append(chunk)
+            yield chunk
+
+    body = b"".join(iter_decoded(received_chunks(), decoder, max_decompressed))
+    return b"".join(received), body
@@ -0,0 +1,443 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import binascii
+import datetime
+import logging
+import time
+
+from kent import codec
+from kent.attachments import ATTACHMENT_KEY
+from kent.decoders import get_decoder, iter_decoded
+from kent.utils import LRUCache
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Body for events Kent couldn't decode
+DECODE_ERROR_BODY = {"error": "Kent could not decode body; see logs"}
+
+# Recently decoded bodies for events that keep their bodies as raw bytes;
+# maps Event -> body
+BODY_CACHE = LRUCache(maxsize=100)
+
+# Recently serialized events; events don't change once they're stored, so this
+# maps (event_id, seq) -> JSON-encoded to_dict() bytes
+JSON_CACHE = LRUCache(maxsize=100)
+
+_MISSING = object()
+
+
+def decode_raw_body(event_id, raw_body):
+    """Decodes a JSON-encoded body
+
+    :arg event_id: the event id for logging
+    :arg raw_body: the JSON-encoded body
+
+    :returns: the decoded body or ``DECODE_ERROR_BODY`` if it's not valid JSON
+
+    """
+    try:
+        return codec.loads(raw_body)
+    except Exception:
+        LOGGER.exception("%s: exception when JSON-decoding body.", event_id)
+        LOGGER.error("%s: %r", event_id, bytes(raw_body[:1000]))
+        return DECODE_ERROR_BODY
+
+
+def deep_get(structure, path, default=None):
+    node = structure
+    for part in path.split("."):
+        if part.startswith("["):
+            index = int(part[1:-1])
+            node = node[index]
+        elif part in node:
+            node = node[part]
+        else:
+            return default
+    return node
+
+
+def compile_path(path):
+    """Compiles a ``deep_get`` path into a tuple of keys and indexes
+
+    :arg path: dotted path like ``exception.values.[0].type``
+
+    :returns: tuple of keys (str) and list indexes (int)
+
+    :raises ValueError: if an index isn't an integer
+
+    """
+    parts = []
+    for part in path.split("."):
+        if part.startswith("[") and part.endswith("]"):
+            try:
+                parts.append(int(part[1:-1]))
+            except ValueError:
+                raise ValueError(f"bad index {part!r} in path {path!r}") from None
+        else:
+            parts.append(part)
+    return tuple(parts)
+
+
+def get_path(structure, parts, default=None):
+    """Returns the value at a compiled path or default if it's not there"""
+    node = structure
+    for part in parts:
+        if isinstance(part, int):
+            if not isinstance(node, list) or not -len(node) <= part < len(node):
+                return default
+        elif not isinstance(node, dict) or part not in node:
+            return default
+        node = node[part]
+    return node
+
+
+def get_summary(body):
+    """Returns a one-line summary of an event body"""
+    if not body:
+        return "no summary"
+
+    if isinstance(body, dict):
+        # Kent body parsing errors
+        kent_error = body.get("error")
+        if kent_error:
+            return kent_error
+
+        # Sentry exceptions events
+        exceptions = deep_get(body, "exception.values", default=[])
+        if exceptions:
+            first = exceptions[0]
+            return f"{first['type']}: {first['value']}"
+
+        # Sentry message
+        msg = deep_get(body, "message", default=None)
+        if msg:
+            return msg
+
+        # CSP security report (older browsers--single report per payload)
+        if "csp-report" in body:
+            directive = deep_get(
+                body, "csp-report.violated-directive", default="unknown"
+            )
+            summary = f"csp-report: {directive}"
+            return summary
+
+        if body.get("type") == "csp-violation":
+            directive = deep_get(body, "body.effectiveDirective", default="unknown")
+            summary = f"csp-report: {directive}"
+            return summary
+
+    return "no summary"
+
+
+def get_exception_types(body):
+    """Returns a tuple of the exception types in an event body"""
+    if not isinstance(body, dict):
+        return ()
+    exceptions = deep_get(body, "exception.values", default=None)
+    if not isinstance(exceptions, list):
+        return ()
+    return tuple(
+        str(exc["type"])
+        for exc in exceptions
+        if isinstance(exc, dict) and exc.get("type") is not None
+    )
+
+
+def get_tags(body):
+    """Returns the tags in an event body as a dict of strings"""
+    tags = body.get("tags") if isinstance(body, dict) else None
+    if isinstance(tags, dict):
+        tags = tags.items()
+    elif isinstance(tags, list):
+        # NOTE: some sdks send tags as a list of [key, value] pairs
+        tags = [tag for tag in tags if isinstance(tag, (list, tuple)) and len(tag) == 2]
+    else:
+        return {}
+    return {str(key): str(value) for key, value in tags}
+
+
+def get_terms(event):
+    """Returns the ``(field, value)`` pairs that event search can match
+
+    Storage backends index events by these.
+
+    """
+    terms = [("item_type", event.item_type)]
+    terms.extend(("exception_type", value) for value in event.exception_types)
+    for field in ("sdk_name", "sdk_version", "release", "environment"):
+        value = getattr(event, field)
+        if value is not None:
+            terms.append((field, str(value)))
+    terms.extend((f"tag:{key}", value) for key, value in event.tags.items())
+    return terms
+
+
+def get_timestamp(body):
+    """Returns the event timestamp from the body or now if there isn't one"""
+    # NOTE(willkg): timestamp is a string
+    if isinstance(body, dict) and body.get("timestamp"):
+        return body["timestamp"]
+    return str(datetime.datetime.now())
+
+
+class Event:
+    __slots__ = (
+        "project_id",
+        "event_id",
+        "envelope_header",
+        "header",
+        "_body",
+        "_raw_body",
+        "_encoding",
+        "size",
+        "seq",
+        "item_type",
+        "summary",
+        "timestamp",
+        "sdk_name",
+        "sdk_version",
+        "release",
+        "environment",
+        "exception_types",
+        "tags",
+        "received",
+    )
+
+    def __init__(
+        self,
+        project_id,
+        event_id,
+        envelope_header=None,
+        header=None,
+        body=None,
+        size=0,
+        seq=0,
+        raw_body=None,
+        encoding=None,
+        summary=None,
+        timestamp=None,
+        sdk_name=None,
+        sdk_version=None,
+        release=None,
+        environment=None,
+        exception_types=(),
+        tags=None,
+        received=None,
+    ):
+        self.project_id = project_id
+        self.event_id = event_id
+
+        # envelope_header when the envelope API is used
+        self.envelope_header = envelope_header
+        # item header
+        self.header = header
+        # item
+        # attachments will be stored as bytes, non-attachments as python
+        # datastructures; if there's a raw_body, body is only used to extract
+        # fields and isn't kept
+        self._body = body if raw_body is None else None
+        # non-attachments can be stored as raw JSON-encoded bytes instead which
+        # get decoded when they're needed; these can be compressed with
+        # encoding (a Content-Encoding in kent.decoders.DECODERS)
+        self._raw_body = raw_body
+        self._encoding = encoding
+        # size in bytes of the body as it was received
+        self.size = size
+        # order the event was added in across all projects
+        self.seq = seq
+
+        # Item type from the envelope item header
+        self.item_type = (header or {}).get("type", "event")
+
+        # Fields that listing and logging events need are extracted from the
+        # body once so they don't need the body. Storage backends that keep
+        # these fields pass them in. Ingestion passes in the body it already
+        # decoded so the raw body doesn't get decompressed and decoded again.
+        if summary is None:
+            if body is None:
+                body = self.body
+            summary = get_summary(body)
+            timestamp = get_timestamp(body)
+            exception_types = get_exception_types(body)
+            tags = get_tags(body)
+            if isinstance(body, dict):
+                sdk_name = deep_get(body, "sdk.name")
+                sdk_version = deep_get(body, "sdk.version")
+                release = body.get("release")
+                environment = body.get("environment")
+        self.summary = summary
+        self.timestamp = timestamp
+        self.sdk_name = sdk_name
+        self.sdk_version = sdk_version
+        self.release = release
+        self.environment = environment
+        self.exception_types = tuple(exception_types)
+        self.tags = tags or {}
+        # When Kent received the event in seconds since the epoch
+        self.received = time.time() if received is None else received
+
+    def __repr__(self):
+        return (
+            f"<Event project_id={self.project_id!r} event_id={self.event_id!r} "
+            f"seq={self.seq!r}>"
+        )
+
+    def get_raw_body(self):
+        """Returns the JSON-encoded body or None if it's not stored that way"""
+        if self._raw_body is None:
+            return None
+        decoder = get_decoder(self._encoding)
+        if decoder is None:
+            return self._raw_body
+        return b"".join(iter_decoded([self._raw_body], decoder))
+
+    def _decode_body(self):
+        body = BODY_CACHE.get(self, _MISSING)
+        if body is _MISSING:
+            body = decode_raw_body(self.event_id, self.get_raw_body())
+            BODY_CACHE.put(self, body)
+        return body
+
+    @property
+    def body(self):
+        if self._raw_body is not None:
+            return self._decode_body()
+        return self._body
+
+    def get_fields(self, paths):
+        """Returns the values at paths in the body
+
+        :arg paths: list of ``(path, compiled_path)`` pairs; see
+            ``compile_path``
+
+        :returns: dict of path -> value; the value is None if the path isn't
+            in the body
+
+        """
+        body = self.body
+        return {path: get_path(body, parts) for path, parts in paths}
+
+    def to_dict(self, paths=None):
+        """Returns the event as a dict
+
+        :arg paths: if specified, returns ``fields`` with the values at these
+            paths in the body instead of the payload; see ``get_fields``
+
+        """
+        if paths is not None:
+            return {
+                "project_id": self.project_id,
+                "event_id": self.event_id,
+                "fields": self.get_fields(paths),
+            }
+        body = self.body
+        if isinstance(body, bytes):
+            # Attachments can't be JSON-encoded; get them from
+            # /api/event/EVENT_ID/attachment
+            body = {ATTACHMENT_KEY: {"size": len(body)}}
+        return {
+            "project_id": self.project_id,
+            "event_id": self.event_id,
+            "payload": {
+                "envelope_header": self.envelope_header,
+                "header": self.header,
+                "body": body,
+            },
+        }
+
+    def to_export(self):
+        """Returns the event as a dict for exporting
+
+        This is ``to_dict()`` with the fields Kent needs to import it again.
+        Attachment bodies are base64-encoded in ``body_base64``.
+
+        """
+        data = self.to_dict()
+        body = self.body
+        if isinstance(body, bytes):
+            del data["payload"]["body"]
+            data["payload"]["body_base64"] = base64.b64encode(body).decode("ascii")
+        data["size"] = self.size
+        data["received"] = self.received
+        return data
+
+    @classmethod
+    def from_export(cls, data):
+        """Returns an Event from a dict created by ``to_export()``
+
+        :raises ValueError: if the data isn't an exported event
+
+        """
+        if not isinstance(data, dict) or not isinstance(data.get("payload"), dict):
+            raise ValueError("not an exported event: needs a payload object")
+        payload = data["payload"]
+
+        # These end up as keys in storage, so make sure they're the right
+        # types rather than failing part way through an import
+        project_id = data.get("project_id")
+        if isinstance(project_id, bool) or not isinstance(project_id, int):
+            raise ValueError(f"project_id must be an integer: {project_id!r}")
+        event_id = data.get("event_id")
+        if not isinstance(event_id, str) or not event_id:
+            raise ValueError(f"event_id must be a string: {event_id!r}")
+        for key in ("envelope_header", "header"):
+            if not isinstance(payload.get(key), (dict, type(None))):
+                raise ValueError(f"{key} must be an object: {payload[key]!r}")
+        size = data.get("size")
+        if size is not None and (isinstance(size, bool) or not isinstance(size, int)):
+            raise ValueError(f"size must be an integer: {size!r}")
+        received = data.get("received")
+        if received is not None and (
+            isinstance(received, bool) or not isinstance(received, (int, float))
+        ):
+            raise ValueError(f"received must be a number: {received!r}")
+
+        try:
+            if "body_base64" in payload:
+                body = base64.b64decode(payload["body_base64"], validate=True)
+            else:
+                body = payload.get("body")
+        except (TypeError, binascii.Error) as exc:
+            raise ValueError(f"not an exported event: {exc!r}") from exc
+        return cls(
+            project_id=project_id,
+            event_id=event_id,
+            envelope_header=payload.get("envelope_header"),
+            header=payload.get("header"),
+            body=body,
+            size=estimate_size(body) if size is None else size,
+            received=received,
+        )
+
+    def to_json(self):
+        """Returns ``to_dict()`` encoded as JSON
+
+        The encoding is cached so events that are retrieved over and over only
+        get serialized once.
+
+        """
+        key = (self.event_id, self.seq)
+        data = JSON_CACHE.get(key)
+        if data is None:
+            data = encode_json(self.to_dict())
+            JSON_CACHE.put(key, data)
+        return data
+
+
+def encode_json(data):
+    """Returns data encoded as JSON like Flask's JSON responses"""
+    return codec.dumps(data, sort_keys=True) + b"\n"
+
+
+def estimate_size(body):
+    """Returns the size in bytes of a body Kent didn't measure on the wire"""
+    if body is None:
+        return 0
+    if isinstance(body, bytes):
+        return len(body)
+    return len(codec.dumps(body))
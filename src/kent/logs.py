@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Logging handlers and formatters.
+
+Records are formatted and written by a background thread so logging doesn't
+add to the time it takes to handle a request.
+
+"""
+
+import logging
+import os
+import queue
+import sys
+import threading
+
+from kent import codec
+
+
+class BackgroundHandler(logging.Handler):
+    """Handler that formats and writes records in a background thread
+
+    Records are put on a bounded queue. The background thread takes records
+    off the queue in batches and writes each batch to the stream with one
+    write. When the queue is full, records are dropped and counted in
+    ``dropped``.
+
+    """
+
+    # Maximum number of records waiting to be written
+    QUEUE_SIZE = 10_000
+
+    # Maximum number of records written at a time
+    BATCH_SIZE = 500
+
+    def __init__(self, stream=None, maxsize=QUEUE_SIZE):
+        """
+        :arg stream: the stream to write to; defaults to ``sys.stderr``
+        :arg maxsize: maximum number of records waiting to be written
+
+        """
+        super().__init__()
+        self.stream = stream if stream is not None else sys.stderr
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._start()
+
+        # NOTE: Threads don't survive a fork, so workers forked by
+        # kent-server serve start their own. Forking while the thread is
+        # writing would leave the stream locked in the child, so forks wait
+        # for writes to finish.
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(
+                before=self._before_fork,
+                after_in_parent=self._after_fork_in_parent,
+                after_in_child=self._after_fork_in_child,
+            )
+
+    def _before_fork(self):
+        self._write_lock.acquire()
+
+    def _after_fork_in_parent(self):
+        self._write_lock.release()
+
+    def _after_fork_in_child(self):
+        self._write_lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        if self._closed:
+            return
+        self.queue = queue.Queue(maxsize=self.maxsize)
+        self._thread = threading.Thread(
+            target=self._run, args=(self.queue,), name="kent-logging", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, records_queue):
+        while True:
+            records = [records_queue.get()]
+            while len(records) < self.BATCH_SIZE:
+                try:
+                    records.append(records_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in records:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.format(record) + "\n")
+                except Exception:
+                    self.handleError(record)
+
+            if lines:
+                with self._write_lock:
+                    try:
+                        self.stream.write("".join(lines))
+                        self.stream.flush()
+                    except Exception:
+                        self.handleError(records[-1])
+
+            for _ in records:
+                records_queue.task_done()
+            if None in records:
+                return
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Waits until the records in the queue are written"""
+        if self._thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Writes the records in the queue and stops the background thread"""
+        if not self._closed:
+            self._closed = True
+            if self._thread.is_alive():
+                self.queue.put(None)
+                self._thread.join()
+        super().close()
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as JSON objects, one per line
+
+    Fields in the record's ``event`` attribute, which can be set with
+    ``extra={"event": {...}}``, are added to the object.
+
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            data.update(event)
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return codec.dumps(data).decode("utf-8")
@@ -0,0 +1,285 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Token-bucket rate limiting for ingestion like Sentry's.
+
+A limit has a rate in payloads per second and a burst size. Each project gets
+its own bucket for each limit. A limit can apply to one project or all of
+them and to all payloads or to some data categories like ``transaction``.
+
+When a bucket is empty, Kent responds with a 429 and headers that tell the SDK
+how long to back off. See
+https://develop.sentry.dev/sdk/expected-features/rate-limiting/
+
+"""
+
+import math
+import threading
+import time
+
+
+# Sentry data categories for envelope item types; other item types are their
+# own category
+ITEM_TYPE_CATEGORIES = {
+    "event": "error",
+    "transaction": "transaction",
+    "attachment": "attachment",
+    "session": "session",
+    "sessions": "session",
+    "client_report": "internal",
+    "profile": "profile",
+    "profile_chunk": "profile_chunk",
+    "replay_event": "replay",
+    "replay_recording": "replay",
+    "replay_video": "replay",
+    "check_in": "monitor",
+    "span": "span",
+    "log": "log_item",
+    "statsd": "metric_bucket",
+}
+
+
+def get_category(item_type):
+    """Returns the data category for an envelope item type"""
+    return ITEM_TYPE_CATEGORIES.get(item_type, item_type)
+
+
+class RateLimited(Exception):
+    """Raised when a payload is over a rate limit
+
+    :arg rejections: list of ``(limit, retry_after)`` for the limits the
+        payload is over
+
+    """
+
+    def __init__(self, rejections):
+        self.rejections = rejections
+        super().__init__(
+            "rate limited; retry after " + f"{get_retry_after(rejections)} seconds"
+        )
+
+
+class RateLimit:
+    """A rate limit
+
+    :arg rate: payloads per second
+    :arg burst: number of payloads that can be sent at once; defaults to the
+        rate rounded up
+    :arg project_id: project id the limit applies to; None means each project
+        gets its own bucket
+    :arg categories: data categories the limit applies to; empty means it
+        applies to whole payloads
+
+    :raises ValueError: if the arguments aren't valid
+
+    """
+
+    def __init__(self, rate, burst=None, project_id=None, categories=()):
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError(f"rate must be a positive number: {rate!r}")
+        if burst is None:
+            burst = max(1, math.ceil(rate))
+        if isinstance(burst, bool) or not isinstance(burst, int) or burst < 1:
+            raise ValueError(f"burst must be a positive integer: {burst!r}")
+        if project_id is not None and (
+            isinstance(project_id, bool) or not isinstance(project_id, int)
+        ):
+            raise ValueError(f"project_id must be an integer: {project_id!r}")
+        if not isinstance(categories, (list, tuple)) or not all(
+            isinstance(category, str) and category for category in categories
+        ):
+            raise ValueError(f"categories must be a list of strings: {categories!r}")
+
+        self.rate = rate
+        self.burst = burst
+        self.project_id = project_id
+        self.categories = tuple(categories)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns a RateLimit from a dict like to_dict returns
+
+        :raises ValueError: if the dict isn't valid
+
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"rate limit must be an object: {data!r}")
+        unknown = set(data) - {"rate", "burst", "project_id", "categories"}
+        if unknown:
+            raise ValueError(f"unknown rate limit fields: {sorted(unknown)}")
+        if "rate" not in data:
+            raise ValueError("rate limit needs a rate")
+        return cls(**data)
+
+    def to_dict(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "project_id": self.project_id,
+            "categories": list(self.categories),
+        }
+
+    def applies_to(self, project_id, category):
+        """Returns whether the limit applies to a payload or an item in it
+
+        :arg project_id: the project id
+        :arg category: None for the payload or the data category of an item
+
+        """
+        if self.project_id is not None and self.project_id != project_id:
+            return False
+        if category is None:
+            return not self.categories
+        return category in self.categories
+
+    def get_header(self, retry_after):
+        """Returns the X-Sentry-Rate-Limits value for this limit
+
+        The format is ``RETRY_AFTER:CATEGORIES:SCOPE``; no categories means
+        all categories.
+
+        """
+        return f"{retry_after}:{';'.join(self.categories)}:project"
+
+
+class TokenBucket:
+    """Token bucket that fills at ``rate`` tokens per second up to ``burst``"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def fill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait(self, now):
+        """Returns seconds until there's a token; 0 if there's one now"""
+        self.fill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def get_retry_after(rejections):
+    """Returns whole seconds to wait for all the limits in rejections"""
+    return max(max(1, math.ceil(wait)) for _, wait in rejections)
+
+
+class RateLimiter:
+    """Rate limits for all projects
+
+    The limits can be changed at any time. Changing them refills the buckets.
+
+    """
+
+    def __init__(self, limits=(), clock=time.monotonic):
+        """
+        :arg limits: list of RateLimit instances
+        :arg clock: function returning seconds; used by tests
+
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.configure(limits)
+
+    def configure(self, limits):
+        """Replaces the limits and resets the counters
+
+        :arg limits: list of RateLimit instances
+
+        """
+        with self._lock:
+            self.limits = list(limits)
+            # (limit index, project id) -> TokenBucket
+            self._buckets = {}
+            # project id -> {"accepted": count, "rejected": count}
+            self._projects = {}
+            # category -> {"accepted": count, "rejected": count}
+            self._categories = {}
+
+    def _get_bucket(self, index, project_id, now):
+        key = (index, project_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            limit = self.limits[index]
+            bucket = TokenBucket(limit.rate, limit.burst, now)
+            self._buckets[key] = bucket
+        return bucket
+
+    def take(self, project_id, categories=(None,)):
+        """Takes a token for a payload or an item in a payload
+
+        The payload is accepted if every limit that applies has a token.
+        Otherwise nothing is taken.
+
+        :arg project_id: the project id
+        :arg categories: categories to take a token for; None is the payload
+            itself and other values are data categories of items
+
+        :raises RateLimited: if the payload is over any limits
+
+        """
+        with self._lock:
+            now = self._clock()
+            buckets = []
+            rejections = []
+            for index, limit in enumerate(self.limits):
+                if any(limit.applies_to(project_id, cat) for cat in categories):
+                    bucket = self._get_bucket(index, project_id, now)
+                    wait = bucket.get_wait(now)
+                    if wait:
+                        rejections.append((limit, wait))
+                    buckets.append(bucket)
+
+            # Payloads are counted by project and items by category
+            outcome = "rejected" if rejections else "accepted"
+            for category in categories:
+                if category is None:
+                    counts = self._projects.setdefault(
+                        project_id, {"accepted": 0, "rejected": 0}
+                    )
+                else:
+                    counts = self._categories.setdefault(
+                        category, {"accepted": 0, "rejected": 0}
+                    )
+                counts[outcome] += 1
+
+            if rejections:
+                raise RateLimited(rejections)
+            for bucket in buckets:
+                bucket.tokens -= 1
+
+    def get_stats(self):
+        with self._lock:
+            projects = {
+                str(project_id): dict(counts)
+                for project_id, counts in self._projects.items()
+            }
+            return {
+                "accepted": sum(counts["accepted"] for counts in projects.values()),
+                "rejected": sum(counts["rejected"] for counts in projects.values()),
+                "projects": projects,
+                "categories": {
+                    category: dict(counts)
+                    for category, counts in self._categories.items()
+                },
+            }
+
+
+def get_rate_limit_headers(rejections):
+    """Returns the 429 headers for rejections
+
+    :arg rejections: list of ``(limit, retry_after)``
+
+    """
+    return {
+        "Retry-After": str(get_retry_after(rejections)),
+        "X-Sentry-Rate-Limits": ", ".join(
+            limit.get_header(max(1, math.ceil(wait))) for limit, wait in rejections
+        ),
+    }
@@ -0,0 +1,837 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Servers for running Kent under sustained load.
+
+``AsyncServer`` handles connections with asyncio, so thousands of idle or slow
+keep-alive connections are cheap. Once a request has been read completely, the
+WSGI app handles it in a thread pool.
+
+``ThreadedServer`` handles each connection with its own thread.
+
+Both servers limit how many requests the app handles at once. Requests that
+wait a long time, like long polls and event streams, can call the function in
+``environ["kent.detach"]`` so they stop counting against that limit and don't
+hold up other requests.
+
+``serve`` runs either of them in one process or in several pre-forked worker
+processes that share the listening socket.
+
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import unquote_to_bytes
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Most bytes allowed for the request line and headers
+MAX_HEADER_BYTES = 64 * 1024
+
+# Bytes to read from a connection at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+# Request bodies bigger than this are kept in a temporary file instead of in
+# memory until the app reads them
+SPOOL_BYTES = 1024 * 1024
+
+# WSGI environ key for the function a request calls to stop counting against
+# the requests the server handles at once
+DETACH_KEY = "kent.detach"
+
+STATUS_LINES = {
+    400: b"400 Bad Request",
+    413: b"413 Payload Too Large",
+    431: b"431 Request Header Fields Too Large",
+    500: b"500 Internal Server Error",
+}
+
+
+class BadRequest(Exception):
+    """The client sent a request that isn't valid HTTP/1.1"""
+
+
+class BodyTooLarge(Exception):
+    """The client sent a request body that's bigger than the server allows"""
+
+
+def parse_head(head):
+    """Parses the request line and headers
+
+    :arg head: bytes up to and including the blank line after the headers
+
+    :returns: ``(method, target, version, headers)`` where headers is a list of
+        ``(name, value)`` str pairs
+
+    :raises BadRequest: if it's not valid
+
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise BadRequest(f"bad request line: {lines[0]!r}") from None
+    if not version.startswith("HTTP/1."):
+        raise BadRequest(f"unsupported version: {version!r}")
+
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep or not name or name != name.strip():
+            raise BadRequest(f"bad header: {line!r}")
+        headers.append((name, value.strip()))
+    return method, target, version, headers
+
+
+async def read_exactly(reader, size, body, max_size=None):
+    """Reads size bytes into body a piece at a time
+
+    :raises BodyTooLarge: if body would end up bigger than max_size
+
+    """
+    if max_size is not None and body.tell() + size > max_size:
+        raise BodyTooLarge(f"body is bigger than {max_size} bytes")
+    while size > 0:
+        data = await reader.read(min(size, READ_CHUNK_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", size)
+        body.write(data)
+        size -= len(data)
+
+
+async def read_chunked(reader, body, max_size=None):
+    """Reads a body with chunked transfer encoding into body
+
+    :raises BodyTooLarge: as soon as the chunks add up to more than max_size
+
+    """
+    while True:
+        line = await reader.readuntil(b"\r\n")
+        try:
+            size = int(line.split(b";", 1)[0], 16)
+        except ValueError:
+            raise BadRequest(f"bad chunk size: {line!r}") from None
+        if size == 0:
+            break
+        await read_exactly(reader, size, body, max_size)
+        if await reader.readexactly(2) != b"\r\n":
+            raise BadRequest("bad chunk ending")
+
+    # Skip trailers
+    while await reader.readuntil(b"\r\n") != b"\r\n":
+        pass
+
+
+class Slot:
+    """A request's place in the requests the app handles at once
+
+    :arg release: function that gives the place back
+    :arg detached: semaphore for the requests that can be detached at once
+
+    """
+
+    def __init__(self, release, detached):
+        self._release = release
+        self._detached = detached
+        self._lock = threading.Lock()
+        self._held = True
+        self._is_detached = False
+
+    def detach(self):
+        """Gives the place back while the request keeps running
+
+        :returns: True if the request was detached and False if it wasn't
+            because too many requests are detached already
+
+        """
+        with self._lock:
+            if not self._held or not self._detached.acquire(blocking=False):
+                return False
+            self._held = False
+            self._is_detached = True
+        self._release()
+        return True
+
+    def close(self):
+        """Gives the place back when the request is done"""
+        with self._lock:
+            held, self._held = self._held, False
+            detached, self._is_detached = self._is_detached, False
+        if held:
+            self._release()
+        if detached:
+            self._detached.release()
+
+
+class Connection:
+    def __init__(self, writer):
+        self.writer = writer
+        # True while the connection is waiting for the next request
+        self.idle = True
+
+
+class AsyncServer:
+    """Serves a WSGI app with asyncio
+
+    :arg app: the WSGI app
+    :arg host: host to listen on
+    :arg port: port to listen on; 0 picks a free port
+    :arg threads: number of requests the WSGI app handles at once
+    :arg keep_alive: seconds to keep an idle connection open
+    :arg backlog: listen backlog
+    :arg shutdown_timeout: seconds to wait for requests to finish when
+        shutting down
+    :arg max_detached: number of detached requests allowed at once; each
+        uses a thread while it's open
+    :arg max_body_bytes: if specified, a function called with the request
+        method and path that returns the most bytes to read for the request
+        body or None for no limit; bigger bodies get a 413
+
+    """
+
+    THREADS = 32
+    KEEP_ALIVE = 5
+    BACKLOG = 2048
+    SHUTDOWN_TIMEOUT = 10
+    MAX_DETACHED = 256
+
+    def __init__(
+        self,
+        app,
+        host="127.0.0.1",
+        port=5000,
+        threads=None,
+        keep_alive=None,
+        backlog=None,
+        shutdown_timeout=None,
+        max_detached=None,
+        max_body_bytes=None,
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.threads = threads or self.THREADS
+        self.keep_alive = self.KEEP_ALIVE if keep_alive is None else keep_alive
+        self.backlog = backlog or self.BACKLOG
+        self.shutdown_timeout = (
+            self.SHUTDOWN_TIMEOUT if shutdown_timeout is None else shutdown_timeout
+        )
+        self.max_detached = max_detached or self.MAX_DETACHED
+        self.max_body_bytes = max_body_bytes
+
+        self._executor = None
+        self._slots = None
+        self._detached = threading.BoundedSemaphore(self.max_detached)
+        self._server = None
+        self._closing = False
+        self._stopped = None
+        # Map of connection task -> Connection
+        self._connections = {}
+
+    async def start(self, sock=None):
+        """Starts listening
+
+        :arg sock: if specified, a listening socket to use instead of host and
+            port
+
+        """
+        # Detached requests keep using a thread, so there are enough for them
+        # on top of the requests being handled
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.threads + self.max_detached, thread_name_prefix="kent"
+        )
+        self._slots = asyncio.Semaphore(self.threads)
+        self._stopped = asyncio.Event()
+        if sock is not None:
+            self._server = await asyncio.start_server(
+                self._handle, sock=sock, limit=MAX_HEADER_BYTES
+            )
+        else:
+            self._server = await asyncio.start_server(
+                self._handle,
+                self.host,
+                self.port,
+                backlog=self.backlog,
+                limit=MAX_HEADER_BYTES,
+            )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def shutdown(self):
+        """Starts a graceful shutdown; call from the event loop"""
+        self._stopped.set()
+
+    async def stop(self):
+        """Stops accepting connections and waits for requests to finish"""
+        self._closing = True
+        self._server.close()
+
+        # Idle connections are waiting for a request, so close them now
+        for task, conn in list(self._connections.items()):
+            if conn.idle:
+                task.cancel()
+
+        tasks = list(self._connections)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                LOGGER.warning("cancelled %s requests at shutdown", len(pending))
+                await asyncio.wait(pending)
+
+        await self._server.wait_closed()
+        self._executor.shutdown(wait=False)
+
+    async def serve(self, sock=None):
+        """Serves until SIGINT or SIGTERM and then shuts down gracefully"""
+        await self.start(sock=sock)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.shutdown)
+        try:
+            await self._stopped.wait()
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            await self.stop()
+
+    def run(self, sock=None):
+        asyncio.run(self.serve(sock=sock))
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        conn = self._connections[task] = Connection(writer)
+        try:
+            while not self._closing:
+                conn.idle = True
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), timeout=self.keep_alive
+                    )
+                except (asyncio.LimitOverrunError, ValueError):
+                    await self._write_error(writer, 431)
+                    break
+                except (
+                    asyncio.TimeoutError,
+                    asyncio.IncompleteReadError,
+                    ConnectionError,
+                ):
+                    break
+
+                conn.idle = False
+                try:
+                    keep_alive = await self._handle_request(reader, writer, head)
+                except BadRequest as exc:
+                    LOGGER.debug("bad request: %s", exc)
+                    await self._write_error(writer, 400)
+                    break
+                except BodyTooLarge as exc:
+                    # The rest of the body is still coming, so the connection
+                    # can't be used for another request
+                    LOGGER.debug("body too large: %s", exc)
+                    await self._write_error(writer, 413)
+                    break
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            LOGGER.exception("exception handling connection")
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _write_error(self, writer, status):
+        body = STATUS_LINES[status]
+        writer.write(
+            b"HTTP/1.1 %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s"
+            % (STATUS_LINES[status], len(body), body)
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _handle_request(self, reader, writer, head):
+        """Handles one request
+
+        :returns: whether to keep the connection open
+
+        """
+        method, target, version, headers = parse_head(head)
+        header_map = {name.lower(): value for name, value in headers}
+
+        chunked = "chunked" in header_map.get("transfer-encoding", "").lower()
+        length = 0
+        if not chunked:
+            try:
+                length = int(header_map.get("content-length", 0))
+            except ValueError:
+                raise BadRequest("bad content-length") from None
+            if length < 0:
+                raise BadRequest("bad content-length")
+        max_size = None
+        if self.max_body_bytes is not None:
+            path = unquote_to_bytes(target.partition("?")[0]).decode("latin-1")
+            max_size = self.max_body_bytes(method, path)
+        # Refuse the body before the client sends it
+        if max_size is not None and length > max_size:
+            raise BodyTooLarge(f"content-length is {length}")
+
+        if header_map.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        try:
+            if chunked:
+                await read_chunked(reader, body, max_size)
+            else:
+                await read_exactly(reader, length, body)
+            size = body.tell()
+            body.seek(0)
+        except BaseException:
+            body.close()
+            raise
+
+        connection = header_map.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            keep_alive = connection == "keep-alive"
+        else:
+            keep_alive = connection != "close"
+        keep_alive = keep_alive and not self._closing
+
+        with body:
+            environ = self._make_environ(
+                method, target, version, headers, body, size, writer
+            )
+            return await self._run_app(environ, writer, version, keep_alive, method)
+
+    def _make_environ(self, method, target, version, headers, body, size, writer):
+        path, _, query = target.partition("?")
+        server_name, server_port = self._server.sockets[0].getsockname()[:2]
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(server_name),
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": str(peer[0]),
+            "REMOTE_PORT": str(peer[1]),
+            "CONTENT_LENGTH": str(size),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers:
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_LENGTH", "TRANSFER_ENCODING"):
+                # The body has already been read and de-chunked
+                continue
+            if key != "CONTENT_TYPE":
+                key = f"HTTP_{key}"
+            if key in environ:
+                environ[key] += f",{value}"
+            else:
+                environ[key] = value
+        return environ
+
+    def _call_app(self, environ):
+        """Calls the WSGI app and gets the first chunk of the response
+
+        This runs in the thread pool.
+
+        :returns: ``(status, headers, first_chunk, iterator, result)``
+
+        """
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        result = None
+        try:
+            result = self.app(environ, start_response)
+            iterator = iter(result)
+            first = next(iterator, b"")
+        except Exception:
+            LOGGER.exception("exception in WSGI app")
+            if result is not None:
+                self._close_result(result)
+            return None
+        return response[0], response[1], first, iterator, result
+
+    def _next_chunk(self, iterator):
+        return next(iterator, None)
+
+    def _close_result(self, result):
+        close = getattr(result, "close", None)
+        if close is not None:
+            close()
+
+    def _finish(self, result, slot):
+        try:
+            self._close_result(result)
+        finally:
+            slot.close()
+
+    def _release_slot(self, loop):
+        try:
+            loop.call_soon_threadsafe(self._slots.release)
+        except RuntimeError:
+            # The event loop closed while a detached request was running
+            pass
+
+    async def _run_app(self, environ, writer, version, keep_alive, method):
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        slot = Slot(lambda: self._release_slot(loop), self._detached)
+        environ[DETACH_KEY] = slot.detach
+        try:
+            called = await loop.run_in_executor(self._executor, self._call_app, environ)
+        except BaseException:
+            slot.close()
+            raise
+        if called is None:
+            slot.close()
+            await self._write_error(writer, 500)
+            return False
+        status, headers, first, iterator, result = called
+
+        pending = None
+        try:
+            has_length = any(name.lower() == "content-length" for name, _ in headers)
+            # Without a length, HTTP/1.1 responses are chunked and HTTP/1.0
+            # responses end when the connection closes
+            chunked = not has_length and version == "HTTP/1.1" and method != "HEAD"
+            if not has_length and not chunked:
+                keep_alive = False
+
+            lines = [f"{version} {status}"]
+            lines.extend(
+                f"{name}: {value}"
+                for name, value in headers
+                if name.lower() not in ("connection", "transfer-encoding")
+            )
+            lines.append(f"Date: {formatdate(usegmt=True)}")
+            if chunked:
+                lines.append("Transfer-Encoding: chunked")
+            lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+            chunk = first
+            while chunk is not None:
+                if chunk and method != "HEAD":
+                    if chunked:
+                        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    else:
+                        writer.write(chunk)
+                    await writer.drain()
+                pending = self._executor.submit(self._next_chunk, iterator)
+                chunk = await asyncio.wrap_future(pending)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if pending is not None and not pending.done():
+                # The app is still producing the next chunk, so the response
+                # can't be closed until it's done
+                pending.add_done_callback(lambda _: self._finish(result, slot))
+            else:
+                await loop.run_in_executor(self._executor, self._finish, result, slot)
+
+        return keep_alive
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # Idle keep-alive connections time out waiting for the next request
+        self.timeout = self.server.keep_alive
+        super().setup()
+
+
+class ThreadedServer(BaseWSGIServer):
+    """Serves a WSGI app with a thread for each connection
+
+    Each connection uses a thread until it's closed, but only requests the app
+    is handling count against ``threads``. Requests wait for their turn when
+    the app is handling ``threads`` requests already.
+
+    :arg app: the WSGI app
+    :arg host: host to listen on
+    :arg port: port to listen on
+    :arg threads: number of requests the WSGI app handles at once
+    :arg keep_alive: seconds to keep an idle connection open
+    :arg backlog: listen backlog
+    :arg shutdown_timeout: seconds to wait for requests to finish when
+        shutting down
+    :arg max_detached: number of detached requests allowed at once
+    :arg fd: if specified, the file descriptor of a listening socket to use
+        instead of host and port
+
+    """
+
+    multithread = True
+
+    def __init__(
+        self,
+        app,
+        host="127.0.0.1",
+        port=5000,
+        threads=None,
+        keep_alive=None,
+        backlog=None,
+        shutdown_timeout=None,
+        max_detached=None,
+        fd=None,
+    ):
+        self.keep_alive = AsyncServer.KEEP_ALIVE if keep_alive is None else keep_alive
+        self.request_queue_size = backlog or AsyncServer.BACKLOG
+        self.shutdown_timeout = (
+            AsyncServer.SHUTDOWN_TIMEOUT
+            if shutdown_timeout is None
+            else shutdown_timeout
+        )
+        self._slots = threading.Semaphore(threads or AsyncServer.THREADS)
+        self._detached = threading.BoundedSemaphore(
+            max_detached or AsyncServer.MAX_DETACHED
+        )
+        self._threads = set()
+        self._threads_lock = threading.Lock()
+        super().__init__(host, port, app, handler=KeepAliveRequestHandler, fd=fd)
+        self._app = app
+        self.app = self._call_app
+
+    def _call_app(self, environ, start_response):
+        self._slots.acquire()
+        slot = Slot(self._slots.release, self._detached)
+        environ[DETACH_KEY] = slot.detach
+        try:
+            result = self._app(environ, start_response)
+        except BaseException:
+            slot.close()
+            raise
+        return ClosingIterator(result, slot.close)
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(
+            target=self._process, args=(request, client_address), daemon=True
+        )
+        with self._threads_lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._threads_lock:
+                self._threads.discard(threading.current_thread())
+
+    def run(self):
+        """Serves until SIGINT or SIGTERM and then shuts down gracefully
+
+        :returns: True if all requests finished and False if some were still
+            running after ``shutdown_timeout``
+
+        """
+
+        def handle_signal(signum, frame):
+            # shutdown() waits for serve_forever() to stop, so it can't be
+            # called from the thread that's running serve_forever()
+            threading.Thread(target=self.shutdown).start()
+
+        signal.signal(signal.SIGINT, handle_signal)
+        signal.signal(signal.SIGTERM, handle_signal)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        with self._threads_lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        pending = [thread for thread in threads if thread.is_alive()]
+        if pending:
+            LOGGER.warning("cancelled %s requests at shutdown", len(pending))
+            return False
+        return True
+
+
+def make_socket(host, port, backlog):
+    """Creates a listening socket that worker processes can share"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, use_async, **options):
+    """Runs a server on the listening socket until it's told to stop
+
+    :returns: True if it shut down cleanly
+
+    """
+    if use_async:
+        server = AsyncServer(app, **options)
+        server.run(sock=sock)
+        return True
+
+    server = ThreadedServer(app, fd=sock.fileno(), **options)
+    return server.run()
+
+
+def serve(
+    app,
+    host="127.0.0.1",
+    port=5000,
+    workers=1,
+    use_async=False,
+    threads=None,
+    keep_alive=None,
+    backlog=None,
+    shutdown_timeout=None,
+    max_body_bytes=None,
+    on_exit=None,
+):
+    """Serves a WSGI app until SIGINT or SIGTERM
+
+    With more than one worker, this forks worker processes that accept
+    connections from the same listening socket. Workers that die are replaced.
+    When this gets SIGINT or SIGTERM, it sends SIGTERM to the workers and waits
+    for them to shut down gracefully.
+
+    NOTE: Each worker process has its own copy of the app, so with more
+    than one worker, the app needs storage that processes can share.
+
+    :arg app: the WSGI app
+    :arg host: host to listen on
+    :arg port: port to listen on
+    :arg workers: number of worker processes
+    :arg use_async: whether workers use ``AsyncServer`` or ``ThreadedServer``
+    :arg threads: number of requests each worker handles at once
+    :arg keep_alive: seconds to keep an idle connection open
+    :arg backlog: listen backlog
+    :arg shutdown_timeout: seconds to wait for requests to finish when
+        shutting down
+    :arg max_body_bytes: if specified, a function ``AsyncServer`` calls to
+        get the most bytes to read for a request body; ``ThreadedServer``
+        passes bodies to the app as they arrive, so the app enforces its own
+        limits
+    :arg on_exit: function called with no arguments in each worker process
+        after it stops serving
+
+    """
+    sock = make_socket(host, port, backlog or AsyncServer.BACKLOG)
+    options = {
+        "threads": threads,
+        "keep_alive": keep_alive,
+        "backlog": backlog,
+        "shutdown_timeout": shutdown_timeout,
+    }
+    if use_async:
+        options["max_body_bytes"] = max_body_bytes
+
+    def handle_exit(clean):
+        if on_exit is not None:
+            on_exit()
+        if not clean:
+            # Threads that are still handling requests would keep the process
+            # from exiting
+            logging.shutdown()
+            os._exit(0)
+
+    if workers <= 1:
+        try:
+            clean = run_worker(app, sock, use_async, **options)
+        finally:
+            sock.close()
+        handle_exit(clean)
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(app, sock, use_async, **options)
+                if on_exit is not None:
+                    on_exit()
+            except BaseException:
+                LOGGER.exception("worker %s failed", os.getpid())
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        children.add(pid)
+
+    def handle_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    for _ in range(workers):
+        spawn()
+    LOGGER.info("started %s workers", workers)
+
+    try:
+        while children:
+            pid, status = os.wait()
+            if pid not in children:
+                continue
+            children.discard(pid)
+            if not stopping:
+                LOGGER.warning(
+                    "worker %s exited with %s; starting a new one",
+                    pid,
+                    os.waitstatus_to_exitcode(status),
+                )
+                spawn()
+    finally:
+        sock.close()
@@ -0,0 +1,1319 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Storage backends for EventManager.
+
+Each backend keeps the most recent events for each project subject to a
+per-project count limit, an optional per-project byte limit, and an optional
+byte limit for all projects together.
+
+"""
+
+import heapq
+import itertools
+import logging
+import mmap
+import operator
+import os
+import sqlite3
+import struct
+import threading
+import uuid
+import zlib
+
+from kent import codec
+from kent.events import Event, get_terms
+from kent.utils import RingBuffer
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def encode_body(event):
+    """Encodes an event body for storage
+
+    :arg event: the Event
+
+    :returns: ``(body_type, data)`` where body_type is ``"json"``, ``"bytes"``,
+        or None
+
+    """
+    raw_body = event.get_raw_body()
+    if raw_body is not None:
+        return "json", raw_body
+
+    body = event.body
+    if body is None:
+        return None, b""
+    if isinstance(body, bytes):
+        return "bytes", body
+    return "json", codec.dumps(body)
+
+
+def encode_text(data):
+    """Returns data encoded as JSON in a str for SQLite TEXT columns"""
+    return codec.dumps(data).decode("utf-8")
+
+
+class Storage:
+    """Interface for storage backends
+
+    Backends must be safe to use from multiple threads.
+
+    """
+
+    # Whether other processes can add events to the same storage; if so, Kent
+    # can't rely on being notified about new events
+    shared = False
+
+    def __init__(
+        self,
+        max_events,
+        max_bytes=None,
+        max_project_bytes=None,
+        path=None,
+        on_evict=None,
+    ):
+        """
+        :arg max_events: maximum number of events to keep per project
+        :arg max_bytes: maximum total size of events to keep for all projects;
+            None means there's no limit
+        :arg max_project_bytes: maximum total size of events to keep per
+            project; None means there's no limit
+        :arg path: path for backends that keep events on disk
+        :arg on_evict: function called with each Event that's evicted to stay
+            under the limits; it's not called for events that are flushed
+
+        """
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_project_bytes = max_project_bytes
+        self.path = path
+        self.on_evict = on_evict
+
+    def evicted(self, event):
+        """Calls ``on_evict`` for an evicted event"""
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(event)
+        except Exception:
+            LOGGER.exception("%s: exception in on_evict", event.event_id)
+
+    def add_event(self, event):
+        """Stores an event and sets its ``seq``
+
+        This evicts the project's oldest events until the project is back
+        under its limits and then the oldest events of any project until all
+        the events are under ``max_bytes``, but always keeps the event that
+        was just added.
+
+        """
+        raise NotImplementedError
+
+    def add_events(self, events):
+        """Stores events like ``add_event`` and returns them
+
+        Backends can do this more efficiently than adding events one at a
+        time.
+
+        """
+        return [self.add_event(event) for event in events]
+
+    def get_event(self, event_id):
+        """Returns the Event for this event id or None"""
+        raise NotImplementedError
+
+    def get_events(self, project_id=None, since=None, limit=None):
+        """Returns events in the order they were added
+
+        :arg project_id: if specified, only returns events for this project
+        :arg since: if specified, only returns events with a ``seq`` greater
+            than this
+        :arg limit: if specified, returns at most this many events
+
+        :returns: list of Event instances
+
+        """
+        raise NotImplementedError
+
+    def search(
+        self,
+        project_id=None,
+        terms=None,
+        start=None,
+        end=None,
+        since=None,
+        limit=None,
+    ):
+        """Returns events that match all the criteria in the order they were added
+
+        :arg project_id: if specified, only returns events for this project
+        :arg terms: list of ``(field, value)`` pairs the event must have; see
+            ``kent.events.get_terms``; a value ending in ``*`` matches values
+            that start with the rest of it
+        :arg start: if specified, only returns events received at or after
+            this time in seconds since the epoch
+        :arg end: if specified, only returns events received at or before this
+            time in seconds since the epoch
+        :arg since: if specified, only returns events with a ``seq`` greater
+            than this
+        :arg limit: if specified, returns at most this many events
+
+        :returns: list of Event instances
+
+        """
+        raise NotImplementedError
+
+    def get_watermark(self):
+        """Returns the highest ``seq`` where all events up to it are visible
+
+        Events are added concurrently, so an event can become visible before
+        an event with a lower ``seq``. Readers that keep track of the last
+        ``seq`` they've seen should only go up to the watermark so they don't
+        skip events.
+
+        """
+        raise NotImplementedError
+
+    def get_usage(self):
+        """Returns map of project_id -> ``{"events": count, "bytes": size}``"""
+        raise NotImplementedError
+
+    def flush(self, project_id=None):
+        """Removes events
+
+        :arg project_id: if specified, only removes events for this project
+
+        """
+        raise NotImplementedError
+
+    def get_generation(self):
+        """Returns a string that changes whenever events are added or removed
+
+        It's different for different storage, so it works for ETags.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any resources the backend holds"""
+
+
+class Partition:
+    """Events for a single project in the order they were added
+
+    The partition's lock must be held to read or change it.
+
+    """
+
+    def __init__(self, max_events):
+        self.lock = threading.Lock()
+        self.events = RingBuffer(max_events)
+        # Sum of Event.size for all events in this partition
+        self.total_bytes = 0
+        # Set when the partition has been flushed; writers need to get a new one
+        self.closed = False
+        # Search index of field -> value -> {seq: Event}
+        self.terms = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def index(self, event):
+        for field, value in get_terms(event):
+            self.terms.setdefault(field, {}).setdefault(value, {})[event.seq] = event
+
+    def unindex(self, event):
+        for field, value in get_terms(event):
+            values = self.terms.get(field, {})
+            postings = values.get(value)
+            if postings is not None:
+                postings.pop(event.seq, None)
+                if not postings:
+                    del values[value]
+
+    def get_postings(self, field, value):
+        """Returns ``{seq: Event}`` for events with this term"""
+        values = self.terms.get(field, {})
+        if not value.endswith("*"):
+            return values.get(value, {})
+
+        prefix = value[:-1]
+        postings = {}
+        for indexed_value, indexed_postings in values.items():
+            if indexed_value.startswith(prefix):
+                postings.update(indexed_postings)
+        return postings
+
+    def search(self, terms, start, end, since, limit):
+        """Returns matching events; see ``Storage.search``"""
+        if terms:
+            # Start with the smallest set of events and check the others
+            postings = sorted(
+                (self.get_postings(field, value) for field, value in terms), key=len
+            )
+            events = [
+                event
+                for seq, event in postings[0].items()
+                if (since is None or seq > since)
+                and (start is None or event.received >= start)
+                and (end is None or event.received <= end)
+                and all(seq in other for other in postings[1:])
+            ]
+            events.sort(key=operator.attrgetter("seq"))
+            return events[:limit]
+
+        # Events are in sequence order and received times never go down, so
+        # find the range with binary searches
+        lo = self.bisect(lambda event: since is not None and event.seq <= since)
+        if start is not None:
+            lo = max(lo, self.bisect(lambda event: event.received < start))
+        hi = len(self.events)
+        if end is not None:
+            hi = self.bisect(lambda event: event.received <= end)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return [self.events[i] for i in range(lo, hi)]
+
+    def bisect(self, before):
+        """Returns the index of the first event where ``before(event)`` is false"""
+        lo, hi = 0, len(self.events)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if before(self.events[mid]):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class MemoryStorage(Storage):
+    """Keeps events in process memory
+
+    Each project's partition has its own lock so ingesting events for
+    different projects doesn't contend. Reads take a snapshot of each
+    partition.
+
+    """
+
+    def __init__(
+        self,
+        max_events,
+        max_bytes=None,
+        max_project_bytes=None,
+        path=None,
+        on_evict=None,
+    ):
+        super().__init__(
+            max_events=max_events,
+            max_bytes=max_bytes,
+            max_project_bytes=max_project_bytes,
+            path=path,
+            on_evict=on_evict,
+        )
+        # Protects creating and removing partitions and handing out sequence
+        # numbers
+        self._lock = threading.Lock()
+        # Sequence numbers are never reused so they keep increasing across
+        # flushes
+        self._seq = itertools.count(1)
+        # Highest sequence number added and sequence numbers handed out for
+        # events that haven't been added yet; see get_watermark()
+        self._last_seq = 0
+        self._pending = set()
+        # Goes up after events are added or removed; see get_generation()
+        self._token = uuid.uuid4().hex
+        self._generation = 0
+        # Map of project_id -> Partition and map of event_id -> Event; these
+        # are swapped together
+        self._state = ({}, {})
+
+    def _get_partition(self, partitions, project_id):
+        partition = partitions.get(project_id)
+        if partition is None:
+            with self._lock:
+                partition = partitions.get(project_id)
+                if partition is None:
+                    partition = partitions[project_id] = Partition(self.max_events)
+        return partition
+
+    def add_event(self, event):
+        return self._insert(event, assign_seq=True)
+
+    def _insert(self, event, assign_seq):
+        while True:
+            # Get partitions and index together so a concurrent flush() can't
+            # leave this event half-added
+            partitions, index = self._state
+            partition = self._get_partition(partitions, event.project_id)
+            with partition.lock:
+                if partition.closed:
+                    # The project was flushed after we got the partition
+                    continue
+
+                # Assign the sequence number while holding the partition lock
+                # so events in a partition are always in sequence order
+                if assign_seq:
+                    with self._lock:
+                        event.seq = next(self._seq)
+                        self._pending.add(event.seq)
+
+                # Keep received times in order within a partition so search
+                # can use binary searches
+                if partition.events and event.received < partition.events[-1].received:
+                    event.received = partition.events[-1].received
+
+                evicted = partition.events.append(event)
+                if evicted is not None:
+                    self._evict(index, partition, evicted)
+                index[event.event_id] = event
+                partition.index(event)
+                partition.total_bytes += event.size
+
+                # Evict oldest-first until we're back under budget, but always
+                # keep the event we just added
+                if self.max_project_bytes is not None:
+                    while (
+                        partition.total_bytes > self.max_project_bytes
+                        and len(partition) > 1
+                    ):
+                        self._evict(index, partition, partition.events.popleft())
+
+            if self.max_bytes is not None:
+                self._evict_oldest(partitions, index, event)
+
+            with self._lock:
+                self._pending.discard(event.seq)
+                self._last_seq = max(self._last_seq, event.seq)
+                self._generation += 1
+            return event
+
+    def _evict_oldest(self, partitions, index, keep):
+        """Evicts the oldest events of any project until they fit in max_bytes
+
+        This never evicts ``keep``, the event that was just added.
+
+        """
+        while True:
+            with self._lock:
+                candidates = list(partitions.values())
+            if sum(partition.total_bytes for partition in candidates) <= self.max_bytes:
+                return
+
+            # Events in a partition are in sequence order, so the oldest event
+            # is at the front of one of the partitions. NOTE: only one
+            # partition lock is held at a time so this can't deadlock with
+            # other writers.
+            oldest = None
+            for partition in candidates:
+                with partition.lock:
+                    if partition.events and (
+                        oldest is None or partition.events[0].seq < oldest[1].seq
+                    ):
+                        oldest = (partition, partition.events[0])
+            if oldest is None or oldest[1] is keep:
+                return
+
+            partition, event = oldest
+            with partition.lock:
+                # Another writer could have evicted it in the meantime
+                if (
+                    not partition.closed
+                    and partition.events
+                    and partition.events[0] is event
+                ):
+                    self._evict(index, partition, partition.events.popleft())
+                    if not partition.events:
+                        # Remove the empty partition like flush() does so
+                        # projects with no events don't take up memory
+                        partition.closed = True
+                        with self._lock:
+                            if partitions.get(event.project_id) is partition:
+                                del partitions[event.project_id]
+
+    def _evict(self, index, partition, event):
+        self._forget(index, partition, event)
+        self.evicted(event)
+
+    def _forget(self, index, partition, event):
+        # NOTE: index entries for a project are only changed while
+        # holding that project's partition lock
+        if index.get(event.event_id) is event:
+            del index[event.event_id]
+        partition.unindex(event)
+        partition.total_bytes -= event.size
+
+    def _get_partitions(self):
+        partitions = self._state[0]
+        with self._lock:
+            return list(partitions.items())
+
+    def get_event(self, event_id):
+        return self._state[1].get(event_id)
+
+    def get_events(self, project_id=None, since=None, limit=None):
+        return self.search(project_id=project_id, since=since, limit=limit)
+
+    def search(
+        self,
+        project_id=None,
+        terms=None,
+        start=None,
+        end=None,
+        since=None,
+        limit=None,
+    ):
+        if project_id is not None:
+            partition = self._state[0].get(project_id)
+            if partition is None:
+                return []
+            partitions = [partition]
+        else:
+            partitions = [partition for _, partition in self._get_partitions()]
+
+        # NOTE: each partition can have at most limit events in the
+        # result, so that's all we need to copy
+        everything = not terms and all(
+            arg is None for arg in (start, end, since, limit)
+        )
+        results = []
+        for partition in partitions:
+            with partition.lock:
+                if everything:
+                    events = list(partition.events)
+                else:
+                    events = partition.search(terms, start, end, since, limit)
+            if events:
+                results.append(events)
+
+        if len(results) == 1:
+            return results[0]
+
+        merged = heapq.merge(*results, key=operator.attrgetter("seq"))
+        return list(itertools.islice(merged, limit))
+
+    def get_watermark(self):
+        with self._lock:
+            if self._pending:
+                return min(self._pending) - 1
+            return self._last_seq
+
+    def get_usage(self):
+        projects = {}
+        for project_id, partition in self._get_partitions():
+            with partition.lock:
+                projects[project_id] = {
+                    "events": len(partition),
+                    "bytes": partition.total_bytes,
+                }
+        return projects
+
+    def flush(self, project_id=None):
+        if project_id is not None:
+            partitions, index = self._state
+            with self._lock:
+                partition = partitions.pop(project_id, None)
+            if partition is not None:
+                with partition.lock:
+                    partition.closed = True
+                    for event in partition.events:
+                        self._forget(index, partition, event)
+        else:
+            # Map of project_id -> Partition and map of event_id -> Event;
+            # these are swapped together
+            self._state = ({}, {})
+
+        # NOTE: the generation goes up after the events are gone so
+        # anything that sees the new generation sees the change
+        with self._lock:
+            self._generation += 1
+
+    def get_generation(self):
+        with self._lock:
+            return f"{self._token}-{self._generation}"
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL UNIQUE,
+    project_id NOT NULL,
+    envelope_header TEXT,
+    header TEXT,
+    -- "json" for JSON-encoded bodies, "bytes" for attachments
+    body_type TEXT,
+    body BLOB,
+    size INTEGER NOT NULL,
+    summary TEXT,
+    timestamp TEXT,
+    sdk_name TEXT,
+    sdk_version TEXT,
+    release TEXT,
+    environment TEXT,
+    -- JSON-encoded list of strings
+    exception_types TEXT,
+    -- JSON-encoded object of strings
+    tags TEXT,
+    received REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS events_project_seq ON events (project_id, seq);
+CREATE INDEX IF NOT EXISTS events_received ON events (received);
+
+-- Search index; see kent.events.get_terms
+CREATE TABLE IF NOT EXISTS event_terms (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS event_terms_field_value ON event_terms (field, value, seq);
+CREATE INDEX IF NOT EXISTS event_terms_seq ON event_terms (seq);
+
+CREATE TABLE IF NOT EXISTS projects (
+    project_id PRIMARY KEY,
+    events INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+
+-- Single row with a random token for the database and a counter that goes up
+-- whenever events are added or removed
+CREATE TABLE IF NOT EXISTS generation (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    token TEXT NOT NULL,
+    value INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS events_insert AFTER INSERT ON events
+BEGIN
+    UPDATE generation SET value = value + 1;
+    INSERT INTO projects (project_id, events, bytes)
+    VALUES (new.project_id, 1, new.size)
+    ON CONFLICT (project_id) DO UPDATE
+    SET events = events + 1, bytes = bytes + new.size;
+END;
+
+CREATE TRIGGER IF NOT EXISTS events_delete AFTER DELETE ON events
+BEGIN
+    UPDATE generation SET value = value + 1;
+    UPDATE projects SET events = events - 1, bytes = bytes - old.size
+    WHERE project_id = old.project_id;
+    DELETE FROM projects WHERE project_id = old.project_id AND events <= 0;
+    DELETE FROM event_terms WHERE seq = old.seq;
+END;
+"""
+
+
+class SqliteStorage(Storage):
+    """Keeps events in a SQLite database in WAL mode
+
+    Multiple processes on the same host can share the database, so this works
+    with pre-fork WSGI servers where each worker has its own EventManager.
+
+    Each thread in each process gets its own connection.
+
+    """
+
+    shared = True
+
+    # Seconds to wait for another process to finish writing
+    TIMEOUT = 30
+
+    COLUMNS = (
+        "seq, event_id, project_id, envelope_header, header, body_type, body, size, "
+        "summary, timestamp, sdk_name, sdk_version, release, environment, "
+        "exception_types, tags, received"
+    )
+
+    def __init__(
+        self,
+        max_events,
+        max_bytes=None,
+        max_project_bytes=None,
+        path=None,
+        on_evict=None,
+    ):
+        if not path:
+            raise ValueError("SqliteStorage requires a path")
+        super().__init__(
+            max_events=max_events,
+            max_bytes=max_bytes,
+            max_project_bytes=max_project_bytes,
+            path=path,
+            on_evict=on_evict,
+        )
+        self._local = threading.local()
+        # All connections so close() can close them
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        conn = self._get_conn()
+        conn.executescript(SQLITE_SCHEMA)
+        conn.execute(
+            "INSERT OR IGNORE INTO generation (id, token, value) VALUES (1, ?, 0)",
+            (uuid.uuid4().hex,),
+        )
+
+    def _get_conn(self):
+        # NOTE: connections can't be shared across threads or carried
+        # over a fork, so we key them by pid
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # NOTE: check_same_thread is off so close() can close
+            # connections for other threads; each thread still only uses its
+            # own connection
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def _to_row(self, event):
+        body_type, body = encode_body(event)
+        return (
+            event.event_id,
+            event.project_id,
+            encode_text(event.envelope_header),
+            encode_text(event.header),
+            body_type,
+            body,
+            event.size,
+            event.summary,
+            event.timestamp,
+            event.sdk_name,
+            event.sdk_version,
+            event.release,
+            event.environment,
+            encode_text(event.exception_types),
+            encode_text(event.tags),
+            event.received,
+        )
+
+    def _from_row(self, row):
+        (
+            seq,
+            event_id,
+            project_id,
+            envelope_header,
+            header,
+            body_type,
+            body,
+            size,
+            summary,
+            timestamp,
+            sdk_name,
+            sdk_version,
+            release,
+            environment,
+            exception_types,
+            tags,
+            received,
+        ) = row
+        # JSON bodies are decoded when they're needed
+        if body_type == "json":
+            body_kwargs = {"raw_body": body}
+        elif body_type == "bytes":
+            body_kwargs = {"body": body}
+        else:
+            body_kwargs = {}
+        return Event(
+            project_id=project_id,
+            event_id=event_id,
+            envelope_header=codec.loads(envelope_header),
+            header=codec.loads(header),
+            size=size,
+            seq=seq,
+            summary=summary,
+            timestamp=timestamp,
+            sdk_name=sdk_name,
+            sdk_version=sdk_version,
+            release=release,
+            environment=environment,
+            exception_types=codec.loads(exception_types),
+            tags=codec.loads(tags),
+            received=received,
+            **body_kwargs,
+        )
+
+    def add_event(self, event):
+        return self.add_events([event])[0]
+
+    def add_events(self, events):
+        conn = self._get_conn()
+        # BEGIN IMMEDIATE takes the write lock now so retention is enforced
+        # against a consistent view across processes
+        conn.execute("BEGIN IMMEDIATE")
+        evicted = []
+        try:
+            for event in events:
+                cursor = conn.execute(
+                    "INSERT INTO events "
+                    "(event_id, project_id, envelope_header, header, body_type, body, "
+                    "size, summary, timestamp, sdk_name, sdk_version, release, "
+                    "environment, exception_types, tags, received) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._to_row(event),
+                )
+                event.seq = cursor.lastrowid
+                conn.executemany(
+                    "INSERT INTO event_terms (field, value, seq) VALUES (?, ?, ?)",
+                    [(field, value, event.seq) for field, value in get_terms(event)],
+                )
+                evicted.extend(self._evict(conn, event))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        # Only tell on_evict once the events are really gone
+        for event in evicted:
+            self.evicted(event)
+        return events
+
+    def _evict(self, conn, event):
+        """Evicts events until the database is back under its limits
+
+        :returns: list of evicted events when there's an ``on_evict``
+
+        """
+        evicted = []
+        count, total_bytes = conn.execute(
+            "SELECT events, bytes FROM projects WHERE project_id = ?",
+            (event.project_id,),
+        ).fetchone()
+
+        over_count = count - self.max_events
+        over_bytes = (
+            (total_bytes - self.max_project_bytes) if self.max_project_bytes else 0
+        )
+        if over_count > 0 or over_bytes > 0:
+            evicted.extend(self._evict_project(conn, event, over_count, over_bytes))
+        if self.max_bytes:
+            evicted.extend(self._evict_oldest(conn, event))
+        return evicted
+
+    def _delete(self, conn, where, params):
+        """Deletes events and returns them when there's an ``on_evict``"""
+        evicted = []
+        if self.on_evict is not None:
+            evicted = [
+                self._from_row(row)
+                for row in conn.execute(
+                    f"SELECT {self.COLUMNS} FROM events WHERE {where}", params
+                )
+            ]
+        conn.execute(f"DELETE FROM events WHERE {where}", params)
+        return evicted
+
+    def _evict_project(self, conn, event, over_count, over_bytes):
+        # Walk the oldest events until enough are marked for eviction, but
+        # always keep the event we just added
+        last_seq = None
+        rows = conn.execute(
+            "SELECT seq, size FROM events WHERE project_id = ? AND seq < ? "
+            "ORDER BY seq",
+            (event.project_id, event.seq),
+        )
+        for seq, size in rows:
+            if over_count <= 0 and over_bytes <= 0:
+                break
+            last_seq = seq
+            over_count -= 1
+            over_bytes -= size
+
+        if last_seq is None:
+            return []
+        return self._delete(
+            conn, "project_id = ? AND seq <= ?", (event.project_id, last_seq)
+        )
+
+    def _evict_oldest(self, conn, event):
+        """Evicts the oldest events of any project until they fit in max_bytes
+
+        This always keeps the event that was just added.
+
+        """
+        (total_bytes,) = conn.execute("SELECT SUM(bytes) FROM projects").fetchone()
+        over_bytes = (total_bytes or 0) - self.max_bytes
+        if over_bytes <= 0:
+            return []
+
+        last_seq = None
+        rows = conn.execute(
+            "SELECT seq, size FROM events WHERE seq < ? ORDER BY seq", (event.seq,)
+        )
+        for seq, size in rows:
+            if over_bytes <= 0:
+                break
+            last_seq = seq
+            over_bytes -= size
+
+        if last_seq is None:
+            return []
+        return self._delete(conn, "seq <= ?", (last_seq,))
+
+    def get_event(self, event_id):
+        row = (
+            self._get_conn()
+            .execute(
+                f"SELECT {self.COLUMNS} FROM events WHERE event_id = ?", (event_id,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return self._from_row(row)
+
+    def get_events(self, project_id=None, since=None, limit=None):
+        return self.search(project_id=project_id, since=since, limit=limit)
+
+    def search(
+        self,
+        project_id=None,
+        terms=None,
+        start=None,
+        end=None,
+        since=None,
+        limit=None,
+    ):
+        where = ["seq > ?"]
+        params = [since or 0]
+        if project_id is not None:
+            where.append("project_id = ?")
+            params.append(project_id)
+        if start is not None:
+            where.append("received >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("received <= ?")
+            params.append(end)
+        for field, value in terms or []:
+            if value.endswith("*"):
+                # Prefix match that can use the index
+                where.append(
+                    "seq IN (SELECT seq FROM event_terms "
+                    "WHERE field = ? AND value >= ? AND value < ?)"
+                )
+                params.extend([field, value[:-1], value[:-1] + "\U0010ffff"])
+            else:
+                where.append(
+                    "seq IN (SELECT seq FROM event_terms WHERE field = ? AND value = ?)"
+                )
+                params.extend([field, value])
+        # NOTE: LIMIT -1 means there's no limit
+        params.append(-1 if limit is None else limit)
+        rows = self._get_conn().execute(
+            f"SELECT {self.COLUMNS} FROM events WHERE {' AND '.join(where)} "
+            "ORDER BY seq LIMIT ?",
+            params,
+        )
+        return [self._from_row(row) for row in rows]
+
+    def get_watermark(self):
+        # NOTE: writers hold the database write lock from handing out
+        # the seq until they commit, so every committed seq is visible
+        row = (
+            self._get_conn()
+            .execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'")
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def get_usage(self):
+        rows = self._get_conn().execute(
+            "SELECT project_id, events, bytes FROM projects ORDER BY project_id"
+        )
+        return {
+            project_id: {"events": events, "bytes": total_bytes}
+            for project_id, events, total_bytes in rows
+        }
+
+    def flush(self, project_id=None):
+        conn = self._get_conn()
+        if project_id is not None:
+            conn.execute("DELETE FROM events WHERE project_id = ?", (project_id,))
+        else:
+            conn.execute("DELETE FROM events")
+
+    def get_generation(self):
+        token, value = (
+            self._get_conn()
+            .execute("SELECT token, value FROM generation WHERE id = 1")
+            .fetchone()
+        )
+        return f"{token}-{value}"
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+
+class LogEvent(Event):
+    """Event whose body is read from a log segment when it's needed"""
+
+    __slots__ = ("_storage", "segment_id", "offset", "length", "body_type")
+
+    def __init__(self, storage, segment_id, offset, length, body_type, **kwargs):
+        self._storage = storage
+        self.segment_id = segment_id
+        self.offset = offset
+        self.length = length
+        self.body_type = body_type
+        super().__init__(**kwargs)
+
+    def get_raw_body(self):
+        if self.body_type != "json":
+            return None
+        return self._storage.read(self)
+
+    @property
+    def body(self):
+        if self.body_type == "json":
+            return self._decode_body()
+        if self.body_type == "bytes":
+            return self._storage.read(self)
+        return None
+
+
+class Segment:
+    """A single append-only log file"""
+
+    def __init__(self, segment_id, path, size=0):
+        self.segment_id = segment_id
+        self.path = path
+        self.size = size
+        # Number of events in this segment that are still in the index
+        self.live = 0
+        self._mmap = None
+
+    def read(self, offset, length):
+        """Returns a view of ``length`` bytes at ``offset``"""
+        if length == 0:
+            return b""
+        mm = self._mmap
+        if mm is None or len(mm) < offset + length:
+            # The segment has grown since we mapped it
+            with open(self.path, "rb") as fp:
+                mm = self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm)[offset : offset + length]
+
+    def unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+# magic, crc32 of meta and body, length of meta, length of body
+RECORD_HEADER = struct.Struct("<4sIIQ")
+RECORD_MAGIC = b"KENT"
+
+
+class LogStorage(MemoryStorage):
+    """Keeps events in segmented append-only log files in a directory
+
+    The index of events is kept in memory and rebuilt at startup by replaying
+    the segments. Event bodies stay on disk and are read through mmap when
+    they're needed.
+
+    When the active segment reaches ``segment_bytes``, Kent starts a new one.
+    Kent deletes the oldest segments when none of their events are left or
+    when the log is bigger than ``max_log_bytes``.
+
+    Only one process can use a log directory at a time.
+
+    """
+
+    SEGMENT_BYTES = 64 * 1024 * 1024
+    MAX_LOG_BYTES = 1024 * 1024 * 1024
+
+    def __init__(
+        self,
+        max_events,
+        max_bytes=None,
+        max_project_bytes=None,
+        path=None,
+        on_evict=None,
+        segment_bytes=None,
+        max_log_bytes=None,
+    ):
+        if not path:
+            raise ValueError("LogStorage requires a path")
+        super().__init__(
+            max_events=max_events,
+            max_bytes=max_bytes,
+            max_project_bytes=max_project_bytes,
+            path=path,
+            on_evict=on_evict,
+        )
+        self.segment_bytes = segment_bytes or self.SEGMENT_BYTES
+        self.max_log_bytes = max_log_bytes or self.MAX_LOG_BYTES
+
+        # Serializes writing to the log so records are in sequence order
+        self._write_lock = threading.Lock()
+        # Map of segment_id -> Segment, oldest first
+        self._segments = {}
+        self._file = None
+
+        os.makedirs(path, exist_ok=True)
+        with self._write_lock:
+            self._replay()
+            self._delete_old_segments()
+            self._open_active()
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.path, f"{segment_id:010d}.log")
+
+    def _replay(self):
+        segment_ids = sorted(
+            int(name[:-4])
+            for name in os.listdir(self.path)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        max_seq = 0
+        for segment_id in segment_ids:
+            path = self._segment_path(segment_id)
+            segment = self._segments[segment_id] = Segment(
+                segment_id, path, size=os.path.getsize(path)
+            )
+            for meta, offset, length in self._scan(segment):
+                if meta["type"] == "flush":
+                    MemoryStorage.flush(self, project_id=meta["project_id"])
+                    if meta["project_id"] is None:
+                        for old_segment in self._segments.values():
+                            old_segment.live = 0
+                    continue
+
+                max_seq = max(max_seq, meta["seq"])
+                segment.live += 1
+                self._insert(
+                    self._make_event(meta, segment_id, offset, length),
+                    assign_seq=False,
+                )
+
+        self._seq = itertools.count(max_seq + 1)
+
+    def _scan(self, segment):
+        """Yields ``(meta, body_offset, body_length)`` for records in a segment
+
+        If the segment ends with a partial or corrupt record, for example from
+        Kent getting killed mid-write, this truncates the segment there.
+
+        """
+        offset = 0
+        while offset < segment.size:
+            end = offset + RECORD_HEADER.size
+            if end <= segment.size:
+                view = segment.read(offset, RECORD_HEADER.size)
+                magic, crc, meta_length, body_length = RECORD_HEADER.unpack(view)
+                view.release()
+                body_offset = end + meta_length
+                if magic == RECORD_MAGIC and body_offset + body_length <= segment.size:
+                    meta_view = segment.read(end, meta_length)
+                    body_view = segment.read(body_offset, body_length)
+                    valid = zlib.crc32(body_view, zlib.crc32(meta_view)) == crc
+                    meta_data = bytes(meta_view)
+                    meta_view.release()
+                    if isinstance(body_view, memoryview):
+                        body_view.release()
+                    if valid:
+                        yield codec.loads(meta_data), body_offset, body_length
+                        offset = body_offset + body_length
+                        continue
+
+            LOGGER.warning(
+                "%s: truncating corrupt record at offset %s", segment.path, offset
+            )
+            segment.unmap()
+            os.truncate(segment.path, offset)
+            segment.size = offset
+            return
+
+    def _make_event(self, meta, segment_id, offset, length):
+        return LogEvent(
+            storage=self,
+            segment_id=segment_id,
+            offset=offset,
+            length=length,
+            body_type=meta["body_type"],
+            project_id=meta["project_id"],
+            event_id=meta["event_id"],
+            envelope_header=meta["envelope_header"],
+            header=meta["header"],
+            size=meta["size"],
+            seq=meta["seq"],
+            summary=meta["summary"],
+            timestamp=meta["timestamp"],
+            sdk_name=meta["sdk_name"],
+            sdk_version=meta["sdk_version"],
+            release=meta["release"],
+            environment=meta["environment"],
+            exception_types=meta["exception_types"],
+            tags=meta["tags"],
+            received=meta["received"],
+        )
+
+    def _open_active(self):
+        if not self._segments:
+            self._segments[1] = Segment(1, self._segment_path(1))
+        self._active = next(reversed(self._segments.values()))
+        self._file = open(self._active.path, "ab")
+
+    def _rotate(self):
+        self._file.close()
+        segment_id = self._active.segment_id + 1
+        self._active = self._segments[segment_id] = Segment(
+            segment_id, self._segment_path(segment_id)
+        )
+        self._file = open(self._active.path, "ab")
+
+    def _append(self, meta, body):
+        """Appends a record to the active segment
+
+        :returns: ``(segment, body_offset)``
+
+        """
+        meta_data = codec.dumps(meta)
+        crc = zlib.crc32(body, zlib.crc32(meta_data))
+        header = RECORD_HEADER.pack(RECORD_MAGIC, crc, len(meta_data), len(body))
+        record_length = len(header) + len(meta_data) + len(body)
+
+        if (
+            self._active.size > 0
+            and self._active.size + record_length > self.segment_bytes
+        ):
+            self._rotate()
+
+        segment = self._active
+        self._file.write(header)
+        self._file.write(meta_data)
+        self._file.write(body)
+        self._file.flush()
+
+        body_offset = segment.size + len(header) + len(meta_data)
+        segment.size += record_length
+        return segment, body_offset
+
+    def _forget(self, index, partition, event):
+        super()._forget(index, partition, event)
+        segment = self._segments.get(event.segment_id)
+        if segment is not None:
+            segment.live -= 1
+
+    def _delete_old_segments(self):
+        # NOTE: Segments are only deleted from the oldest end. That way
+        # flush records in newer segments still apply to events in older
+        # segments when replaying.
+        total_size = sum(segment.size for segment in self._segments.values())
+        while len(self._segments) > 1:
+            oldest = next(iter(self._segments.values()))
+            if oldest.live > 0:
+                if total_size <= self.max_log_bytes:
+                    break
+                self._drop_segment_events(oldest)
+
+            total_size -= oldest.size
+            del self._segments[oldest.segment_id]
+            os.remove(oldest.path)
+
+    def _drop_segment_events(self, segment):
+        # Events in a partition are in sequence order and this is the oldest
+        # segment, so its events are at the front of each partition
+        index = self._state[1]
+        for _, partition in self._get_partitions():
+            with partition.lock:
+                while (
+                    partition.events
+                    and partition.events[0].segment_id == segment.segment_id
+                ):
+                    self._evict(index, partition, partition.events.popleft())
+
+    def read(self, event):
+        """Returns the stored body bytes for an event or None"""
+        segment = self._segments.get(event.segment_id)
+        if segment is None:
+            # The segment was deleted
+            return None
+        try:
+            view = segment.read(event.offset, event.length)
+        except FileNotFoundError:
+            return None
+        data = bytes(view)
+        if isinstance(view, memoryview):
+            view.release()
+        return data
+
+    def add_event(self, event):
+        body_type, body = encode_body(event)
+        with self._write_lock:
+            with self._lock:
+                event.seq = next(self._seq)
+            meta = {
+                "type": "event",
+                "seq": event.seq,
+                "event_id": event.event_id,
+                "project_id": event.project_id,
+                "envelope_header": event.envelope_header,
+                "header": event.header,
+                "body_type": body_type,
+                "size": event.size,
+                "summary": event.summary,
+                "timestamp": event.timestamp,
+                "sdk_name": event.sdk_name,
+                "sdk_version": event.sdk_version,
+                "release": event.release,
+                "environment": event.environment,
+                "exception_types": event.exception_types,
+                "tags": event.tags,
+                "received": event.received,
+            }
+            segment, offset = self._append(meta, body)
+            segment.live += 1
+            self._insert(
+                self._make_event(meta, segment.segment_id, offset, len(body)),
+                assign_seq=False,
+            )
+            self._delete_old_segments()
+        return event
+
+    def flush(self, project_id=None):
+        with self._write_lock:
+            self._append({"type": "flush", "project_id": project_id}, b"")
+            super().flush(project_id=project_id)
+            if project_id is None:
+                for segment in self._segments.values():
+                    segment.live = 0
+            self._delete_old_segments()
+
+    def close(self):
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+STORAGE_BACKENDS = {
+    "memory": MemoryStorage,
+    "sqlite": SqliteStorage,
+    "log": LogStorage,
+}
+
+
+def get_storage_class(name):
+    """Returns the storage class for a backend name"""
+    try:
+        return STORAGE_BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown storage {name!r}; choose from {', '.join(STORAGE_BACKENDS)}"
+        ) from None
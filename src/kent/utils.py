@@ -2,11 +2,14 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import logging
-import json
+import threading
 from typing import Union
 
+from kent import codec
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -15,85 +18,354 @@ LOGGER = logging.getLogger(__name__)
 class Item:
     envelope_header: dict
     header: dict
-    body: Union[dict, bytes]
+    body: Union[dict, bytes, memoryview]
+    # Size in bytes of the item body as it was received
+    size: int = field(default=0, compare=False)
 
 
-def get_newline_index(body, start_index, end_index):
-    end_index = body.find(b"\n", start_index)
-    if end_index == -1:
-        # If there are no more \n, then the end_index is the last index in the
-        # body
-        end_index = len(body)
-    else:
-        while body[end_index] == "\r":
-            end_index = body.find(b"\n", end_index + 1)
-    return end_index
+class RingBuffer:
+    """Fixed-capacity buffer that drops the oldest item when it's full
 
+    Appending, evicting, and indexing are all O(1). Iterating goes from oldest
+    to newest.
 
-def parse_envelope(body):
-    """Parses an envelope payload into items
+    """
 
-    :arg body: the envelope payload body
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f"capacity must be at least 1, not {capacity}")
+        self.capacity = capacity
+        self._items = [None] * capacity
+        # Index in _items of the oldest item
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self._items[(self._head + i) % self.capacity]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("RingBuffer index out of range")
+        return self._items[(self._head + index) % self.capacity]
+
+    def append(self, item):
+        """Adds an item to the end
+
+        :arg item: the item to add
+
+        :returns: the evicted oldest item if the buffer was full, otherwise None
+
+        """
+        evicted = None
+        if self._size == self.capacity:
+            evicted = self.popleft()
+
+        self._items[(self._head + self._size) % self.capacity] = item
+        self._size += 1
+        return evicted
+
+    def popleft(self):
+        """Removes and returns the oldest item"""
+        if self._size == 0:
+            raise IndexError("pop from an empty RingBuffer")
+        item = self._items[self._head]
+        self._items[self._head] = None
+        self._head = (self._head + 1) % self.capacity
+        self._size -= 1
+        return item
+
+    def clear(self):
+        self._items = [None] * self.capacity
+        self._head = 0
+        self._size = 0
+
+
+class LRUCache:
+    """Thread-safe cache that drops the least recently used item when it's full"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+JSON_WHITESPACE = b" \t\r\n"
+
+
+def iter_lines(chunks):
+    """Yields lines from an iterable of bytes chunks without the line endings
+
+    Blank lines are skipped.
+
+    """
+    pending = []
+    for chunk in chunks:
+        start = 0
+        while True:
+            index = chunk.find(b"\n", start)
+            if index == -1:
+                pending.append(chunk[start:])
+                break
+            pending.append(chunk[start:index])
+            line = b"".join(pending).rstrip(b"\r")
+            pending = []
+            if line:
+                yield line
+            start = index + 1
+
+    line = b"".join(pending).rstrip(b"\r")
+    if line:
+        yield line
+
+
+def looks_like_json(data):
+    """Cheaply checks whether data looks like a JSON object or array
+
+    This doesn't parse the data. It only checks the first and last
+    non-whitespace bytes, so it's possible for data to pass this check and
+    still fail to decode.
+
+    :arg data: bytes
+
+    :returns: bool
 
-    :returns: generator of items
+    """
+    start = 0
+    end = len(data)
+    while start < end and data[start] in JSON_WHITESPACE:
+        start += 1
+    while end > start and data[end - 1] in JSON_WHITESPACE:
+        end -= 1
+    if end - start < 2:
+        return False
+    return (data[start], data[end - 1]) in ((ord("{"), ord("}")), (ord("["), ord("]")))
+
+
+CR = ord("\r")
+LF = ord("\n")
+
+
+class EnvelopeParser:
+    """Parses an envelope incrementally
+
+    Feed the envelope to the parser a chunk at a time with ``feed`` and then
+    call ``close``. Both return the items that were completed.
+
+    Attachment item bodies are memoryviews over the chunks that were fed in, so
+    they're not copied unless they span chunks. Other item bodies are
+    JSON-decoded or bytes.
+
+    Lines end with ``\n`` or ``\r\n``. Items with a ``length`` in their header
+    have exactly that many bytes of body followed by an optional newline.
+
+    See: https://develop.sentry.dev/sdk/envelopes/
+
+    :arg decode: if True, non-attachment item bodies are JSON-decoded; if
+        False, they're left as bytes and only checked with ``looks_like_json``
 
     """
 
-    body_length = len(body)
-    start_index = end_index = 0
-    read_length = -1
+    def __init__(self, decode=True):
+        self.decode = decode
+        self.envelope_header = None
+        # Header of the item whose body is next and the length of its body or
+        # None if the body ends at a newline
+        self._header = None
+        self._length = None
+        # Data from earlier chunks that's part of something incomplete
+        self._pending = []
+        self._pending_size = 0
+        # Whether to skip the newline after a body with a length
+        self._skip_newline = False
+        # Whether the body with a length was followed by a \r and the next
+        # byte should be a \n
+        self._skip_lf = False
+
+    def feed(self, data):
+        """Parses the next chunk of the envelope
+
+        The chunk must not be changed after it's fed in.
+
+        :arg data: bytes
+
+        :returns: list of items that were completed
 
-    envelope_header = None
+        :raises ValueError: if the envelope isn't valid
 
-    # Absorb envelope
-    # See: https://develop.sentry.dev/sdk/envelopes/
-    while end_index < body_length:
-        start_index = end_index
-        end_index = get_newline_index(body, start_index, end_index)
+        """
+        items = []
+        view = memoryview(data)
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if self._skip_lf:
+                self._skip_lf = False
+                if data[pos] == LF:
+                    pos += 1
+
+            elif self._skip_newline:
+                self._skip_newline = False
+                if data[pos] == LF:
+                    pos += 1
+                elif data[pos] == CR:
+                    pos += 1
+                    self._skip_lf = True
+
+            elif self._header is not None and self._length is not None:
+                needed = self._length - self._pending_size
+                if end - pos < needed:
+                    self._add_pending(view[pos:])
+                    break
+                items.append(self._make_item(self._take(view[pos : pos + needed])))
+                pos += needed
+
+            else:
+                index = data.find(b"\n", pos)
+                if index == -1:
+                    self._add_pending(view[pos:])
+                    break
+                item = self._handle_line(self._take(view[pos:index]))
+                if item is not None:
+                    items.append(item)
+                pos = index + 1
 
-        if envelope_header is None:
-            envelope_header = json.loads(body[start_index:end_index])
-            end_index += 1
-            continue
+        return items
 
-        json_part = body[start_index:end_index]
+    def close(self):
+        """Finishes parsing the envelope
 
+        :returns: list of items that were completed
+
+        :raises ValueError: if the envelope ended in the middle of an item
+
+        """
+        items = []
+        if self._pending_size and self._length is None:
+            # The last line didn't end with a newline
+            item = self._handle_line(self._take(memoryview(b"")))
+            if item is not None:
+                items.append(item)
+
+        if self._header is not None:
+            if self._length is not None and self._pending_size < self._length:
+                raise ValueError("envelope ended in the middle of an item")
+            items.append(self._make_item(self._take(memoryview(b""))))
+        return items
+
+    def _add_pending(self, view):
+        self._pending.append(view)
+        self._pending_size += len(view)
+
+    def _take(self, view):
+        """Returns pending data followed by view"""
+        if not self._pending:
+            return view
+        self._pending.append(view)
+        data = memoryview(b"".join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+        return data
+
+    def _loads(self, data):
         try:
-            part = json.loads(json_part)
+            return codec.loads(data)
         except Exception:
             LOGGER.exception("exception when JSON-decoding body.")
-            LOGGER.error("%s", json_part)
+            LOGGER.error("%s", bytes(data[:1000]))
             raise
 
-        if "type" in part:
-            # Advance past the \n
-            end_index += 1
+    def _handle_line(self, line):
+        if line and line[-1] == CR:
+            line = line[:-1]
 
-            start_index = end_index
-            read_length = part.get("length", -1)
-            if read_length != -1:
-                # NOTE(willkg): This will include the newline separater at the end
-                end_index = end_index + read_length
-            else:
-                end_index = get_newline_index(body, start_index, end_index)
+        if self.envelope_header is None:
+            self.envelope_header = self._loads(line)
+            return None
 
-            # NOTE(willkg): This drops the newline separator because it's not
-            # part of the Item body
-            item_body = body[start_index:end_index]
+        if self._header is None:
+            # Skip blank lines between items
+            if not line:
+                return None
+            header = self._loads(line)
+            if not isinstance(header, dict) or "type" not in header:
+                raise ValueError(f"item header has no type: {bytes(line[:1000])!r}")
+            length = header.get("length")
+            if length is not None and (not isinstance(length, int) or length < 0):
+                raise ValueError(f"item header has a bad length: {length!r}")
+            self._header = header
+            self._length = length
+            return None
 
-            if part.get("type") == "attachment":
-                yield Item(
-                    envelope_header=envelope_header,
-                    header=part,
-                    body=item_body,
-                )
+        # Body of an item without a length
+        return self._make_item(line)
 
+    def _make_item(self, body):
+        header = self._header
+        self._header = None
+        if self._length is not None:
+            self._length = None
+            self._skip_newline = True
+
+        size = len(body)
+        if header.get("type") != "attachment":
+            if self.decode:
+                body = self._loads(body)
             else:
-                item_body_data = json.loads(item_body)
-                yield Item(
-                    envelope_header=envelope_header, header=part, body=item_body_data
-                )
-
-            # Advance past the \n
-            end_index += 1
-            continue
+                if not looks_like_json(body):
+                    LOGGER.error("item body is not JSON: %r", bytes(body[:1000]))
+                    raise ValueError("item body is not JSON")
+                body = body.tobytes()
+
+        return Item(
+            envelope_header=self.envelope_header,
+            header=header,
+            body=body,
+            size=size,
+        )
+
+
+def parse_envelope(body, decode=True):
+    """Parses an envelope payload into items
+
+    :arg body: the envelope payload body
+    :arg decode: if True, non-attachment item bodies are JSON-decoded; if
+        False, they're left as bytes and only checked with ``looks_like_json``
+
+    :returns: generator of items; see ``EnvelopeParser``
+
+    """
+    parser = EnvelopeParser(decode=decode)
+    yield from parser.feed(body)
+    yield from parser.close()
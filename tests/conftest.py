@@ -0,0 +1,16 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def flush_logs():
+    # Logs are written in a background thread; write them before the test ends
+    # so they're captured with the test's output
+    yield
+    for handler in logging.getLogger().handlers:
+        handler.flush()
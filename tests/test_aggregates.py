@@ -0,0 +1,129 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+from kent.aggregates import Aggregates, ItemPolicy, parse_item_policies
+
+
+def test_parse_item_policies():
+    assert parse_item_policies("") == {}
+    assert parse_item_policies(
+        " session=aggregate, transaction=sample:0.25,client_report=drop,"
+    ) == {
+        "session": ItemPolicy("aggregate"),
+        "transaction": ItemPolicy("store", 0.25),
+        "client_report": ItemPolicy("drop"),
+    }
+    assert parse_item_policies({"event": "store"}) == {"event": ItemPolicy("store")}
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "session",
+        "session=keep",
+        "transaction=sample",
+        "transaction=sample:2",
+        "a=drop:1",
+    ],
+)
+def test_parse_item_policies_invalid(value):
+    with pytest.raises(ValueError):
+        parse_item_policies(value)
+
+
+def test_sample_policy():
+    policy = ItemPolicy.parse("sample:0.5")
+    actions = [policy.get_action() for _ in range(200)]
+    assert set(actions) == {"store", "drop"}
+    assert ItemPolicy.parse("sample:0").get_action() == "drop"
+    assert ItemPolicy.parse("sample:1").get_action() == "store"
+
+
+def encode(data):
+    return json.dumps(data).encode("utf-8")
+
+
+class TestAggregates:
+    def test_count(self):
+        aggregates = Aggregates()
+        aggregates.count(1, "transaction", "store")
+        aggregates.count(1, "transaction", "drop")
+        aggregates.count(1, "transaction", "drop")
+        assert aggregates.get(1)["items"] == {
+            "transaction": {"stored": 1, "aggregated": 0, "dropped": 2}
+        }
+
+    def test_sessions(self):
+        aggregates = Aggregates()
+        for body in [
+            {"sid": "a", "init": True, "status": "ok"},
+            {"sid": "a", "status": "exited", "errors": 0},
+            {"sid": "b", "init": True, "status": "ok", "errors": 1},
+            {"sid": "b", "status": "exited", "errors": 1},
+            {"sid": "c", "init": True, "status": "crashed"},
+        ]:
+            aggregates.add(1, "session", encode(body))
+        aggregates.add(
+            1,
+            "sessions",
+            encode(
+                {
+                    "aggregates": [
+                        {"started": "2024-01-01T00:00:00Z", "exited": 3},
+                        {"started": "2024-01-01T00:01:00Z", "abnormal": 1},
+                    ]
+                }
+            ),
+        )
+        assert aggregates.get(1)["sessions"] == {
+            "started": 7,
+            "exited": 4,
+            "errored": 1,
+            "crashed": 1,
+            "abnormal": 1,
+        }
+
+    def test_client_reports(self):
+        aggregates = Aggregates()
+        body = {
+            "timestamp": "2024-01-01T00:00:00Z",
+            "discarded_events": [
+                {"reason": "queue_overflow", "category": "error", "quantity": 2},
+                {
+                    "reason": "ratelimit_backoff",
+                    "category": "transaction",
+                    "quantity": 5,
+                },
+                {"reason": "bad", "category": "error", "quantity": "lots"},
+            ],
+        }
+        aggregates.add(1, "client_report", encode(body))
+        aggregates.add(1, "client_report", encode(body))
+        assert aggregates.get(1)["client_reports"] == {
+            "discarded_events": {
+                "queue_overflow:error": 4,
+                "ratelimit_backoff:transaction": 10,
+            }
+        }
+
+    def test_bad_bodies(self):
+        aggregates = Aggregates()
+        aggregates.add(1, "session", b"not json")
+        aggregates.add(1, "client_report", b"[]")
+        aggregates.add(1, "profile", b"{}")
+        assert aggregates.get() == {}
+
+    def test_flush(self):
+        aggregates = Aggregates()
+        aggregates.count(1, "session", "aggregate")
+        aggregates.count(2, "session", "aggregate")
+        aggregates.flush(project_id=1)
+        assert list(aggregates.get()) == ["2"]
+        assert aggregates.get(1)["items"] == {}
+        aggregates.flush()
+        assert aggregates.get() == {}
@@ -2,10 +2,35 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import pytest
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import json
+import logging
+import threading
+import time
 import uuid
+import zlib
+
+import pytest
 
-from kent.app import create_app, Event
+from kent.app import (
+    create_app,
+    Event,
+    EventManager,
+    EVENTS,
+    get_max_body_bytes,
+    INGEST,
+)
+from kent.decoders import DECODERS, register_decoder
+from kent.events import (
+    BODY_CACHE,
+    compile_path,
+    DECODE_ERROR_BODY,
+    get_path,
+    get_terms,
+    JSON_CACHE,
+)
 
 
 @pytest.fixture
@@ -50,6 +75,456 @@ class TestEvent:
         )
         assert event.summary == expected
 
+    def test_fields_extracted_once(self):
+        event = Event(
+            project_id=1,
+            event_id="abc",
+            header={"type": "event"},
+            raw_body=json.dumps(SENTRY_SDK_1_45_0_ERROR).encode("utf-8"),
+        )
+        assert event.item_type == "event"
+        assert event.summary == "test error capture"
+        assert event.timestamp == "2024-05-19T02:22:32.086845Z"
+        assert event.sdk_name == "sentry.python.flask"
+        assert event.sdk_version == "1.45.0"
+        assert event.release == "2667f04c7246db93ecbc175cf7a2534ad412154e"
+        assert event.environment == "production"
+
+    @pytest.mark.parametrize(
+        "tags",
+        [
+            {"color": "blue", "count": 5},
+            [["color", "blue"], ["count", 5]],
+        ],
+    )
+    def test_search_fields(self, tags):
+        event = Event(
+            project_id=1,
+            event_id="abc",
+            body={
+                "exception": {
+                    "values": [
+                        {"type": "KeyError", "value": "'a'"},
+                        {"type": "ValueError", "value": "b"},
+                    ]
+                },
+                "tags": tags,
+            },
+        )
+        assert event.exception_types == ("KeyError", "ValueError")
+        assert event.tags == {"color": "blue", "count": "5"}
+        assert sorted(get_terms(event)) == [
+            ("exception_type", "KeyError"),
+            ("exception_type", "ValueError"),
+            ("item_type", "event"),
+            ("tag:color", "blue"),
+            ("tag:count", "5"),
+        ]
+
+    def test_timestamp_is_stable(self):
+        event = Event(project_id=1, event_id="abc", body={"message": "hi"})
+        timestamp = event.timestamp
+        time.sleep(0.01)
+        assert event.timestamp == timestamp
+
+    def test_fields_passed_in(self):
+        # Storage backends pass in fields they kept so the body isn't needed
+        event = Event(
+            project_id=1,
+            event_id="abc",
+            raw_body=b"{}",
+            summary="stored summary",
+            timestamp="2024-05-19T02:22:32Z",
+        )
+        assert event.summary == "stored summary"
+        assert BODY_CACHE.get(event) is None
+
+    def test_raw_body_is_decoded_lazily(self):
+        event = Event(project_id=1, event_id="abc", raw_body=b'{"message": "hi"}')
+        assert event.body == {"message": "hi"}
+        assert BODY_CACHE.get(event) == {"message": "hi"}
+        assert event.summary == "hi"
+
+    @pytest.mark.parametrize(
+        "encoding, compress",
+        [("gzip", gzip.compress), ("deflate", zlib.compress)],
+    )
+    def test_compressed_raw_body(self, encoding, compress):
+        raw_body = compress(b'{"message": "hi"}')
+        event = Event(
+            project_id=1, event_id="abc", raw_body=raw_body, encoding=encoding
+        )
+        assert event.get_raw_body() == b'{"message": "hi"}'
+        assert event.body == {"message": "hi"}
+
+    def test_to_json_is_cached(self):
+        event = Event(project_id=1, event_id="abc", seq=1, body={"message": "hi"})
+        data = event.to_json()
+        assert json.loads(data) == event.to_dict()
+        assert JSON_CACHE.get(("abc", 1)) is data
+        assert event.to_json() is data
+
+    @pytest.mark.parametrize("body", [{"message": "hi"}, b"\x00attachment", None])
+    def test_export_round_trip(self, body):
+        event = Event(
+            project_id=1,
+            event_id="abc",
+            envelope_header={"event_id": "abc"},
+            header={"type": "event"},
+            body=body,
+            size=10,
+            received=1000.0,
+        )
+        data = json.loads(json.dumps(event.to_export()))
+        imported = Event.from_export(data)
+        assert imported.to_dict() == event.to_dict()
+        assert imported.size == 10
+        assert imported.received == 1000.0
+        assert imported.summary == event.summary
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {},
+            {"project_id": 1, "event_id": "abc"},
+            {"project_id": 1, "event_id": "abc", "payload": {"body_base64": "!"}},
+        ],
+    )
+    def test_from_export_bad_data(self, data):
+        with pytest.raises(ValueError):
+            Event.from_export(data)
+
+    def test_raw_body_decode_error(self):
+        event = Event(project_id=1, event_id="abc", raw_body=b'{"message": }')
+        assert event.body == DECODE_ERROR_BODY
+        assert event.summary == DECODE_ERROR_BODY["error"]
+
+
+def test_compile_path():
+    assert compile_path("exception.values.[0].type") == (
+        "exception",
+        "values",
+        0,
+        "type",
+    )
+    assert compile_path("tags") == ("tags",)
+    with pytest.raises(ValueError):
+        compile_path("exception.values.[first]")
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("exception.values.[0].type", "KeyError"),
+        ("exception.values.[-1].type", "KeyError"),
+        ("exception.values.[1].type", None),
+        ("exception.values.type", None),
+        ("tags", {"color": "blue"}),
+        ("tags.color.shade", None),
+        ("missing", None),
+    ],
+)
+def test_get_path(path, expected):
+    body = {
+        "exception": {"values": [{"type": "KeyError"}]},
+        "tags": {"color": "blue"},
+    }
+    assert get_path(body, compile_path(path)) == expected
+
+
+class TestEventManager:
+    def test_add_and_get(self):
+        manager = EventManager()
+        event = manager.add_event(event_id="abc", project_id=1, body={})
+        assert manager.get_event("abc") is event
+        assert manager.get_event("def") is None
+
+    def test_evicts_oldest(self):
+        manager = EventManager(max_events=3)
+        for i in range(5):
+            manager.add_event(event_id=str(i), project_id=1, body={})
+
+        assert [event.event_id for event in manager.get_events()] == ["2", "3", "4"]
+        assert manager.get_event("0") is None
+        assert manager.get_event("1") is None
+        assert manager.get_event("4").event_id == "4"
+
+    def test_evicts_by_bytes(self):
+        manager = EventManager(max_bytes=100)
+        for i in range(5):
+            manager.add_event(event_id=str(i), project_id=1, body={}, size=40)
+
+        assert [event.event_id for event in manager.get_events()] == ["3", "4"]
+        assert manager.get_event("2") is None
+        assert manager.get_usage() == {
+            "events": 2,
+            "max_events": 100,
+            "bytes": 80,
+            "max_bytes": 100,
+            "max_project_bytes": None,
+            "projects": {1: {"events": 2, "bytes": 80}},
+        }
+
+    def test_byte_limit_is_for_all_projects(self):
+        manager = EventManager(max_bytes=100, max_project_bytes=60)
+        manager.add_event(event_id="old", project_id=1, body={}, size=40)
+        for i in range(3):
+            manager.add_event(event_id=str(i), project_id=i + 2, body={}, size=30)
+
+        # New projects push out the oldest events of any project
+        assert [event.event_id for event in manager.get_events()] == ["0", "1", "2"]
+
+        # Projects also have their own limit
+        manager.add_event(event_id="new", project_id=2, body={}, size=40)
+        assert [event.event_id for event in manager.get_events(project_id=2)] == ["new"]
+        assert manager.get_usage()["bytes"] == 100
+
+    def test_keeps_newest_event_over_budget(self):
+        manager = EventManager(max_bytes=10)
+        manager.add_event(event_id="small", project_id=1, body={}, size=5)
+        manager.add_event(event_id="big", project_id=1, body={}, size=50)
+        assert [event.event_id for event in manager.get_events()] == ["big"]
+
+    def test_estimates_size(self):
+        manager = EventManager()
+        event = manager.add_event(event_id="abc", project_id=1, body={"a": 1})
+        assert event.size == len(b'{"a":1}')
+        event = manager.add_event(event_id="def", project_id=1, body=b"12345")
+        assert event.size == 5
+
+    def test_projects_have_separate_caps(self):
+        manager = EventManager(max_events=2)
+        manager.add_event(event_id="quiet", project_id=1, body={})
+        for i in range(5):
+            manager.add_event(event_id=f"noisy{i}", project_id=2, body={})
+
+        assert [event.event_id for event in manager.get_events(project_id=1)] == [
+            "quiet"
+        ]
+        assert [event.event_id for event in manager.get_events(project_id=2)] == [
+            "noisy3",
+            "noisy4",
+        ]
+        assert manager.get_events(project_id=3) == []
+
+    def test_get_events_keeps_insertion_order(self):
+        manager = EventManager()
+        for i, project_id in enumerate([1, 2, 1, 3, 2]):
+            manager.add_event(event_id=str(i), project_id=project_id, body={})
+
+        assert [event.event_id for event in manager.get_events()] == [
+            "0",
+            "1",
+            "2",
+            "3",
+            "4",
+        ]
+
+    def test_flush_project(self):
+        manager = EventManager()
+        manager.add_event(event_id="abc", project_id=1, body={})
+        manager.add_event(event_id="def", project_id=2, body={})
+        manager.flush(project_id=1)
+        assert manager.get_event("abc") is None
+        assert [event.event_id for event in manager.get_events()] == ["def"]
+
+    def test_concurrent_add_event(self):
+        manager = EventManager(max_events=50)
+        num_threads = 8
+        per_thread = 500
+        barrier = threading.Barrier(num_threads)
+
+        def add_events(thread_num):
+            barrier.wait()
+            for i in range(per_thread):
+                manager.add_event(
+                    event_id=f"{thread_num}-{i}", project_id=thread_num % 3, body={}
+                )
+                if i % 50 == 0:
+                    manager.get_events()
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(add_events, range(num_threads)))
+
+        events = manager.get_events()
+        assert len(events) == 150
+        assert [event.seq for event in events] == sorted(event.seq for event in events)
+        for event in events:
+            assert manager.get_event(event.event_id) is event
+
+    def test_flush(self):
+        manager = EventManager()
+        manager.add_event(event_id="abc", project_id=1, body={})
+        manager.flush()
+        assert manager.get_events() == []
+        assert manager.get_event("abc") is None
+
+    def test_get_events_since(self):
+        manager = EventManager()
+        manager.add_event(event_id="abc", project_id=1, body={})
+        cursor = manager.get_cursor()
+        manager.add_event(event_id="def", project_id=2, body={})
+        manager.add_event(event_id="ghi", project_id=1, body={})
+
+        events, next_cursor = manager.get_events_since(cursor)
+        assert [event.event_id for event in events] == ["def", "ghi"]
+        assert manager.get_events_since(next_cursor) == ([], next_cursor)
+
+        events, _ = manager.get_events_since(cursor, project_id=1)
+        assert [event.event_id for event in events] == ["ghi"]
+
+    def test_get_events_since_limit(self):
+        manager = EventManager()
+        for event_id in ["abc", "def", "ghi"]:
+            manager.add_event(event_id=event_id, project_id=1, body={})
+
+        events, cursor = manager.get_events_since(0, limit=2)
+        assert [event.event_id for event in events] == ["abc", "def"]
+        assert cursor == events[-1].seq
+
+        events, cursor = manager.get_events_since(cursor, limit=2)
+        assert [event.event_id for event in events] == ["ghi"]
+        assert cursor == manager.get_cursor()
+
+    def test_wait_for_events_wakes_up(self):
+        manager = EventManager()
+        cursor = manager.get_cursor()
+
+        def add_event():
+            time.sleep(0.1)
+            manager.add_event(event_id="abc", project_id=1, body={})
+
+        thread = threading.Thread(target=add_event)
+        thread.start()
+        start = time.monotonic()
+        events, _ = manager.wait_for_events(cursor, timeout=10)
+        thread.join()
+
+        assert [event.event_id for event in events] == ["abc"]
+        assert time.monotonic() - start < 5
+
+    def test_wait_for_events_project(self):
+        manager = EventManager()
+        cursor = manager.get_cursor()
+
+        def add_events():
+            time.sleep(0.1)
+            manager.add_event(event_id="abc", project_id=1, body={})
+            time.sleep(0.1)
+            manager.add_event(event_id="def", project_id=2, body={})
+
+        thread = threading.Thread(target=add_events)
+        thread.start()
+        events, _ = manager.wait_for_events(cursor, project_id=2, timeout=10)
+        thread.join()
+
+        assert [event.event_id for event in events] == ["def"]
+
+    def test_subscribe(self):
+        manager = EventManager()
+        everything = manager.subscribe()
+        project = manager.subscribe(project_id=2)
+        manager.add_event(event_id="abc", project_id=1, body={})
+        manager.add_event(event_id="def", project_id=2, body={})
+
+        assert [event.event_id for event in everything.drain()] == ["abc", "def"]
+        assert [event.event_id for event in project.drain()] == ["def"]
+
+        manager.unsubscribe(everything)
+        manager.add_event(event_id="ghi", project_id=2, body={})
+        assert everything.drain() == []
+        assert [event.event_id for event in project.drain()] == ["ghi"]
+
+    def test_subscription_drops_events_when_full(self):
+        manager = EventManager()
+        manager.SUBSCRIBER_QUEUE_SIZE = 2
+        subscription = manager.subscribe()
+        events = [
+            manager.add_event(event_id=str(i), project_id=1, body={}) for i in range(4)
+        ]
+
+        assert [event.event_id for event in subscription.drain()] == ["0", "1"]
+        assert subscription.missed == events[-1].seq
+
+    def test_wait_for_events_timeout(self):
+        manager = EventManager()
+        manager.add_event(event_id="abc", project_id=1, body={})
+        cursor = manager.get_cursor()
+
+        start = time.monotonic()
+        assert manager.wait_for_events(cursor, timeout=0.1) == ([], cursor)
+        assert time.monotonic() - start >= 0.1
+
+
+def test_max_events_config():
+    app = create_app({"TESTING": True, "KENT_MAX_EVENTS": 2})
+    with app.test_client() as client:
+        for _ in range(3):
+            client.post("/api/1/store/", json={"message": "hi"})
+        resp = client.get("/api/eventlist/")
+        assert len(resp.json["events"]) == 2
+
+
+def test_api_usage_view(client):
+    body = b'{"message": "hi"}'
+    client.post("/api/1/store/", data=body, content_type="application/json")
+    resp = client.get("/api/usage/")
+    assert resp.json == {
+        "events": 1,
+        "max_events": 100,
+        "bytes": len(body),
+        "max_bytes": None,
+        "max_project_bytes": None,
+        "projects": {"1": {"events": 1, "bytes": len(body)}},
+    }
+
+
+def test_sqlite_storage_config(tmp_path):
+    config = {
+        "TESTING": True,
+        "KENT_STORAGE": "sqlite",
+        "KENT_STORAGE_PATH": str(tmp_path / "kent.db"),
+    }
+    # Two apps stand in for two workers sharing the database
+    app = create_app(config)
+    with app.test_client() as client:
+        client.post("/api/1/store/", json={"message": "hi"})
+
+    app = create_app(config)
+    with app.test_client() as client:
+        resp = client.get("/api/eventlist/")
+        assert [event["summary"] for event in resp.json["events"]] == ["hi"]
+        event_id = resp.json["events"][0]["event_id"]
+        resp = client.get(f"/api/event/{event_id}")
+        assert resp.json["payload"]["body"] == {"message": "hi"}
+
+
+def test_log_storage_config(tmp_path):
+    config = {
+        "TESTING": True,
+        "KENT_STORAGE": "log",
+        "KENT_STORAGE_PATH": str(tmp_path),
+        "KENT_LOG_SEGMENT_BYTES": 1000,
+    }
+    app = create_app(config)
+    with app.test_client() as client:
+        for i in range(10):
+            client.post("/api/1/store/", json={"message": f"hi {i}"})
+
+    # A new app stands in for restarting Kent
+    app = create_app(config)
+    with app.test_client() as client:
+        resp = client.get("/api/eventlist/")
+        assert [event["summary"] for event in resp.json["events"]] == [
+            f"hi {i}" for i in range(10)
+        ]
+        event_id = resp.json["events"][0]["event_id"]
+        resp = client.get(f"/api/event/{event_id}")
+        assert resp.json["payload"]["body"] == {"message": "hi 0"}
+
+    # Switch back to memory storage so the log gets closed
+    create_app({"TESTING": True})
+
 
 def test_index_view(client):
     resp = client.get("/")
@@ -128,6 +603,152 @@ def test_store_view(client):
     assert resp.status_code == 200
 
 
+def test_store_view_keeps_raw_body(client):
+    data = b'{"message": "hi"}'
+    resp = client.post(
+        "/api/1/store/",
+        headers={"Content-Encoding": "gzip"},
+        data=gzip.compress(data),
+        content_type="application/json",
+    )
+    assert resp.status_code == 200
+
+    [event] = EVENTS.get_events()
+    assert event.get_raw_body() == data
+    assert event.body == {"message": "hi"}
+
+
+def test_store_view_keeps_compressed_body():
+    app = create_app({"TESTING": True, "KENT_KEEP_COMPRESSED": True})
+    compressed = gzip.compress(b'{"message": "hi"}')
+    with app.test_client() as client:
+        client.post(
+            "/api/1/store/",
+            headers={"Content-Encoding": "gzip"},
+            data=compressed,
+            content_type="application/json",
+        )
+
+    [event] = EVENTS.get_events()
+    assert event._raw_body == compressed
+    assert event.size == len(b'{"message": "hi"}')
+    assert event.summary == "hi"
+    # Fields were extracted without decompressing or decoding the raw body
+    assert BODY_CACHE.get(event) is None
+    assert event.body == {"message": "hi"}
+
+
+class TestContentEncoding:
+    @pytest.mark.parametrize("view", ["store", "envelope", "security"])
+    def test_unsupported(self, client, view):
+        resp = client.post(
+            f"/api/1/{view}/",
+            data=b"{}",
+            content_type="application/json",
+            headers={"Content-Encoding": "compress"},
+        )
+        assert resp.status_code == 415
+        assert resp.json == {"error": "Unsupported Content-Encoding: compress"}
+        assert EVENTS.get_events() == []
+
+    def test_registered_decoder(self, client):
+        register_decoder("x-test", DECODERS["gzip"])
+        try:
+            resp = client.post(
+                "/api/1/security/",
+                data=gzip.compress(b'{"csp-report": {"document-uri": "x"}}'),
+                content_type="application/json",
+                headers={"Content-Encoding": "x-test"},
+            )
+        finally:
+            del DECODERS["x-test"]
+        assert resp.status_code == 200
+        assert len(EVENTS.get_events()) == 1
+
+
+class TestPayloadLimits:
+    @pytest.fixture
+    def client(self):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_MAX_COMPRESSED_BYTES": 1000,
+                "KENT_MAX_DECOMPRESSED_BYTES": 10_000,
+            }
+        )
+        with app.test_client() as client:
+            yield client
+
+    @pytest.mark.parametrize("view", ["store", "envelope", "security"])
+    def test_too_large(self, client, view):
+        resp = client.post(
+            f"/api/1/{view}/",
+            data=b"{" + b" " * 1000 + b"}",
+            content_type="application/json",
+        )
+        assert resp.status_code == 413
+        assert resp.json == {"error": "body is larger than 1000 bytes"}
+        assert EVENTS.get_events() == []
+
+    def test_too_large_chunked(self, client):
+        # Without a Content-Length, the limit is checked while reading
+        resp = client.post(
+            "/api/1/store/",
+            input_stream=io.BytesIO(b"{" + b" " * 2000 + b"}"),
+            content_type="application/json",
+            headers={"Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},
+        )
+        assert resp.status_code == 413
+
+    @pytest.mark.parametrize("view", ["store", "envelope"])
+    def test_decompressed_too_large(self, client, view):
+        data = gzip.compress(b"{" + b" " * 20_000 + b"}")
+        assert len(data) < 1000
+        resp = client.post(
+            f"/api/1/{view}/",
+            data=data,
+            content_type="application/json",
+            headers={"Content-Encoding": "gzip"},
+        )
+        assert resp.status_code == 413
+        assert resp.json == {"error": "decompressed body is larger than 10000 bytes"}
+        assert EVENTS.get_events() == []
+
+    def test_under_limits(self, client):
+        data = gzip.compress(b'{"message": "hi"' + b" " * 9000 + b"}")
+        resp = client.post(
+            "/api/1/store/",
+            data=data,
+            content_type="application/json",
+            headers={"Content-Encoding": "gzip"},
+        )
+        assert resp.status_code == 200
+        assert EVENTS.get_events()[0].summary == "hi"
+
+    @pytest.mark.parametrize(
+        "method, path, expected",
+        [
+            ("POST", "/api/1/store/", 1000),
+            ("POST", "/api/1/envelope/", 1000),
+            ("POST", "/api/1/security/", 1000),
+            ("POST", "/api/import/", None),
+            ("GET", "/api/1/store/", None),
+            ("POST", "/nonexistent/", None),
+        ],
+    )
+    def test_get_max_body_bytes(self, client, method, path, expected):
+        assert get_max_body_bytes(client.application, method, path) == expected
+
+
+def test_store_view_not_json(client):
+    with pytest.raises(ValueError):
+        client.post("/api/1/store/", data=b"not json", content_type="text/plain")
+
+    [event] = EVENTS.get_events()
+    assert event.body == DECODE_ERROR_BODY
+
+
 def test_envelope_view(client):
     resp = client.post(
         "/api/1/envelope/",
@@ -271,6 +892,571 @@ def test_security_view(client):
     assert resp.status_code == 200
 
 
+def test_security_view_multiple_reports(client):
+    resp = client.post("/api/1/security/", json=CSP_REPORT_NEW * 2)
+    assert resp.status_code == 200
+
+    resp = client.get("/api/eventlist/")
+    event_ids = [event["event_id"] for event in resp.json["events"]]
+    assert len(set(event_ids)) == 2
+    for event_id in event_ids:
+        assert client.get(f"/api/event/{event_id}").status_code == 200
+
+
+class TestEventLog:
+    def get_records(self, caplog):
+        return [record for record in caplog.records if record.name == "kent.ingest"]
+
+    def test_one_record_per_event(self, caplog):
+        app = create_app({"TESTING": True})
+        with caplog.at_level(logging.INFO), app.test_client() as client:
+            client.post(
+                "/api/1/store/",
+                json=SENTRY_SDK_1_45_0_ERROR,
+                headers={"User-Agent": "sentry.python/1.45.0", "X-Foo": "bar"},
+            )
+            client.post("/api/1/security/", json=CSP_REPORT_NEW * 2)
+
+        records = self.get_records(caplog)
+        assert len(records) == 3
+        [event] = EVENTS.get_events(project_id=1)[:1]
+        assert records[0].event == {
+            "event_id": event.event_id,
+            "project_id": 1,
+            "type": "event",
+            "sdk": "sentry.python.flask 1.45.0",
+            "summary": event.summary,
+            "url": f"http://localhost/api/event/{event.event_id}",
+            "headers": {"User-Agent": "sentry.python/1.45.0"},
+        }
+        assert event.event_id in records[0].getMessage()
+
+    def test_sampled(self, caplog):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_EVENT_LOG": "sampled",
+                "KENT_EVENT_LOG_SAMPLE_RATE": 0.5,
+            }
+        )
+        with caplog.at_level(logging.INFO), app.test_client() as client:
+            for _ in range(200):
+                client.post("/api/1/store/", json={})
+        assert 0 < len(self.get_records(caplog)) < 200
+
+    def test_off(self, caplog):
+        app = create_app({"TESTING": True, "KENT_EVENT_LOG": "off"})
+        with caplog.at_level(logging.INFO), app.test_client() as client:
+            client.post("/api/1/store/", json={})
+        assert self.get_records(caplog) == []
+        assert len(EVENTS.get_events()) == 1
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            create_app({"TESTING": True, "KENT_EVENT_LOG": "some"})
+
+    @pytest.mark.parametrize("view", ["store", "security"])
+    def test_body_is_only_formatted_for_debug(self, caplog, view):
+        app = create_app({"TESTING": True})
+
+        def body_records():
+            return [
+                record
+                for record in caplog.records
+                if record.name == app.logger.name and "marker" in repr(record.args)
+            ]
+
+        with app.test_client() as client:
+            with caplog.at_level(logging.INFO):
+                client.post(f"/api/1/{view}/", json={"marker": 1})
+            assert body_records() == []
+
+            with caplog.at_level(logging.DEBUG, logger=app.logger.name):
+                client.post(f"/api/1/{view}/", json={"marker": 1})
+        # The body is formatted when the record is, not when it's logged
+        [record] = body_records()
+        assert record.msg == "%s"
+        assert "marker" in record.getMessage()
+
+
+class TestIngestQueue:
+    @pytest.fixture
+    def app(self):
+        app = create_app(
+            {"TESTING": True, "KENT_INGEST_WORKERS": 2, "KENT_INGEST_QUEUE_SIZE": 5}
+        )
+        yield app
+        INGEST.configure()
+
+    def test_processes_bodies(self, app):
+        with app.test_client() as client:
+            resp = client.post("/api/1/store/", json={"message": "store"})
+            assert resp.status_code == 200
+            resp = client.post(
+                "/api/1/envelope/",
+                data=gzip.compress(b'{}\n{"type":"event"}\n{"message":"envelope"}\n'),
+                headers={"Content-Encoding": "gzip"},
+            )
+            assert resp.status_code == 200
+            resp = client.post("/api/1/security/", json=CSP_REPORT_NEW)
+            assert resp.status_code == 200
+
+            INGEST.join()
+            stats = client.get("/api/ingest/").json
+
+        assert sorted(event.summary for event in EVENTS.get_events()) == [
+            "csp-report: script-src",
+            "envelope",
+            "store",
+        ]
+        assert stats["workers"] == 2
+        assert stats["queue_depth"] == 0
+        assert stats["queue_size"] == 5
+        assert stats["accepted"] == 3
+        assert stats["processed"] == 3
+        assert stats["rejected"] == 0
+        assert stats["failed"] == 0
+        assert 0 < stats["lag"] <= stats["max_lag"]
+
+    def test_failed(self, app):
+        with app.test_client() as client:
+            resp = client.post(
+                "/api/1/store/", data=b"not json", content_type="text/plain"
+            )
+            assert resp.status_code == 200
+            INGEST.join()
+
+        assert INGEST.get_stats()["failed"] == 1
+        [event] = EVENTS.get_events()
+        assert event.body == DECODE_ERROR_BODY
+
+    def test_queue_full(self, app):
+        blocked = threading.Semaphore(0)
+        release = threading.Event()
+
+        def block():
+            blocked.release()
+            release.wait(timeout=5)
+
+        # Keep both workers busy and fill the queue
+        INGEST.submit(block)
+        INGEST.submit(block)
+        assert blocked.acquire(timeout=5)
+        assert blocked.acquire(timeout=5)
+        with app.test_client() as client:
+            for _ in range(10):
+                resp = client.post("/api/1/store/", json={})
+                if resp.status_code == 429:
+                    break
+            release.set()
+
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "1"
+        INGEST.join()
+        stats = INGEST.get_stats()
+        assert stats["rejected"] == 1
+        assert len(EVENTS.get_events()) == 5
+
+    def test_checks_before_queueing(self, app):
+        with app.test_client() as client:
+            resp = client.post(
+                "/api/1/store/", data=b"{}", headers={"Content-Encoding": "compress"}
+            )
+            assert resp.status_code == 415
+        app.config["KENT_MAX_COMPRESSED_BYTES"] = 10
+        with app.test_client() as client:
+            resp = client.post(
+                "/api/1/store/",
+                input_stream=io.BytesIO(b"{" + b" " * 20 + b"}"),
+                content_type="application/json",
+                environ_overrides={"wsgi.input_terminated": True},
+            )
+            assert resp.status_code == 413
+        assert INGEST.get_stats()["accepted"] == 0
+
+
+class TestRateLimits:
+    @pytest.fixture
+    def client(self):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_RATE_LIMITS": json.dumps(
+                    [
+                        {"rate": 0.001, "burst": 2, "project_id": 1},
+                        {"rate": 0.001, "categories": ["transaction"]},
+                    ]
+                ),
+            }
+        )
+        with app.test_client() as client:
+            yield client
+
+    def test_store(self, client):
+        for _ in range(2):
+            assert client.post("/api/1/store/", json={}).status_code == 200
+        resp = client.post("/api/1/store/", json={})
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "1000"
+        assert resp.headers["X-Sentry-Rate-Limits"] == "1000::project"
+
+        # Other projects have their own limits
+        assert client.post("/api/2/security/", json=CSP_REPORT_NEW).status_code == 200
+        assert len(EVENTS.get_events()) == 3
+
+    def test_envelope_items(self, client):
+        envelope = (
+            b"{}\n"
+            + b'{"type":"transaction"}\n{"transaction":"a"}\n'
+            + b'{"type":"event"}\n{"message":"b"}\n'
+        )
+        resp = client.post("/api/2/envelope/", data=envelope)
+        assert resp.status_code == 200
+        assert "X-Sentry-Rate-Limits" not in resp.headers
+
+        # The transaction is dropped and the error is kept
+        resp = client.post("/api/2/envelope/", data=envelope)
+        assert resp.status_code == 200
+        assert resp.headers["X-Sentry-Rate-Limits"] == "1000:transaction:project"
+        assert [event.item_type for event in EVENTS.get_events()] == [
+            "transaction",
+            "event",
+            "event",
+        ]
+
+        # If all the items are dropped, it's a 429
+        resp = client.post("/api/2/envelope/", data=b'{}\n{"type":"transaction"}\n{}\n')
+        assert resp.status_code == 429
+        assert resp.headers["X-Sentry-Rate-Limits"] == "1000:transaction:project"
+
+    def test_api(self, client):
+        client.post("/api/1/store/", json={})
+        resp = client.get("/api/ratelimits/")
+        assert resp.json == {
+            "limits": [
+                {"rate": 0.001, "burst": 2, "project_id": 1, "categories": []},
+                {
+                    "rate": 0.001,
+                    "burst": 1,
+                    "project_id": None,
+                    "categories": ["transaction"],
+                },
+            ],
+            "stats": {
+                "accepted": 1,
+                "rejected": 0,
+                "projects": {"1": {"accepted": 1, "rejected": 0}},
+                "categories": {"error": {"accepted": 1, "rejected": 0}},
+            },
+        }
+
+        resp = client.post("/api/ratelimits/", json={"limits": [{"rate": 1000}]})
+        assert resp.status_code == 200
+        assert resp.json["limits"] == [
+            {"rate": 1000, "burst": 1000, "project_id": None, "categories": []}
+        ]
+        assert resp.json["stats"]["accepted"] == 0
+        for _ in range(5):
+            assert client.post("/api/1/store/", json={}).status_code == 200
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            None,
+            {},
+            {"limits": {}},
+            {"limits": [{"rate": -1}]},
+            {"limits": [{"rate": 1, "categories": None}]},
+        ],
+    )
+    def test_api_invalid(self, client, data):
+        resp = client.post("/api/ratelimits/", json=data)
+        assert resp.status_code == 400
+        assert len(client.get("/api/ratelimits/").json["limits"]) == 2
+
+    def test_invalid_config(self):
+        with pytest.raises(ValueError):
+            create_app(
+                {
+                    "TESTING": True,
+                    "KENT_RATE_LIMITS": '[{"rate": 1, "categories": null}]',
+                }
+            )
+
+
+class TestItemPolicies:
+    ENVELOPE = (
+        b"{}\n"
+        + b'{"type":"event"}\n{"message":"error"}\n'
+        + b'{"type":"session"}\n{"sid":"a","init":true,"status":"exited"}\n'
+        + b'{"type":"client_report"}\n'
+        + b'{"discarded_events":[{"reason":"queue_overflow","category":"error",'
+        + b'"quantity":3}]}\n'
+        + b'{"type":"transaction"}\n{"transaction":"GET /"}\n'
+    )
+
+    @pytest.fixture
+    def client(self):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_ITEM_POLICIES": (
+                    "session=aggregate,client_report=aggregate,transaction=drop"
+                ),
+            }
+        )
+        with app.test_client() as client:
+            yield client
+
+    def test_envelope(self, client):
+        resp = client.post("/api/1/envelope/", data=self.ENVELOPE)
+        assert resp.status_code == 200
+
+        # Only the error is stored
+        assert [event.summary for event in EVENTS.get_events()] == ["error"]
+
+        resp = client.get("/api/1/aggregates/")
+        assert resp.json == {
+            "items": {
+                "event": {"stored": 1, "aggregated": 0, "dropped": 0},
+                "session": {"stored": 0, "aggregated": 1, "dropped": 0},
+                "client_report": {"stored": 0, "aggregated": 1, "dropped": 0},
+                "transaction": {"stored": 0, "aggregated": 0, "dropped": 1},
+            },
+            "sessions": {
+                "started": 1,
+                "exited": 1,
+                "errored": 0,
+                "crashed": 0,
+                "abnormal": 0,
+            },
+            "client_reports": {"discarded_events": {"queue_overflow:error": 3}},
+        }
+        assert list(client.get("/api/aggregates/").json["projects"]) == ["1"]
+
+    def test_flush(self, client):
+        client.post("/api/1/envelope/", data=self.ENVELOPE)
+        client.post("/api/2/envelope/", data=self.ENVELOPE)
+        client.post("/api/1/flush/")
+        assert list(client.get("/api/aggregates/").json["projects"]) == ["2"]
+        client.post("/api/flush/")
+        assert client.get("/api/aggregates/").json == {"projects": {}}
+
+    def test_default_stores_everything(self):
+        app = create_app({"TESTING": True})
+        with app.test_client() as client:
+            client.post("/api/1/envelope/", data=self.ENVELOPE)
+        assert len(EVENTS.get_events()) == 4
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            create_app({"TESTING": True, "KENT_ITEM_POLICIES": "session=keep"})
+
+
+class TestAttachments:
+    DATA = bytes(range(256)) * 4
+
+    @pytest.fixture
+    def client(self, tmp_path):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_ATTACHMENT_SPILL_BYTES": 100,
+                "KENT_ATTACHMENT_PATH": str(tmp_path),
+            }
+        )
+        with app.test_client() as client:
+            yield client
+
+    def post_attachment(self, client, data, project_id=1):
+        header = {
+            "type": "attachment",
+            "length": len(data),
+            "filename": "dump.bin",
+            "content_type": "application/x-dump",
+        }
+        resp = client.post(
+            f"/api/{project_id}/envelope/",
+            data=b"{}\n" + json.dumps(header).encode("utf-8") + b"\n" + data + b"\n",
+        )
+        assert resp.status_code == 200
+        return EVENTS.get_events()[-1]
+
+    def test_spill(self, client, tmp_path):
+        event = self.post_attachment(client, self.DATA)
+        ref = event.body["kent_attachment"]
+        assert ref["size"] == len(self.DATA)
+        assert (tmp_path / "1" / ref["id"]).read_bytes() == self.DATA
+
+        resp = client.get(f"/api/event/{event.event_id}")
+        assert resp.json["payload"]["body"] == event.body
+
+    def test_small_attachments_stay_in_memory(self, client, tmp_path):
+        event = self.post_attachment(client, b"\x00\xffhi")
+        assert event.body == b"\x00\xffhi"
+        assert list(tmp_path.iterdir()) == []
+
+        resp = client.get(f"/api/event/{event.event_id}")
+        assert resp.json["payload"]["body"] == {"kent_attachment": {"size": 4}}
+
+        resp = client.get(f"/api/event/{event.event_id}/attachment")
+        assert resp.status_code == 200
+        assert resp.data == b"\x00\xffhi"
+
+    def test_download(self, client):
+        event = self.post_attachment(client, self.DATA)
+        with client.get(f"/api/event/{event.event_id}/attachment") as resp:
+            assert resp.status_code == 200
+            assert resp.data == self.DATA
+            assert resp.headers["Content-Type"] == "application/x-dump"
+            assert resp.headers["Accept-Ranges"] == "bytes"
+            assert "dump.bin" in resp.headers["Content-Disposition"]
+
+    def test_download_range(self, client):
+        event = self.post_attachment(client, self.DATA)
+        url = f"/api/event/{event.event_id}/attachment"
+        with client.get(url, headers={"Range": "bytes=10-19"}) as resp:
+            assert resp.status_code == 206
+            assert resp.data == self.DATA[10:20]
+            assert resp.headers["Content-Range"] == f"bytes 10-19/{len(self.DATA)}"
+
+        with client.get(url, headers={"Range": f"bytes={len(self.DATA)}-"}) as resp:
+            assert resp.status_code == 416
+
+    def test_download_not_found(self, client):
+        resp = client.get(f"/api/event/{uuid.uuid4()}/attachment")
+        assert resp.status_code == 404
+
+        client.post("/api/1/store/", json={"message": "hi"})
+        event_id = EVENTS.get_events()[-1].event_id
+        resp = client.get(f"/api/event/{event_id}/attachment")
+        assert resp.status_code == 404
+
+    def test_flush(self, client, tmp_path):
+        self.post_attachment(client, self.DATA, project_id=1)
+        self.post_attachment(client, self.DATA, project_id=2)
+        client.post("/api/1/flush/")
+        assert list((tmp_path / "1").iterdir()) == []
+        assert len(list((tmp_path / "2").iterdir())) == 1
+
+        # Attachments that were removed are a 404
+        event = EVENTS.get_events()[-1]
+        client.post("/api/2/flush/")
+        EVENTS.add_event(
+            event_id=event.event_id,
+            project_id=event.project_id,
+            envelope_header=event.envelope_header,
+            header=event.header,
+            body=event.body,
+        )
+        resp = client.get(f"/api/event/{event.event_id}/attachment")
+        assert resp.status_code == 404
+
+    @pytest.mark.parametrize("storage", ["memory", "sqlite", "log"])
+    def test_evicted_attachments_are_removed(self, tmp_path, storage):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_MAX_EVENTS": 1,
+                "KENT_STORAGE": storage,
+                "KENT_STORAGE_PATH": (
+                    None if storage == "memory" else str(tmp_path / "events")
+                ),
+                "KENT_ATTACHMENT_SPILL_BYTES": 100,
+                "KENT_ATTACHMENT_PATH": str(tmp_path / "attachments"),
+            }
+        )
+        with app.test_client() as client:
+            self.post_attachment(client, self.DATA)
+            self.post_attachment(client, self.DATA)
+        [event] = EVENTS.get_events()
+        ref = event.body["kent_attachment"]
+        assert [path.name for path in (tmp_path / "attachments" / "1").iterdir()] == [
+            ref["id"]
+        ]
+
+    def test_dropped_attachments_are_removed(self, tmp_path):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_ATTACHMENT_SPILL_BYTES": 100,
+                "KENT_ATTACHMENT_PATH": str(tmp_path),
+                "KENT_ITEM_POLICIES": "attachment=drop",
+            }
+        )
+        with app.test_client() as client:
+            client.post(
+                "/api/1/envelope/",
+                data=b'{}\n{"type":"attachment","length":1024}\n' + self.DATA,
+            )
+        assert EVENTS.get_events() == []
+        assert list((tmp_path / "1").iterdir()) == []
+
+    def test_bad_envelope_removes_attachments(self, client, tmp_path):
+        with pytest.raises(ValueError):
+            client.post(
+                "/api/1/envelope/",
+                data=b'{}\n{"type":"attachment","length":1024}\n' + self.DATA + b"\n{",
+            )
+        assert EVENTS.get_events() == []
+        assert list((tmp_path / "1").iterdir()) == []
+
+    def test_spill_off(self, tmp_path):
+        app = create_app(
+            {
+                "TESTING": True,
+                "KENT_ATTACHMENT_SPILL_BYTES": None,
+                "KENT_ATTACHMENT_PATH": str(tmp_path),
+            }
+        )
+        with app.test_client() as client:
+            event = self.post_attachment(client, self.DATA)
+        assert event.body == self.DATA
+
+
+def test_concurrent_ingestion():
+    num_threads = 8
+    per_thread = 30
+    app = create_app({"TESTING": True, "KENT_MAX_EVENTS": 10000})
+    barrier = threading.Barrier(num_threads)
+    envelope = (
+        b'{"event_id":"b5a2369b82c7421eb5c118a3151da03e"}\n'
+        b'{"type":"event","content_type":"application/json"}\n'
+        b'{"message":"envelope"}\n'
+    )
+
+    def post_events(thread_num):
+        project_id = thread_num % 4
+        with app.test_client() as client:
+            barrier.wait()
+            for _ in range(per_thread):
+                resp = client.post(
+                    f"/api/{project_id}/store/", json=SENTRY_SDK_1_45_0_ERROR
+                )
+                assert resp.status_code == 200
+                resp = client.post(
+                    f"/api/{project_id}/envelope/",
+                    data=envelope,
+                    content_type="application/octet-stream",
+                )
+                assert resp.status_code == 200
+                resp = client.post(f"/api/{project_id}/security/", json=CSP_REPORT_NEW)
+                assert resp.status_code == 200
+                client.get("/api/eventlist/")
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(post_events, range(num_threads)))
+
+    with app.test_client() as client:
+        resp = client.get("/api/eventlist/")
+        events = resp.json["events"]
+        assert len(events) == num_threads * per_thread * 3
+        assert len({event["event_id"] for event in events}) == len(events)
+        for project_id in range(4):
+            resp = client.get(f"/api/{project_id}/eventlist/")
+            assert len(resp.json["events"]) == (num_threads // 4) * per_thread * 3
+
+
 def test_api_flush_view(client):
     resp = client.post("/api/flush/")
     assert resp.status_code == 200
@@ -280,7 +1466,7 @@ def test_api_flush_view(client):
 class TestAPIEventListView:
     def test_empty_eventlist(self, client):
         resp = client.get("/api/eventlist/")
-        assert resp.json == {"events": []}
+        assert resp.json == {"events": [], "cursor": 0}
 
     def test_nonempty_eventlist(self, client):
         # Store an event
@@ -293,7 +1479,507 @@ class TestAPIEventListView:
         assert resp.status_code == 200
 
         resp = client.get("/api/eventlist/")
-        assert len(resp.json) == 1
+        assert len(resp.json["events"]) == 1
+
+    def test_since_and_limit(self, client):
+        for i in range(5):
+            client.post("/api/1/store/", json={"message": str(i)})
+
+        resp = client.get("/api/eventlist/?limit=2")
+        assert [event["summary"] for event in resp.json["events"]] == ["0", "1"]
+
+        resp = client.get(f"/api/eventlist/?since={resp.json['cursor']}&limit=2")
+        assert [event["summary"] for event in resp.json["events"]] == ["2", "3"]
+
+        resp = client.get(f"/api/eventlist/?since={resp.json['cursor']}&limit=2")
+        assert [event["summary"] for event in resp.json["events"]] == ["4"]
+
+        # Nothing new since the last call
+        cursor = resp.json["cursor"]
+        resp = client.get(f"/api/eventlist/?since={cursor}")
+        assert resp.json == {"events": [], "cursor": cursor}
+
+        client.post("/api/1/store/", json={"message": "5"})
+        resp = client.get(f"/api/eventlist/?since={cursor}")
+        assert [event["summary"] for event in resp.json["events"]] == ["5"]
+
+    @pytest.mark.parametrize("query", ["since=abc", "limit=abc", "limit=0", "limit=-1"])
+    def test_bad_arguments(self, client, query):
+        resp = client.get(f"/api/eventlist/?{query}")
+        assert resp.status_code == 400
+
+
+class TestAPIProjectEventListView:
+    def test_only_project_events(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        client.post("/api/2/store/", json={"message": "two"})
+
+        resp = client.get("/api/2/eventlist/")
+        assert resp.status_code == 200
+        assert [event["summary"] for event in resp.json["events"]] == ["two"]
+
+    def test_since_and_limit(self, client):
+        for i in range(3):
+            client.post("/api/1/store/", json={"message": f"one{i}"})
+            client.post("/api/2/store/", json={"message": f"two{i}"})
+
+        resp = client.get("/api/2/eventlist/?limit=2")
+        assert [event["summary"] for event in resp.json["events"]] == ["two0", "two1"]
+
+        resp = client.get(f"/api/2/eventlist/?since={resp.json['cursor']}")
+        assert [event["summary"] for event in resp.json["events"]] == ["two2"]
+
+    def test_flush_project(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        client.post("/api/2/store/", json={"message": "two"})
+
+        resp = client.post("/api/2/flush/")
+        assert resp.json == {"success": True}
+
+        resp = client.get("/api/eventlist/")
+        assert [event["summary"] for event in resp.json["events"]] == ["one"]
+
+
+class TestAPISearchView:
+    @pytest.fixture
+    def events(self, client):
+        def exception_event(exc_type, sdk_version, **kwargs):
+            return {
+                "exception": {"values": [{"type": exc_type, "value": "oops"}]},
+                "sdk": {"name": "sentry.python", "version": sdk_version},
+                **kwargs,
+            }
+
+        client.post("/api/1/store/", json=exception_event("KeyError", "2.2.0"))
+        client.post(
+            "/api/3/store/",
+            json=exception_event(
+                "KeyError",
+                "2.1.0",
+                release="1.0",
+                environment="prod",
+                tags={"color": "blue"},
+            ),
+        )
+        client.post("/api/3/store/", json=exception_event("KeyError", "1.45.0"))
+        client.post("/api/3/store/", json=exception_event("ValueError", "2.2.0"))
+        client.post("/api/3/store/", json={"message": "hello"})
+
+    def search(self, client, query):
+        resp = client.get(f"/api/events/search/?{query}")
+        assert resp.status_code == 200
+        return [event["summary"] for event in resp.json["events"]]
+
+    def test_search(self, client, events):
+        assert len(self.search(client, "project_id=3&exception_type=KeyError")) == 2
+        assert (
+            len(
+                self.search(
+                    client,
+                    "project_id=3&exception_type=KeyError&sdk_name=sentry.python"
+                    "&sdk_version=2.*",
+                )
+            )
+            == 1
+        )
+        assert self.search(client, "exception_type=ValueError") == ["ValueError: oops"]
+        assert len(self.search(client, "release=1.0&environment=prod")) == 1
+        assert len(self.search(client, "tag=color:blue")) == 1
+        assert self.search(client, "tag=color:red") == []
+        assert len(self.search(client, "item_type=event")) == 5
+        assert self.search(client, "item_type=transaction") == []
+
+    def test_time_range(self, client, events):
+        assert len(self.search(client, "start=-60")) == 5
+        assert self.search(client, f"start={time.time() + 60}") == []
+        assert self.search(client, "end=2020-01-01T00:00:00Z") == []
+        assert len(self.search(client, "start=2020-01-01T00:00:00")) == 5
+
+    def test_pagination(self, client, events):
+        resp = client.get("/api/events/search/?exception_type=KeyError&limit=2")
+        assert len(resp.json["events"]) == 2
+        resp = client.get(
+            f"/api/events/search/?exception_type=KeyError&since={resp.json['cursor']}"
+        )
+        assert len(resp.json["events"]) == 1
+
+    @pytest.mark.parametrize(
+        "query", ["project_id=abc", "start=yesterday", "tag=color", "limit=0"]
+    )
+    def test_bad_arguments(self, client, query):
+        resp = client.get(f"/api/events/search/?{query}")
+        assert resp.status_code == 400
+
+
+class TestAPIWaitView:
+    def test_returns_existing_events(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        client.post("/api/2/store/", json={"message": "two"})
+
+        resp = client.get("/api/wait/?after=0")
+        assert resp.status_code == 200
+        assert [event["summary"] for event in resp.json["events"]] == ["one", "two"]
+
+        cursor = resp.json["cursor"]
+        resp = client.get(f"/api/wait/?after={cursor}&timeout=0")
+        assert resp.json == {"events": [], "cursor": cursor}
+
+    def test_waits_for_event(self, client):
+        def add_event():
+            time.sleep(0.1)
+            EVENTS.add_event(event_id="abc", project_id=1, body={"message": "one"})
+
+        thread = threading.Thread(target=add_event)
+        thread.start()
+        resp = client.get("/api/wait/?project_id=1&timeout=10")
+        thread.join()
+
+        assert resp.status_code == 200
+        assert resp.json["events"] == [
+            {"project_id": 1, "event_id": "abc", "summary": "one"}
+        ]
+
+    def test_detaches_from_server(self, client):
+        detached = []
+        resp = client.get(
+            "/api/wait/?timeout=0",
+            environ_base={"kent.detach": lambda: detached.append(True)},
+        )
+        assert resp.status_code == 200
+        assert detached == [True]
+
+    def test_bad_arguments(self, client):
+        resp = client.get("/api/wait/?after=abc")
+        assert resp.status_code == 400
+        resp = client.get("/api/wait/?timeout=abc")
+        assert resp.status_code == 400
+
+
+class TestAPIStreamView:
+    def read_events(self, chunks, count):
+        events = []
+        data = b""
+        for chunk in chunks:
+            data += chunk
+            *messages, data = data.split(b"\n\n")
+            for message in messages:
+                if message.startswith(b"id: "):
+                    id_line, data_line = message.decode("utf-8").splitlines()
+                    events.append((int(id_line[4:]), json.loads(data_line[6:])))
+            if len(events) >= count:
+                return events
+
+    def test_stream(self, client):
+        EVENTS.add_event(event_id="abc", project_id=1, body={"message": "one"})
+        resp = client.get("/api/stream/", buffered=False)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+        chunks = iter(resp.response)
+
+        # The stream starts with the next event
+        event = EVENTS.add_event(event_id="def", project_id=2, body={"message": "two"})
+        assert self.read_events(chunks, 1) == [
+            (event.seq, {"project_id": 2, "event_id": "def", "summary": "two"})
+        ]
+
+        resp.close()
+        assert EVENTS._subscriptions == ()
+
+    def test_project_and_cursor(self, client):
+        EVENTS.add_event(event_id="abc", project_id=1, body={})
+        EVENTS.add_event(event_id="def", project_id=2, body={})
+        resp = client.get("/api/stream/?project_id=1&after=0", buffered=False)
+        chunks = iter(resp.response)
+        EVENTS.add_event(event_id="ghi", project_id=2, body={})
+        EVENTS.add_event(event_id="jkl", project_id=1, body={})
+
+        events = self.read_events(chunks, 2)
+        assert [data["event_id"] for _, data in events] == ["abc", "jkl"]
+        resp.close()
+
+    def test_resume_from_last_event_id(self, client):
+        first = EVENTS.add_event(event_id="abc", project_id=1, body={})
+        EVENTS.add_event(event_id="def", project_id=1, body={})
+        resp = client.get(
+            "/api/stream/", headers={"Last-Event-ID": str(first.seq)}, buffered=False
+        )
+
+        events = self.read_events(iter(resp.response), 1)
+        assert [data["event_id"] for _, data in events] == ["def"]
+        resp.close()
+
+    def test_catches_up_after_falling_behind(self, client, monkeypatch):
+        monkeypatch.setattr(EVENTS, "SUBSCRIBER_QUEUE_SIZE", 2)
+        resp = client.get("/api/stream/", buffered=False)
+        chunks = iter(resp.response)
+        for i in range(5):
+            EVENTS.add_event(event_id=str(i), project_id=1, body={})
+
+        events = self.read_events(chunks, 5)
+        assert [data["event_id"] for _, data in events] == ["0", "1", "2", "3", "4"]
+        resp.close()
+
+    def test_detaches_from_server(self, client):
+        detached = []
+        resp = client.get(
+            "/api/stream/",
+            environ_base={"kent.detach": lambda: detached.append(True)},
+            buffered=False,
+        )
+        assert resp.status_code == 200
+        assert detached == [True]
+        resp.close()
+
+    def test_no_duplicates_after_falling_behind(self, client, monkeypatch):
+        monkeypatch.setattr(EVENTS, "SUBSCRIBER_QUEUE_SIZE", 2)
+        resp = client.get("/api/stream/", buffered=False)
+        chunks = iter(resp.response)
+        EVENTS.add_event(event_id="start", project_id=1, body={})
+        events = self.read_events(chunks, 1)
+        for i in range(2):
+            EVENTS.add_event(event_id=f"a{i}", project_id=1, body={})
+        events += self.read_events(chunks, 2)
+
+        # The subscriber's queue overflows
+        for i in range(5):
+            EVENTS.add_event(event_id=f"b{i}", project_id=1, body={})
+        events += self.read_events(chunks, 5)
+        assert [data["event_id"] for _, data in events] == [
+            "start",
+            "a0",
+            "a1",
+            "b0",
+            "b1",
+            "b2",
+            "b3",
+            "b4",
+        ]
+        resp.close()
+
+    def test_shared_storage(self, tmp_path):
+        config = {
+            "TESTING": True,
+            "KENT_STORAGE": "sqlite",
+            "KENT_STORAGE_PATH": str(tmp_path / "kent.db"),
+        }
+        # Another worker adds events to the same database without notifying
+        # this one
+        other = EventManager()
+        other.configure(storage="sqlite", path=config["KENT_STORAGE_PATH"])
+
+        app = create_app(config)
+        with app.test_client() as client:
+            resp = client.get("/api/stream/", buffered=False)
+            chunks = iter(resp.response)
+            EVENTS.add_event(event_id="abc", project_id=1, body={})
+            events = self.read_events(chunks, 1)
+            other.add_event(event_id="def", project_id=1, body={})
+            events += self.read_events(chunks, 1)
+            assert [data["event_id"] for _, data in events] == ["abc", "def"]
+            resp.close()
+
+    def test_bad_arguments(self, client):
+        resp = client.get("/api/stream/", headers={"Last-Event-ID": "abc"})
+        assert resp.status_code == 400
+
+
+class TestFields:
+    @pytest.fixture
+    def event_id(self, client):
+        client.post(
+            "/api/1/store/",
+            json={
+                "exception": {"values": [{"type": "KeyError", "value": "'a'"}]},
+                "tags": {"color": "blue"},
+                "breadcrumbs": {"values": [{"message": "crumb"}] * 100},
+            },
+        )
+        return EVENTS.get_events()[0].event_id
+
+    def test_event_view(self, client, event_id):
+        resp = client.get(
+            f"/api/event/{event_id}?fields=exception.values.[0].type,tags"
+            "&fields=release"
+        )
+        assert resp.status_code == 200
+        assert resp.json == {
+            "project_id": 1,
+            "event_id": event_id,
+            "fields": {
+                "exception.values.[0].type": "KeyError",
+                "tags": {"color": "blue"},
+                "release": None,
+            },
+        }
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "/api/eventlist/",
+            "/api/1/eventlist/",
+            "/api/events/search/?exception_type=KeyError",
+            "/api/wait/?after=0",
+        ],
+    )
+    def test_list_views(self, client, event_id, url):
+        sep = "&" if "?" in url else "?"
+        resp = client.get(f"{url}{sep}fields=tags.color")
+        assert resp.status_code == 200
+        assert resp.json["events"] == [
+            {
+                "project_id": 1,
+                "event_id": event_id,
+                "summary": "KeyError: 'a'",
+                "fields": {"tags.color": "blue"},
+            }
+        ]
+
+    def test_bad_path(self, client, event_id):
+        resp = client.get(f"/api/event/{event_id}?fields=exception.values.[x]")
+        assert resp.status_code == 400
+
+
+class TestExportImport:
+    def export(self, client, query="", **kwargs):
+        resp = client.get(f"/api/export/{query}", **kwargs)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        return resp
+
+    def test_export(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        client.post("/api/2/store/", json={"message": "two"})
+
+        lines = self.export(client).data.splitlines()
+        records = [json.loads(line) for line in lines]
+        assert [record["payload"]["body"] for record in records] == [
+            {"message": "one"},
+            {"message": "two"},
+        ]
+        assert records[0] == EVENTS.get_events()[0].to_export()
+
+        lines = self.export(client, "?project_id=2").data.splitlines()
+        assert [json.loads(line)["project_id"] for line in lines] == [2]
+
+    def test_export_in_batches(self, client, monkeypatch):
+        monkeypatch.setattr("kent.app.EXPORT_BATCH_SIZE", 2)
+        for i in range(5):
+            client.post("/api/1/store/", json={"message": str(i)})
+
+        lines = self.export(client).data.splitlines()
+        summaries = [json.loads(line)["payload"]["body"]["message"] for line in lines]
+        assert summaries == ["0", "1", "2", "3", "4"]
+
+    def test_export_gzip(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        resp = self.export(client, headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        [line] = gzip.decompress(resp.data).splitlines()
+        assert json.loads(line)["payload"]["body"] == {"message": "one"}
+
+    def test_import(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        client.post(
+            "/api/1/envelope/",
+            data=(
+                b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\n'
+                b'{"type":"attachment","length":4}\n'
+                b"\x00\xffhi\n"
+                b'{"type":"event","length":19}\n'
+                b'{"message":"hello"}\n'
+            ),
+        )
+        exported = self.export(client).data
+        expected = [event.to_dict() for event in EVENTS.get_events()]
+
+        client.post("/api/flush/")
+        resp = client.post("/api/import/", data=exported)
+        assert resp.status_code == 200
+        assert resp.json == {"success": True, "imported": 3, "skipped": 0}
+        assert [event.to_dict() for event in EVENTS.get_events()] == expected
+
+        # Events that are already there are skipped
+        resp = client.post("/api/import/", data=exported)
+        assert resp.json == {"success": True, "imported": 0, "skipped": 3}
+
+    def test_import_gzip(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        exported = self.export(client).data
+        client.post("/api/flush/")
+
+        resp = client.post(
+            "/api/import/",
+            data=gzip.compress(exported),
+            headers={"Content-Encoding": "gzip"},
+        )
+        assert resp.json["imported"] == 1
+        assert EVENTS.get_events()[0].summary == "one"
+
+    def test_import_bad_line(self, client):
+        client.post("/api/1/store/", json={"message": "one"})
+        exported = self.export(client).data
+        client.post("/api/flush/")
+
+        resp = client.post("/api/import/", data=exported + b"{not json\n")
+        assert resp.status_code == 400
+        assert resp.json["error"].startswith("line 2: ")
+        # Events before the bad line are imported
+        assert [event.summary for event in EVENTS.get_events()] == ["one"]
+
+    @pytest.mark.parametrize(
+        "data",
+        [
+            {"project_id": [1], "event_id": "abc", "payload": {}},
+            {"project_id": "1", "event_id": "abc", "payload": {}},
+            {"project_id": True, "event_id": "abc", "payload": {}},
+            {"project_id": 1, "event_id": {"a": 1}, "payload": {}},
+            {"project_id": 1, "event_id": "abc", "payload": []},
+            {"project_id": 1, "event_id": "abc", "payload": {"header": "x"}},
+            {"project_id": 1, "event_id": "abc", "payload": {}, "size": "10"},
+            {"project_id": 1, "event_id": "abc", "payload": {}, "received": "now"},
+            [1, 2],
+        ],
+    )
+    def test_import_bad_fields(self, client, data):
+        resp = client.post("/api/import/", data=json.dumps(data).encode("utf-8"))
+        assert resp.status_code == 400
+        assert resp.json["error"].startswith("line 1: ")
+        assert EVENTS.get_events() == []
+        assert client.get("/api/usage/").json["projects"] == {}
+
+    def test_import_unsupported_encoding(self, client):
+        resp = client.post(
+            "/api/import/", data=b"", headers={"Content-Encoding": "compress"}
+        )
+        assert resp.status_code == 415
+
+
+class TestETags:
+    @pytest.mark.parametrize("url", ["/", "/api/eventlist/", "/api/1/eventlist/"])
+    def test_not_modified(self, client, url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+
+        client.post("/api/1/store/", json={"message": "one"})
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        etag = resp.headers["ETag"]
+
+        client.post("/api/flush/")
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    def test_errors_have_no_etag(self, client):
+        resp = client.get("/api/eventlist/?limit=0")
+        assert resp.status_code == 400
+        assert "ETag" not in resp.headers
 
 
 class TestAPIEventView:
@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+
+from kent.attachments import AttachmentStore, get_attachment_ref
+
+
+def test_get_attachment_ref():
+    assert get_attachment_ref({"kent_attachment": {"id": "abc", "size": 1}}) == {
+        "id": "abc",
+        "size": 1,
+    }
+    assert get_attachment_ref({"message": "hi"}) is None
+    assert get_attachment_ref({"kent_attachment": "abc"}) is None
+    assert get_attachment_ref(b"data") is None
+
+
+def test_write_and_find(tmp_path):
+    store = AttachmentStore(path=str(tmp_path))
+    body = store.write(1, memoryview(b"some data"))
+    ref = get_attachment_ref(body)
+    assert ref["size"] == 9
+    assert store.total_bytes == 9
+
+    path = store.find(1, ref)
+    assert path == str(tmp_path / "1" / ref["id"])
+    with open(path, "rb") as fp:
+        assert fp.read() == b"some data"
+
+    # The reference is for a different project
+    assert store.find(2, ref) is None
+
+
+def test_find_bad_ids(tmp_path):
+    store = AttachmentStore(path=str(tmp_path))
+    (tmp_path / "secret").write_bytes(b"secret")
+    assert store.find(1, {"id": "../secret"}) is None
+    assert store.find(1, {"id": None}) is None
+    assert store.find(1, {}) is None
+
+
+def test_evicts_oldest(tmp_path):
+    store = AttachmentStore(path=str(tmp_path), max_bytes=25)
+    refs = [get_attachment_ref(store.write(1, b"x" * 10)) for _ in range(3)]
+    assert store.total_bytes == 20
+    assert store.find(1, refs[0]) is None
+    assert store.find(1, refs[1]) is not None
+    assert store.find(1, refs[2]) is not None
+
+    # An attachment that's bigger than the limit is kept until the next one
+    ref = get_attachment_ref(store.write(1, b"x" * 30))
+    assert store.find(1, ref) is not None
+    assert store.total_bytes == 30
+
+
+def test_delete_and_flush(tmp_path):
+    store = AttachmentStore(path=str(tmp_path))
+    ref1 = get_attachment_ref(store.write(1, b"one"))
+    ref2 = get_attachment_ref(store.write(2, b"two"))
+    ref3 = get_attachment_ref(store.write(2, b"three"))
+
+    store.delete(2, ref3["id"])
+    assert store.find(2, ref3) is None
+    assert store.total_bytes == 6
+
+    store.flush(project_id=1)
+    assert store.find(1, ref1) is None
+    assert store.find(2, ref2) is not None
+
+    store.flush()
+    assert store.find(2, ref2) is None
+    assert store.total_bytes == 0
+
+
+def test_load_existing_files(tmp_path):
+    store = AttachmentStore(path=str(tmp_path))
+    old = get_attachment_ref(store.write(1, b"x" * 10))
+    new = get_attachment_ref(store.write(2, b"x" * 10))
+    old_path = store.find(1, old)
+    os.utime(old_path, (0, 0))
+
+    # A new store picks up the files and evicts the oldest one first
+    store = AttachmentStore(path=str(tmp_path), max_bytes=15)
+    assert store.total_bytes == 20
+    store.write(2, b"x")
+    assert store.find(1, old) is None
+    assert store.find(2, new) is not None
+
+
+def test_temporary_directory():
+    store = AttachmentStore()
+    store.configure()
+    ref = get_attachment_ref(store.write(1, b"data"))
+    path = store.find(1, ref)
+    assert os.path.basename(os.path.dirname(os.path.dirname(path))).startswith(
+        "kent-attachments-"
+    )
+    store.flush()
@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import math
+
+import pytest
+
+from kent import codec
+from kent.app import create_app
+
+
+@pytest.fixture(params=codec.get_available_backends())
+def backend(request):
+    original = codec.BACKEND
+    codec.set_backend(request.param)
+    yield request.param
+    codec.set_backend(original)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b'{"message": "hello", "level": "error", "n": [1, 2.5, -0.0, null, true]}',
+        b'{"a": 1, "a": 2}',
+        '{"str": "café \\u2028"}',
+        b'"\xf0\x9f\x92\xa9 \\ud83d\\udca9"',
+        b"18446744073709551616",
+        b'{"id": 123456789012345678901234567890}',
+        b'"12345678901234567890"',
+        b"1e400",
+        b"[NaN, Infinity, -Infinity]",
+        b'"\\ud800"',
+        b"  [] ",
+    ],
+)
+def test_loads_is_the_same_as_json(backend, data):
+    expected = json.loads(data)
+    actual = codec.loads(data)
+    assert repr(actual) == repr(expected)
+    assert repr(
+        codec.loads(memoryview(data.encode("utf-8") if isinstance(data, str) else data))
+    ) == repr(expected)
+
+
+@pytest.mark.parametrize("data", [b"", b"{", b"not json", b'{"a": }'])
+def test_loads_bad_json(backend, data):
+    with pytest.raises(ValueError):
+        codec.loads(data)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"message": "hello", "n": [1, 2.5, -0.0, None, True, 1e16, 1e-05]},
+        {"str": "café   \U0001f4a9"},
+        {"b": 1, "a": {"d": 2, "c": 3}},
+        {"big": 2**70},
+        [],
+    ],
+)
+def test_dumps_is_equivalent_to_json(backend, data):
+    encoded = codec.dumps(data, sort_keys=True)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == data
+    # Keys are sorted the same way
+    assert list(json.loads(encoded, object_pairs_hook=list)) == list(
+        json.loads(json.dumps(data, sort_keys=True), object_pairs_hook=list)
+    )
+
+
+def test_dumps_is_compact(backend):
+    assert codec.dumps({"b": [1, 2], "a": None}, sort_keys=True) == (
+        b'{"a":null,"b":[1,2]}'
+    )
+
+
+def test_dumps_unsupported_type(backend):
+    with pytest.raises(TypeError):
+        codec.dumps({"a": object()})
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        [math.nan],
+        {"a": [1, None, math.inf]},
+        {"a": {"b": (-math.inf,)}},
+        {math.nan: 1},
+    ],
+)
+def test_dumps_non_finite_is_the_same_as_json(backend, data):
+    assert codec.dumps(data) == json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def test_set_backend_errors():
+    with pytest.raises(ValueError):
+        codec.set_backend("simplejson")
+
+
+def test_json_backend_config(backend):
+    app = create_app({"TESTING": True, "KENT_JSON_BACKEND": backend})
+    assert codec.BACKEND == backend
+    with app.test_client() as client:
+        client.post("/api/1/store/", json={"message": "café", "n": 1e16})
+        [event] = client.get("/api/eventlist/").json["events"]
+        resp = client.get(f"/api/event/{event['event_id']}")
+    assert resp.json["payload"]["body"] == {"message": "café", "n": 1e16}
+
+
+def test_json_backend_config_unknown():
+    with pytest.raises(ValueError):
+        create_app({"TESTING": True, "KENT_JSON_BACKEND": "nope"})
+    codec.set_backend()
@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import lzma
+import zlib
+
+import pytest
+
+from kent import decoders
+from kent.decoders import (
+    DecodeError,
+    DECODERS,
+    get_decoder,
+    iter_decoded,
+    PayloadTooLarge,
+    read_body,
+    register_decoder,
+    UnsupportedEncoding,
+)
+
+
+class LzmaDecoder:
+    # lzma has the same interface as the decoders, so it's handy for testing
+    # registering a decoder
+    def __init__(self):
+        self._decompressor = lzma.LZMADecompressor()
+
+    def decompress(self, data, max_length=0):
+        return self._decompressor.decompress(data, max_length or -1)
+
+    @property
+    def needs_input(self):
+        return self._decompressor.needs_input
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+
+@pytest.fixture
+def xz_decoder():
+    register_decoder("xz", LzmaDecoder)
+    yield
+    del DECODERS["xz"]
+
+
+@pytest.mark.parametrize("encoding", [None, "", "identity", " Identity "])
+def test_get_decoder_not_encoded(encoding):
+    assert get_decoder(encoding) is None
+
+
+def test_get_decoder_unsupported():
+    with pytest.raises(UnsupportedEncoding):
+        get_decoder("compress")
+
+
+def test_get_decoder_case_insensitive():
+    assert isinstance(get_decoder("GZip"), decoders.ZlibDecoder)
+
+
+def test_register_decoder(xz_decoder):
+    data = b"a" * 100_000
+    raw, body = read_body([lzma.compress(data)], encoding="xz", max_decompressed=None)
+    assert body == data
+
+    # Output is limited even when the input is one chunk
+    with pytest.raises(PayloadTooLarge):
+        read_body([lzma.compress(data)], encoding="xz", max_decompressed=1000)
+
+
+def test_iter_decoded_limits_each_piece():
+    data = gzip.compress(b"a" * 100_000)
+    pieces = []
+    with pytest.raises(PayloadTooLarge):
+        for piece in iter_decoded([data], get_decoder("gzip"), max_decompressed=1000):
+            pieces.append(piece)
+    assert sum(len(piece) for piece in pieces) <= 1000
+
+
+@pytest.mark.skipif("br" not in DECODERS, reason="needs brotli")
+def test_brotli():
+    brotli = pytest.importorskip("brotli")
+    data = b'{"message": "hi"}' * 1000
+    compressed = brotli.compress(data)
+    chunks = [compressed[i : i + 10] for i in range(0, len(compressed), 10)]
+    assert read_body(chunks, encoding="br") == (compressed, data)
+    with pytest.raises(DecodeError):
+        read_body([b"not brotli"], encoding="br")
+
+
+@pytest.mark.skipif("zstd" not in DECODERS, reason="needs zstd")
+def test_zstd():
+    if decoders.zstd is not None:
+        compressed = decoders.zstd.compress(b'{"message": "hi"}' * 1000)
+    else:
+        compressed = decoders.zstandard.ZstdCompressor().compress(
+            b'{"message": "hi"}' * 1000
+        )
+    chunks = [compressed[i : i + 10] for i in range(0, len(compressed), 10)]
+    assert read_body(chunks, encoding="zstd") == (
+        compressed,
+        b'{"message": "hi"}' * 1000,
+    )
+    with pytest.raises(DecodeError):
+        read_body([b"not zstd"], encoding="zstd")
+
+
+class TestReadBody:
+    def chunks(self, data, size=10):
+        return [data[i : i + size] for i in range(0, len(data), size)]
+
+    @pytest.mark.parametrize(
+        "encoding, compress",
+        [
+            (None, lambda data: data),
+            ("gzip", gzip.compress),
+            ("deflate", zlib.compress),
+        ],
+    )
+    def test_read(self, encoding, compress):
+        data = b'{"message": "hi"}' * 10
+        raw, body = read_body(self.chunks(compress(data)), encoding=encoding)
+        assert raw == compress(data)
+        assert body == data
+
+    def test_unsupported_encoding(self):
+        with pytest.raises(UnsupportedEncoding):
+            read_body([b"abc"], encoding="compress")
+
+    def test_max_compressed(self):
+        read_body(self.chunks(b"a" * 100), max_compressed=100)
+        with pytest.raises(PayloadTooLarge):
+            read_body(self.chunks(b"a" * 101), max_compressed=100)
+
+    def test_max_decompressed(self):
+        data = gzip.compress(b"a" * 100)
+        read_body([data], encoding="gzip", max_decompressed=100)
+        with pytest.raises(PayloadTooLarge):
+            read_body([data], encoding="gzip", max_decompressed=99)
+
+    def test_zip_bomb(self):
+        # 10 GB of zeros would compress to about 10 MB, so stop reading a much
+        # smaller bomb after the first chunk
+        data = gzip.compress(b"\x00" * 10_000_000)
+        chunks = iter(self.chunks(data, size=1000))
+        with pytest.raises(PayloadTooLarge):
+            read_body(chunks, encoding="gzip", max_decompressed=1000)
+        assert next(chunks)
+
+    def test_incomplete(self):
+        data = gzip.compress(b"a" * 100)
+        with pytest.raises(DecodeError):
+            read_body([data[:-10]], encoding="gzip")
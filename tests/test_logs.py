@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+import logging
+
+import pytest
+
+from kent.logs import BackgroundHandler, JSONFormatter
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger("kent.test_logs")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    yield logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+class TestBackgroundHandler:
+    def test_writes_records(self, logger):
+        stream = io.StringIO()
+        handler = BackgroundHandler(stream=stream)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger.addHandler(handler)
+
+        for i in range(1000):
+            logger.info("record %s", i)
+        handler.flush()
+
+        lines = stream.getvalue().splitlines()
+        assert lines == [f"INFO record {i}" for i in range(1000)]
+
+    def test_close_writes_queued_records(self, logger):
+        stream = io.StringIO()
+        handler = BackgroundHandler(stream=stream)
+        logger.addHandler(handler)
+        logger.info("one")
+        logger.info("two")
+        handler.close()
+        assert stream.getvalue() == "one\ntwo\n"
+
+    def test_full_queue_drops_records(self, logger):
+        handler = BackgroundHandler(stream=io.StringIO(), maxsize=1)
+        # Hold the write lock so the background thread can't empty the queue
+        with handler._write_lock:
+            logger.addHandler(handler)
+            for i in range(100):
+                logger.info("record %s", i)
+            assert handler.dropped > 0
+
+
+def test_json_formatter(logger):
+    stream = io.StringIO()
+    handler = BackgroundHandler(stream=stream)
+    handler.setFormatter(JSONFormatter())
+    logger.addHandler(handler)
+
+    logger.info("%s: summary: %s", "abc", "hi", extra={"event": {"event_id": "abc"}})
+    try:
+        raise ValueError("bad")
+    except ValueError:
+        logger.exception("oops")
+    handler.flush()
+
+    first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert first["level"] == "INFO"
+    assert first["logger"] == "kent.test_logs"
+    assert first["message"] == "abc: summary: hi"
+    assert first["event_id"] == "abc"
+    assert second["message"] == "oops"
+    assert "ValueError: bad" in second["exc_info"]
@@ -0,0 +1,164 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from kent.ratelimit import (
+    get_category,
+    get_rate_limit_headers,
+    RateLimit,
+    RateLimited,
+    RateLimiter,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_get_category():
+    assert get_category("event") == "error"
+    assert get_category("sessions") == "session"
+    assert get_category("something_new") == "something_new"
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {},
+        {"rate": 0},
+        {"rate": "1"},
+        {"rate": 1, "burst": 0},
+        {"rate": 1, "burst": 1.5},
+        {"rate": 1, "project_id": "1"},
+        {"rate": 1, "categories": "error"},
+        {"rate": 1, "categories": [""]},
+        {"rate": 1, "categories": None},
+        {"rate": 1, "categories": 5},
+        {"rate": 1, "categories": [5]},
+        {"rate": 1, "scope": "key"},
+        [],
+    ],
+)
+def test_rate_limit_from_dict_invalid(data):
+    with pytest.raises(ValueError):
+        RateLimit.from_dict(data)
+
+
+def test_rate_limit_to_dict():
+    assert RateLimit.from_dict({"rate": 0.5}).to_dict() == {
+        "rate": 0.5,
+        "burst": 1,
+        "project_id": None,
+        "categories": [],
+    }
+
+
+class TestRateLimiter:
+    def test_burst_and_refill(self, clock):
+        limiter = RateLimiter([RateLimit(rate=2, burst=3)], clock=clock)
+        for _ in range(3):
+            limiter.take(1)
+        with pytest.raises(RateLimited) as excinfo:
+            limiter.take(1)
+        [(limit, wait)] = excinfo.value.rejections
+        assert wait == 0.5
+
+        clock.now += 0.5
+        limiter.take(1)
+        with pytest.raises(RateLimited):
+            limiter.take(1)
+
+        # Buckets don't fill past the burst
+        clock.now += 100
+        for _ in range(3):
+            limiter.take(1)
+        with pytest.raises(RateLimited):
+            limiter.take(1)
+
+    def test_projects_have_their_own_buckets(self, clock):
+        limiter = RateLimiter([RateLimit(rate=1)], clock=clock)
+        limiter.take(1)
+        limiter.take(2)
+        with pytest.raises(RateLimited):
+            limiter.take(1)
+
+    def test_project_limit(self, clock):
+        limiter = RateLimiter([RateLimit(rate=1, project_id=2)], clock=clock)
+        for _ in range(5):
+            limiter.take(1)
+        limiter.take(2)
+        with pytest.raises(RateLimited):
+            limiter.take(2)
+
+    def test_categories(self, clock):
+        limiter = RateLimiter(
+            [RateLimit(rate=1, categories=["transaction"])], clock=clock
+        )
+        limiter.take(1, (None, "error"))
+        limiter.take(1, (None, "error"))
+        limiter.take(1, ("transaction",))
+        with pytest.raises(RateLimited):
+            limiter.take(1, ("transaction",))
+
+    def test_rejected_payloads_take_nothing(self, clock):
+        limiter = RateLimiter(
+            [RateLimit(rate=1, burst=2), RateLimit(rate=1, categories=["error"])],
+            clock=clock,
+        )
+        limiter.take(1, (None, "error"))
+        with pytest.raises(RateLimited) as excinfo:
+            limiter.take(1, (None, "error"))
+        assert [limit.categories for limit, _ in excinfo.value.rejections] == [
+            ("error",)
+        ]
+        # The payload limit still has a token
+        limiter.take(1)
+
+    def test_stats(self, clock):
+        limiter = RateLimiter([RateLimit(rate=1)], clock=clock)
+        limiter.take(1, (None, "error"))
+        with pytest.raises(RateLimited):
+            limiter.take(1, (None, "error"))
+        limiter.take(1, ("transaction",))
+        assert limiter.get_stats() == {
+            "accepted": 1,
+            "rejected": 1,
+            "projects": {"1": {"accepted": 1, "rejected": 1}},
+            "categories": {
+                "error": {"accepted": 1, "rejected": 1},
+                "transaction": {"accepted": 1, "rejected": 0},
+            },
+        }
+
+    def test_configure_resets(self, clock):
+        limiter = RateLimiter([RateLimit(rate=1)], clock=clock)
+        limiter.take(1)
+        limiter.configure([RateLimit(rate=1)])
+        limiter.take(1)
+        assert limiter.get_stats()["accepted"] == 1
+
+        limiter.configure([])
+        for _ in range(10):
+            limiter.take(1)
+
+
+def test_get_rate_limit_headers():
+    rejections = [
+        (RateLimit(rate=1), 0.2),
+        (RateLimit(rate=1, categories=["transaction", "span"]), 30.5),
+    ]
+    assert get_rate_limit_headers(rejections) == {
+        "Retry-After": "31",
+        "X-Sentry-Rate-Limits": "1::project, 31:transaction;span:project",
+    }
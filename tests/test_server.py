@@ -0,0 +1,447 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from kent.app import create_app, EVENTS, get_max_body_bytes
+from kent.events import Event
+from kent.server import AsyncServer, BadRequest, parse_head, ThreadedServer
+
+
+@pytest.fixture
+def server():
+    app = create_app({"TESTING": True})
+    server = AsyncServer(
+        app,
+        port=0,
+        threads=4,
+        keep_alive=2,
+        shutdown_timeout=2,
+        max_body_bytes=functools.partial(get_max_body_bytes, app),
+    )
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    async def main():
+        await server.start()
+        started.set()
+        await server._stopped.wait()
+        await server.stop()
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(main(),))
+    thread.start()
+    started.wait(timeout=5)
+    yield server
+    loop.call_soon_threadsafe(server.shutdown)
+    thread.join(timeout=10)
+    loop.close()
+
+
+def connect(server):
+    return http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+
+
+def raw_request(server, data):
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(data)
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+
+def check_streams_dont_block(server):
+    # More event streams than threads are open and events still get stored
+    conns = []
+    for _ in range(8):
+        conn = connect(server)
+        conn.request("GET", "/api/stream/")
+        resp = conn.getresponse()
+        assert resp.readline() == b": stream started\n"
+        conns.append((conn, resp))
+
+    post = connect(server)
+    post.request(
+        "POST",
+        "/api/1/store/",
+        body=b'{"message": "hi"}',
+        headers={"Content-Type": "application/json"},
+    )
+    assert post.getresponse().status == 200
+    post.close()
+
+    conn, resp = conns[0]
+    while not (line := resp.readline()).startswith(b"data: "):
+        pass
+    assert json.loads(line[6:])["summary"] == "hi"
+    for conn, _ in conns:
+        conn.close()
+
+
+def test_parse_head():
+    head = b"POST /api/1/store/?a=b HTTP/1.1\r\nHost: x\r\nX-Foo:  bar \r\n\r\n"
+    assert parse_head(head) == (
+        "POST",
+        "/api/1/store/?a=b",
+        "HTTP/1.1",
+        [("Host", "x"), ("X-Foo", "bar")],
+    )
+
+
+@pytest.mark.parametrize(
+    "head",
+    [
+        b"GET /\r\n\r\n",
+        b"GET / HTTP/2\r\n\r\n",
+        b"GET / HTTP/1.1\r\nno colon\r\n\r\n",
+        b"GET / HTTP/1.1\r\nX-Foo : bar\r\n\r\n",
+    ],
+)
+def test_parse_head_bad(head):
+    with pytest.raises(BadRequest):
+        parse_head(head)
+
+
+class TestAsyncServer:
+    def test_keep_alive(self, server):
+        conn = connect(server)
+        for i in range(3):
+            body = json.dumps({"message": f"event {i}"})
+            conn.request(
+                "POST",
+                "/api/1/store/",
+                body=body,
+                headers={"Content-Type": "application/json"},
+            )
+            resp = conn.getresponse()
+            assert resp.status == 200
+            assert resp.getheader("Connection") == "keep-alive"
+            assert json.loads(resp.read()) == {"success": True}
+
+        conn.request("GET", "/api/eventlist/")
+        resp = conn.getresponse()
+        events = json.loads(resp.read())["events"]
+        assert [event["summary"] for event in events] == [
+            "event 0",
+            "event 1",
+            "event 2",
+        ]
+        conn.close()
+
+    def test_chunked_request(self, server):
+        conn = connect(server)
+        conn.request(
+            "POST",
+            "/api/1/store/",
+            body=iter([b'{"message": ', b'"chunked"}']),
+            headers={"Content-Type": "application/json"},
+            encode_chunked=True,
+        )
+        assert conn.getresponse().status == 200
+        assert EVENTS.get_events()[-1].summary == "chunked"
+        conn.close()
+
+    def test_large_body(self, server):
+        # Bodies bigger than SPOOL_BYTES are kept in a temporary file
+        body = json.dumps({"message": "big", "padding": "a" * 2_000_000})
+        conn = connect(server)
+        conn.request(
+            "POST",
+            "/api/1/store/",
+            body=body,
+            headers={"Content-Type": "application/json"},
+        )
+        assert conn.getresponse().status == 200
+        assert EVENTS.get_events()[-1].summary == "big"
+        conn.close()
+
+    def test_expect_continue(self, server):
+        data = raw_request(
+            server,
+            b"POST /api/1/store/ HTTP/1.1\r\n"
+            + b"Host: localhost\r\n"
+            + b"Content-Type: application/json\r\n"
+            + b"Content-Length: 2\r\n"
+            + b"Expect: 100-continue\r\n"
+            + b"Connection: close\r\n"
+            + b"\r\n{}",
+        )
+        assert data.startswith(b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\n")
+        assert b"Connection: close\r\n" in data
+
+    def test_body_too_large(self, server):
+        server.app.config["KENT_MAX_COMPRESSED_BYTES"] = 100
+        # The 413 is sent before the client is told to continue and without
+        # reading the body
+        data = raw_request(
+            server,
+            b"POST /api/1/store/ HTTP/1.1\r\n"
+            + b"Host: localhost\r\n"
+            + b"Content-Length: 1000\r\n"
+            + b"Expect: 100-continue\r\n"
+            + b"\r\n",
+        )
+        assert data.startswith(b"HTTP/1.1 413 Payload Too Large\r\n")
+        assert b"Connection: close\r\n" in data
+
+    def test_chunked_body_too_large(self, server):
+        server.app.config["KENT_MAX_COMPRESSED_BYTES"] = 100
+        data = raw_request(
+            server,
+            b"POST /api/1/store/ HTTP/1.1\r\n"
+            + b"Host: localhost\r\n"
+            + b"Transfer-Encoding: chunked\r\n"
+            + b"\r\n"
+            + b"50\r\n"
+            + b"a" * 0x50
+            + b"\r\n50\r\n"
+            + b"a" * 0x50
+            + b"\r\n",
+        )
+        assert data.startswith(b"HTTP/1.1 413 Payload Too Large\r\n")
+        assert EVENTS.get_events() == []
+
+    def test_body_limit_is_for_ingestion(self, server):
+        server.app.config["KENT_MAX_COMPRESSED_BYTES"] = 100
+        event = Event(project_id=1, event_id="abc", body={"message": "big" * 100})
+        conn = connect(server)
+        conn.request("POST", "/api/import/", body=json.dumps(event.to_export()))
+        assert conn.getresponse().status == 200
+        assert EVENTS.get_events()[-1].summary == "big" * 100
+        conn.close()
+
+    def test_bad_request(self, server):
+        data = raw_request(server, b"NONSENSE\r\n\r\n")
+        assert data.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+
+    def test_headers_too_large(self, server):
+        data = raw_request(
+            server, b"GET / HTTP/1.1\r\nX-Foo: " + b"a" * 100_000 + b"\r\n\r\n"
+        )
+        assert data.startswith(b"HTTP/1.1 431 ")
+
+    def test_streamed_response_is_chunked(self, server):
+        conn = connect(server)
+        conn.request("GET", "/api/stream/?after=0")
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.getheader("Transfer-Encoding") == "chunked"
+        assert resp.readline() == b": stream started\n"
+        assert resp.readline() == b"\n"
+
+        EVENTS.add_event(event_id="abc", project_id=1, body={"message": "one"})
+        lines = [resp.readline() for _ in range(3)]
+        assert lines[0].startswith(b"id: ")
+        assert json.loads(lines[1][6:])["event_id"] == "abc"
+        conn.close()
+
+    def test_concurrent_connections(self, server):
+        # Lots of open connections only use threads while handling a request
+        conns = [connect(server) for _ in range(100)]
+        for conn in conns:
+            conn.connect()
+
+        def post(conn):
+            conn.request(
+                "POST",
+                "/api/1/store/",
+                body=b"{}",
+                headers={"Content-Type": "application/json"},
+            )
+            status = conn.getresponse().status
+            conn.close()
+            return status
+
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            assert set(pool.map(post, conns)) == {200}
+        assert len(EVENTS.get_events(project_id=1)) == 100
+
+    def test_streams_dont_block(self, server):
+        check_streams_dont_block(server)
+
+
+@pytest.fixture
+def threaded_server():
+    app = create_app({"TESTING": True})
+    server = ThreadedServer(app, port=0, threads=4, keep_alive=2)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join(timeout=10)
+
+
+class TestThreadedServer:
+    def test_keep_alive(self, threaded_server):
+        conn = connect(threaded_server)
+        for _ in range(3):
+            conn.request(
+                "POST",
+                "/api/1/store/",
+                body=b"{}",
+                headers={"Content-Type": "application/json"},
+            )
+            resp = conn.getresponse()
+            assert resp.status == 200
+            resp.read()
+        assert len(EVENTS.get_events(project_id=1)) == 3
+        conn.close()
+
+    def test_concurrent_connections(self, threaded_server):
+        def post(_):
+            conn = connect(threaded_server)
+            conn.request(
+                "POST",
+                "/api/1/store/",
+                body=b"{}",
+                headers={"Content-Type": "application/json", "Connection": "close"},
+            )
+            status = conn.getresponse().status
+            conn.close()
+            return status
+
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            assert set(pool.map(post, range(50))) == {200}
+        assert len(EVENTS.get_events(project_id=1)) == 50
+
+    def test_idle_connections_dont_block(self, threaded_server):
+        # Idle keep-alive connections don't count against threads
+        conns = []
+        for _ in range(8):
+            conn = connect(threaded_server)
+            conn.request("GET", "/api/usage/")
+            conn.getresponse().read()
+            conns.append(conn)
+
+        conn = connect(threaded_server)
+        conn.request("GET", "/api/usage/")
+        assert conn.getresponse().status == 200
+        conn.close()
+        for idle in conns:
+            idle.close()
+
+    def test_streams_dont_block(self, threaded_server):
+        check_streams_dont_block(threaded_server)
+
+    def test_detached_limit(self):
+        detached = []
+        unblock = threading.Event()
+
+        def app(environ, start_response):
+            detached.append(environ["kent.detach"]())
+            if environ["PATH_INFO"] == "/block":
+                unblock.wait(timeout=5)
+            start_response("200 OK", [("Content-Length", "0")])
+            return [b""]
+
+        def get(path):
+            conn = connect(server)
+            conn.request("GET", path)
+            status = conn.getresponse().status
+            conn.close()
+            return status
+
+        server = ThreadedServer(app, port=0, threads=1, max_detached=1)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                blocked = pool.submit(get, "/block")
+                while not detached:
+                    time.sleep(0.01)
+
+                # The blocked request is detached, so this one can run, but it
+                # can't detach too
+                assert get("/") == 200
+                assert detached == [True, False]
+
+                unblock.set()
+                assert blocked.result() == 200
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join(timeout=10)
+
+
+KENT_SERVER = os.path.join(os.path.dirname(sys.executable), "kent-server")
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+@pytest.mark.parametrize("use_async", [False, True])
+def test_serve_workers(tmp_path, use_async):
+    port = get_free_port()
+    env = dict(
+        os.environ,
+        KENT_STORAGE="sqlite",
+        KENT_STORAGE_PATH=str(tmp_path / "kent.db"),
+    )
+    args = ["serve", "--port", str(port), "--workers", "2"]
+    if use_async:
+        args.append("--async")
+    proc = subprocess.Popen(
+        [KENT_SERVER, *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+        for _ in range(10):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request(
+                "POST",
+                "/api/1/store/",
+                body=b"{}",
+                headers={"Content-Type": "application/json"},
+            )
+            assert conn.getresponse().status == 200
+            conn.close()
+
+        # All the workers see all the events
+        for _ in range(4):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/api/usage/")
+            assert json.loads(conn.getresponse().read())["events"] == 10
+            conn.close()
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=20) == 0
+
+
+def test_serve_workers_needs_shared_storage():
+    env = dict(os.environ, KENT_STORAGE="memory")
+    proc = subprocess.run(
+        [KENT_SERVER, "serve", "--workers", "2"],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert proc.returncode == 2
+    assert "KENT_STORAGE=sqlite" in proc.stderr
@@ -0,0 +1,496 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import multiprocessing
+import os
+
+import pytest
+
+from kent.events import Event
+from kent.storage import (
+    get_storage_class,
+    LogStorage,
+    MemoryStorage,
+    SqliteStorage,
+)
+
+
+STORAGE_PATHS = {
+    "memory": None,
+    "sqlite": "kent.db",
+    "log": "log",
+}
+
+
+@pytest.fixture
+def storages():
+    """Closes storages created in a test"""
+    created = []
+    yield created
+    for storage in created:
+        storage.close()
+
+
+@pytest.fixture(params=["memory", "sqlite", "log"])
+def make_storage(request, tmp_path, storages):
+    path = STORAGE_PATHS[request.param]
+
+    def _make_storage(
+        max_events=100, max_bytes=None, max_project_bytes=None, on_evict=None
+    ):
+        storage_class = get_storage_class(request.param)
+        storage = storage_class(
+            max_events=max_events,
+            max_bytes=max_bytes,
+            max_project_bytes=max_project_bytes,
+            on_evict=on_evict,
+            path=str(tmp_path / path) if path else None,
+        )
+        storages.append(storage)
+        return storage
+
+    return _make_storage
+
+
+def make_event(event_id, project_id=1, body=None, size=10, **kwargs):
+    return Event(
+        project_id=project_id,
+        event_id=event_id,
+        body=body if body is not None else {"message": event_id},
+        size=size,
+        **kwargs,
+    )
+
+
+def event_ids(events):
+    return [event.event_id for event in events]
+
+
+class TestStorage:
+    def test_add_and_get(self, make_storage):
+        storage = make_storage()
+        storage.add_event(
+            make_event(
+                "abc",
+                envelope_header={"event_id": "abc"},
+                header={"type": "event"},
+            )
+        )
+        storage.add_event(make_event("def", body=b"\x00attachment"))
+
+        event = storage.get_event("abc")
+        assert event.to_dict() == {
+            "project_id": 1,
+            "event_id": "abc",
+            "payload": {
+                "envelope_header": {"event_id": "abc"},
+                "header": {"type": "event"},
+                "body": {"message": "abc"},
+            },
+        }
+        assert storage.get_event("def").body == b"\x00attachment"
+        assert storage.get_event("ghi") is None
+
+    def test_keeps_extracted_fields(self, make_storage):
+        storage = make_storage()
+        storage.add_event(
+            make_event(
+                "abc",
+                header={"type": "transaction"},
+                body={
+                    "message": "hi",
+                    "timestamp": "2024-05-19T02:22:32Z",
+                    "sdk": {"name": "sentry.python", "version": "2.2.0"},
+                    "release": "1.0",
+                    "environment": "prod",
+                    "exception": {"values": [{"type": "KeyError", "value": "a"}]},
+                    "tags": {"color": "blue"},
+                },
+                received=1000.0,
+            )
+        )
+
+        [event] = storage.get_events()
+        assert event.item_type == "transaction"
+        assert event.summary == "KeyError: a"
+        assert event.timestamp == "2024-05-19T02:22:32Z"
+        assert event.sdk_name == "sentry.python"
+        assert event.sdk_version == "2.2.0"
+        assert event.release == "1.0"
+        assert event.environment == "prod"
+        assert event.exception_types == ("KeyError",)
+        assert event.tags == {"color": "blue"}
+        assert event.received == 1000.0
+
+    def test_add_events(self, make_storage):
+        storage = make_storage(max_events=2)
+        events = storage.add_events([make_event(str(i)) for i in range(3)])
+        assert [event.seq for event in events] == sorted(event.seq for event in events)
+        assert event_ids(storage.get_events()) == ["1", "2"]
+
+    def test_seq_increases(self, make_storage):
+        storage = make_storage()
+        first = storage.add_event(make_event("abc"))
+        second = storage.add_event(make_event("def", project_id=2))
+        assert 0 < first.seq < second.seq
+
+    def test_order(self, make_storage):
+        storage = make_storage()
+        for i, project_id in enumerate([1, 2, 1, 3, 2]):
+            storage.add_event(make_event(str(i), project_id=project_id))
+
+        assert event_ids(storage.get_events()) == ["0", "1", "2", "3", "4"]
+        assert event_ids(storage.get_events(project_id=2)) == ["1", "4"]
+        assert storage.get_events(project_id=4) == []
+
+    def test_get_events_since(self, make_storage):
+        storage = make_storage()
+        seqs = [
+            storage.add_event(make_event(str(i), project_id=project_id)).seq
+            for i, project_id in enumerate([1, 2, 1, 3, 2])
+        ]
+
+        assert event_ids(storage.get_events(since=seqs[1])) == ["2", "3", "4"]
+        assert event_ids(storage.get_events(project_id=2, since=seqs[1])) == ["4"]
+        assert storage.get_events(since=seqs[-1]) == []
+
+    def test_get_events_limit(self, make_storage):
+        storage = make_storage()
+        seqs = [
+            storage.add_event(make_event(str(i), project_id=project_id)).seq
+            for i, project_id in enumerate([1, 2, 1, 3, 2])
+        ]
+
+        assert event_ids(storage.get_events(limit=2)) == ["0", "1"]
+        assert event_ids(storage.get_events(since=seqs[0], limit=3)) == ["1", "2", "3"]
+        assert event_ids(storage.get_events(project_id=2, limit=1)) == ["1"]
+        assert event_ids(storage.get_events(limit=10)) == ["0", "1", "2", "3", "4"]
+
+    def test_watermark(self, make_storage):
+        storage = make_storage()
+        assert storage.get_watermark() == 0
+        event = storage.add_event(make_event("abc"))
+        assert storage.get_watermark() == event.seq
+
+        # Flushing doesn't reset it
+        storage.flush()
+        assert storage.get_watermark() == event.seq
+
+    def test_search(self, make_storage):
+        storage = make_storage()
+
+        def add(event_id, exc_type, project_id=1, **kwargs):
+            body = {
+                "exception": {"values": [{"type": exc_type, "value": "oops"}]},
+                **kwargs,
+            }
+            storage.add_event(make_event(event_id, project_id=project_id, body=body))
+
+        add("0", "KeyError", sdk={"name": "sentry.python", "version": "2.2.0"})
+        add("1", "KeyError", sdk={"name": "sentry.python", "version": "1.45.0"})
+        add("2", "ValueError", sdk={"name": "sentry.python", "version": "2.1.0"})
+        add("3", "KeyError", project_id=2, tags={"color": "blue"})
+        add("4", "KeyError", sdk={"name": "sentry.python", "version": "2.0.1"})
+
+        def search(**kwargs):
+            return event_ids(storage.search(**kwargs))
+
+        assert search(terms=[("exception_type", "KeyError")]) == ["0", "1", "3", "4"]
+        assert search(
+            terms=[("exception_type", "KeyError"), ("sdk_version", "2.*")]
+        ) == ["0", "4"]
+        assert search(project_id=2, terms=[("exception_type", "KeyError")]) == ["3"]
+        assert search(terms=[("tag:color", "blue")]) == ["3"]
+        assert search(terms=[("sdk_name", "sentry.javascript")]) == []
+
+        seq = storage.get_event("0").seq
+        assert search(terms=[("exception_type", "KeyError")], since=seq, limit=2) == [
+            "1",
+            "3",
+        ]
+
+    def test_search_time_range(self, make_storage):
+        storage = make_storage()
+        for i in range(5):
+            storage.add_event(make_event(str(i), project_id=i % 2, received=100.0 + i))
+
+        assert event_ids(storage.search(start=101, end=103)) == ["1", "2", "3"]
+        assert event_ids(storage.search(project_id=0, start=101)) == ["2", "4"]
+        assert event_ids(
+            storage.search(start=102, terms=[("item_type", "event")], limit=2)
+        ) == ["2", "3"]
+
+    def test_search_skips_removed_events(self, make_storage):
+        storage = make_storage(max_events=2)
+        for i in range(3):
+            storage.add_event(make_event(str(i), body={"tags": {"color": "blue"}}))
+        assert event_ids(storage.search(terms=[("tag:color", "blue")])) == ["1", "2"]
+
+        storage.flush()
+        assert storage.search(terms=[("tag:color", "blue")]) == []
+
+    def test_generation(self, make_storage):
+        storage = make_storage(max_events=1)
+        generations = [storage.get_generation()]
+        storage.add_event(make_event("abc"))
+        generations.append(storage.get_generation())
+        # Adding an event that evicts another
+        storage.add_event(make_event("def"))
+        generations.append(storage.get_generation())
+        storage.flush(project_id=1)
+        generations.append(storage.get_generation())
+        assert len(set(generations)) == 4
+
+        assert storage.get_generation() == generations[-1]
+
+    def test_evicts_by_count_per_project(self, make_storage):
+        storage = make_storage(max_events=2)
+        storage.add_event(make_event("quiet", project_id=1))
+        for i in range(5):
+            storage.add_event(make_event(f"noisy{i}", project_id=2))
+
+        assert event_ids(storage.get_events()) == ["quiet", "noisy3", "noisy4"]
+        assert storage.get_event("noisy0") is None
+
+    def test_evicts_by_bytes(self, make_storage):
+        storage = make_storage(max_bytes=100)
+        for i in range(5):
+            storage.add_event(make_event(str(i), size=40))
+        assert event_ids(storage.get_events()) == ["3", "4"]
+        assert storage.get_usage() == {1: {"events": 2, "bytes": 80}}
+
+        # The newest event is kept even if it's over budget by itself
+        storage.add_event(make_event("big", size=500))
+        assert event_ids(storage.get_events()) == ["big"]
+
+    def test_evicts_by_bytes_across_projects(self, make_storage):
+        storage = make_storage(max_bytes=100)
+        for i in range(5):
+            storage.add_event(make_event(str(i), project_id=i, size=40))
+        assert event_ids(storage.get_events()) == ["3", "4"]
+        assert storage.get_usage() == {
+            3: {"events": 1, "bytes": 40},
+            4: {"events": 1, "bytes": 40},
+        }
+
+    def test_evicts_by_project_bytes(self, make_storage):
+        storage = make_storage(max_project_bytes=100)
+        storage.add_event(make_event("quiet", project_id=1, size=40))
+        for i in range(5):
+            storage.add_event(make_event(str(i), project_id=2, size=40))
+        assert event_ids(storage.get_events()) == ["quiet", "3", "4"]
+
+    def test_on_evict(self, make_storage):
+        evicted = []
+        storage = make_storage(max_events=2, max_bytes=50, on_evict=evicted.append)
+        for i in range(3):
+            storage.add_event(make_event(str(i)))
+        assert event_ids(evicted) == ["0"]
+        assert evicted[0].body == {"message": "0"}
+
+        storage.add_event(make_event("big", project_id=2, size=40))
+        assert event_ids(evicted) == ["0", "1"]
+
+        # Flushed events aren't evicted
+        storage.flush()
+        assert event_ids(evicted) == ["0", "1"]
+
+    def test_flush(self, make_storage):
+        storage = make_storage()
+        storage.add_event(make_event("abc", project_id=1))
+        storage.add_event(make_event("def", project_id=2))
+
+        storage.flush(project_id=1)
+        assert storage.get_event("abc") is None
+        assert event_ids(storage.get_events()) == ["def"]
+        assert storage.get_usage() == {2: {"events": 1, "bytes": 10}}
+
+        storage.flush()
+        assert storage.get_events() == []
+        assert storage.get_usage() == {}
+
+
+def test_unknown_storage():
+    with pytest.raises(ValueError):
+        get_storage_class("cassette")
+
+
+def test_memory_storage_watermark_waits_for_pending_events():
+    storage = MemoryStorage(max_events=10)
+    first = storage.add_event(make_event("abc"))
+
+    # Pretend another thread has been handed the next seq but hasn't added its
+    # event yet
+    with storage._lock:
+        pending = next(storage._seq)
+        storage._pending.add(pending)
+    second = storage.add_event(make_event("def", project_id=2))
+    assert storage.get_watermark() == first.seq
+
+    with storage._lock:
+        storage._pending.discard(pending)
+    assert storage.get_watermark() == second.seq
+
+
+def test_memory_storage_is_not_shared():
+    first = MemoryStorage(max_events=10)
+    second = MemoryStorage(max_events=10)
+    first.add_event(make_event("abc"))
+    assert second.get_event("abc") is None
+    assert first.get_generation() != second.get_generation()
+
+
+class TestSqliteStorage:
+    def test_requires_path(self):
+        with pytest.raises(ValueError):
+            SqliteStorage(max_events=10)
+
+    def test_shared_between_instances(self, tmp_path, storages):
+        path = str(tmp_path / "kent.db")
+        first = SqliteStorage(max_events=10, path=path)
+        second = SqliteStorage(max_events=10, path=path)
+        storages.extend([first, second])
+
+        first.add_event(make_event("abc"))
+        second.add_event(make_event("def"))
+
+        assert event_ids(first.get_events()) == ["abc", "def"]
+        assert event_ids(second.get_events()) == ["abc", "def"]
+        assert first.get_generation() == second.get_generation()
+
+    def test_shared_between_processes(self, tmp_path, storages):
+        path = str(tmp_path / "kent.db")
+        storage = SqliteStorage(max_events=1000, path=path)
+        storages.append(storage)
+
+        ctx = multiprocessing.get_context("spawn")
+        procs = [
+            ctx.Process(target=add_events, args=(path, worker, 50))
+            for worker in range(3)
+        ]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+
+        assert len(storage.get_events()) == 150
+        assert storage.get_event("2-49") is not None
+
+
+def add_events(path, worker, count):
+    storage = SqliteStorage(max_events=1000, path=path)
+    for i in range(count):
+        storage.add_event(make_event(f"{worker}-{i}"))
+    storage.close()
+
+
+class TestLogStorage:
+    @pytest.fixture
+    def open_log(self, tmp_path, storages):
+        def _open_log(**kwargs):
+            kwargs.setdefault("max_events", 100)
+            storage = LogStorage(path=str(tmp_path), **kwargs)
+            storages.append(storage)
+            return storage
+
+        return _open_log
+
+    def segment_files(self, path):
+        return sorted(name for name in os.listdir(path) if name.endswith(".log"))
+
+    def test_requires_path(self):
+        with pytest.raises(ValueError):
+            LogStorage(max_events=10)
+
+    def test_bodies_are_not_held_in_memory(self, tmp_path, open_log):
+        storage = open_log(max_events=10)
+        storage.add_event(make_event("abc", body={"message": "hello"}))
+
+        event = storage.get_event("abc")
+        assert event._body is None
+        assert event.body == {"message": "hello"}
+        assert event.summary == "hello"
+
+    def test_listing_does_not_read_bodies(self, tmp_path, open_log, monkeypatch):
+        storage = open_log(max_events=10)
+        storage.add_event(make_event("abc", body={"message": "hello"}))
+
+        def read(event):
+            raise AssertionError("read body")
+
+        monkeypatch.setattr(storage, "read", read)
+        assert [event.summary for event in storage.get_events()] == ["hello"]
+
+    def test_recovers_after_restart(self, tmp_path, open_log):
+        storage = open_log(max_events=10)
+        storage.add_event(make_event("abc", project_id=1))
+        storage.add_event(make_event("def", project_id=2, body=b"attachment"))
+        storage.add_event(make_event("ghi", project_id=2))
+        storage.flush(project_id=1)
+        last_seq = storage.get_event("ghi").seq
+        storage.close()
+
+        storage = open_log(max_events=10)
+        assert event_ids(storage.get_events()) == ["def", "ghi"]
+        assert storage.get_event("def").body == b"attachment"
+        assert storage.get_usage() == {2: {"events": 2, "bytes": 20}}
+        assert storage.add_event(make_event("jkl")).seq > last_seq
+
+    def test_recovers_from_truncated_record(self, tmp_path, open_log):
+        storage = open_log(max_events=10)
+        storage.add_event(make_event("abc"))
+        storage.add_event(make_event("def"))
+        storage.close()
+
+        # Chop off the end of the last record like a crash mid-write would
+        [segment] = self.segment_files(tmp_path)
+        path = tmp_path / segment
+        size = path.stat().st_size
+        os.truncate(path, size - 5)
+
+        storage = open_log(max_events=10)
+        assert event_ids(storage.get_events()) == ["abc"]
+        storage.add_event(make_event("ghi"))
+        storage.close()
+
+        storage = open_log(max_events=10)
+        assert event_ids(storage.get_events()) == ["abc", "ghi"]
+
+    def test_rotates_segments(self, tmp_path, open_log):
+        storage = open_log(max_events=100, segment_bytes=500)
+        for i in range(20):
+            storage.add_event(make_event(str(i)))
+
+        assert len(self.segment_files(tmp_path)) > 1
+        assert event_ids(storage.get_events()) == [str(i) for i in range(20)]
+        assert storage.get_event("0").body == {"message": "0"}
+
+    def test_deletes_segments_by_size(self, tmp_path, open_log):
+        storage = open_log(max_events=100, segment_bytes=500, max_log_bytes=1000)
+        for i in range(50):
+            storage.add_event(make_event(str(i)))
+
+        total_size = sum(
+            (tmp_path / name).stat().st_size for name in self.segment_files(tmp_path)
+        )
+        assert total_size <= 1000 + 500
+        events = storage.get_events()
+        assert events[-1].event_id == "49"
+        assert storage.get_event("0") is None
+        for event in events:
+            assert event.body == {"message": event.event_id}
+
+    def test_deletes_segments_without_events(self, tmp_path, open_log):
+        storage = open_log(max_events=2, segment_bytes=300)
+        for i in range(20):
+            storage.add_event(make_event(str(i)))
+        assert len(self.segment_files(tmp_path)) <= 2
+
+        storage.flush()
+        assert len(self.segment_files(tmp_path)) == 1
+        storage.close()
+
+        storage = open_log(max_events=2)
+        assert storage.get_events() == []
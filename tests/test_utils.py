@@ -2,7 +2,114 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from kent.utils import Item, parse_envelope
+import json
+import random
+
+import pytest
+
+from kent.utils import (
+    EnvelopeParser,
+    Item,
+    iter_lines,
+    looks_like_json,
+    LRUCache,
+    parse_envelope,
+    RingBuffer,
+)
+
+
+class TestRingBuffer:
+    def test_append_and_iterate(self):
+        buf = RingBuffer(3)
+        assert not buf
+        assert buf.append(1) is None
+        assert buf.append(2) is None
+        assert list(buf) == [1, 2]
+        assert len(buf) == 2
+
+    def test_evicts_oldest(self):
+        buf = RingBuffer(3)
+        for i in range(3):
+            buf.append(i)
+        assert buf.append(3) == 0
+        assert buf.append(4) == 1
+        assert list(buf) == [2, 3, 4]
+        assert buf[0] == 2
+        assert buf[-1] == 4
+
+    def test_index_out_of_range(self):
+        buf = RingBuffer(2)
+        buf.append(1)
+        with pytest.raises(IndexError):
+            buf[1]
+
+    def test_popleft_and_clear(self):
+        buf = RingBuffer(2)
+        buf.append(1)
+        buf.append(2)
+        assert buf.popleft() == 1
+        assert list(buf) == [2]
+        buf.clear()
+        assert list(buf) == []
+        with pytest.raises(IndexError):
+            buf.popleft()
+
+    def test_bad_capacity(self):
+        with pytest.raises(ValueError):
+            RingBuffer(0)
+
+
+class TestLRUCache:
+    def test_get_and_put(self):
+        cache = LRUCache(maxsize=2)
+        assert cache.get("a") is None
+        assert cache.get("a", 5) == 5
+        cache.put("a", 1)
+        assert cache.get("a") == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        # Using "a" makes "b" the least recently used
+        cache.get("a")
+        cache.put("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        (b'{"a": 1}', True),
+        (b"  [1, 2]\n", True),
+        (b"{}", True),
+        (b"", False),
+        (b"   ", False),
+        (b"{", False),
+        (b'"string"', False),
+        (b"null", False),
+        (b"{]", False),
+        (b"\x1f\x8b\x08\x00", False),
+    ],
+)
+def test_looks_like_json(data, expected):
+    assert looks_like_json(data) is expected
+
+
+@pytest.mark.parametrize(
+    "chunks, expected",
+    [
+        ([], []),
+        ([b"abc\ndef\n"], [b"abc", b"def"]),
+        ([b"abc\r\nd", b"e", b"f"], [b"abc", b"def"]),
+        ([b"ab", b"c\n\n", b"\ndef\n", b"\n"], [b"abc", b"def"]),
+    ],
+)
+def test_iter_lines(chunks, expected):
+    assert list(iter_lines(chunks)) == expected
 
 
 class Test_parse_envelope:
@@ -220,3 +327,142 @@ class Test_parse_envelope:
                 },
             ),
         ]
+
+    def test_no_decode(self):
+        payload = (
+            b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\n'
+            b'{"type":"event","length":41}\n'
+            b'{"message":"hello world","level":"error"}\n'
+        )
+
+        items = list(parse_envelope(payload, decode=False))
+
+        assert items == [
+            Item(
+                envelope_header={"event_id": "9ec79c33ec9942ab8353589fcb2e04dc"},
+                header={"length": 41, "type": "event"},
+                body=b'{"message":"hello world","level":"error"}',
+            ),
+        ]
+
+    def test_no_decode_not_json(self):
+        payload = (
+            b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\n'
+            b'{"type":"event"}\n'
+            b"not json\n"
+        )
+
+        with pytest.raises(ValueError):
+            list(parse_envelope(payload, decode=False))
+
+    def test_crlf(self):
+        payload = (
+            b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc"}\r\n'
+            b'{"type":"event"}\r\n'
+            b'{"message":"hello world"}\r\n'
+            b'{"type":"attachment","length":4}\r\n'
+            b"a\r\nb\r\n"
+            b'{"type":"event","length":2}\r\n'
+            b"{}"
+        )
+
+        items = list(parse_envelope(payload))
+
+        assert [item.body for item in items] == [
+            {"message": "hello world"},
+            b"a\r\nb",
+            {},
+        ]
+
+    def test_attachments_are_not_copied(self):
+        payload = b'{}\n{"type":"attachment","length":5}\nhello\n'
+
+        [item] = list(parse_envelope(payload))
+        assert isinstance(item.body, memoryview)
+        assert item.body.obj is payload
+
+    @pytest.mark.parametrize(
+        "payload",
+        [
+            # Item header without a type
+            b'{}\n{"length":2}\n{}\n',
+            # Bad length
+            b'{}\n{"type":"event","length":-1}\n{}\n',
+            # Envelope ends in the middle of an item
+            b'{}\n{"type":"attachment","length":10}\nhello',
+            # Item header isn't JSON
+            b"{}\nnot json\n{}\n",
+        ],
+    )
+    def test_bad_envelope(self, payload):
+        with pytest.raises(ValueError):
+            list(parse_envelope(payload))
+
+
+ENVELOPE = (
+    b'{"event_id":"9ec79c33ec9942ab8353589fcb2e04dc","dsn":"https://public@sentry.io/42"}\n'
+    b'{"type":"attachment","length":10,"filename":"hello.txt"}\n'
+    b"\xef\xbb\xbfHello\r\n\n"
+    b'{"type":"event","length":41}\r\n'
+    b'{"message":"hello world","level":"error"}\r\n'
+    b'{"type":"attachment","length":0}\n'
+    b"\n"
+    b'{"type":"session"}\n'
+    b'{"started":"2020-02-07T14:16:00Z"}'
+)
+
+
+class TestEnvelopeParser:
+    def test_every_split(self):
+        expected = list(parse_envelope(ENVELOPE))
+        assert len(expected) == 4
+        for index in range(len(ENVELOPE) + 1):
+            parser = EnvelopeParser()
+            items = parser.feed(ENVELOPE[:index])
+            items.extend(parser.feed(ENVELOPE[index:]))
+            items.extend(parser.close())
+            assert items == expected, index
+
+    def test_byte_at_a_time(self):
+        parser = EnvelopeParser()
+        items = []
+        for i in range(len(ENVELOPE)):
+            items.extend(parser.feed(ENVELOPE[i : i + 1]))
+        items.extend(parser.close())
+        assert items == list(parse_envelope(ENVELOPE))
+
+    def test_fuzz(self):
+        # Build random envelopes, feed them in random chunks, and check the
+        # items come out the same as they went in
+        rng = random.Random(20240519)
+        for _ in range(200):
+            expected = []
+            parts = [b'{"event_id":"abc"}\n']
+            for _ in range(rng.randint(0, 5)):
+                newline = rng.choice([b"\n", b"\r\n"])
+                if rng.random() < 0.5:
+                    body = bytes(rng.randrange(256) for _ in range(rng.randint(0, 50)))
+                    header = {"type": "attachment", "length": len(body)}
+                    expected.append((header, body))
+                else:
+                    data = {"message": "x" * rng.randint(0, 20)}
+                    body = json.dumps(data).encode("utf-8")
+                    header = {"type": "event"}
+                    if rng.random() < 0.5:
+                        header["length"] = len(body)
+                    expected.append((header, data))
+                parts.extend([json.dumps(header).encode("utf-8"), newline, body])
+                parts.append(newline)
+            payload = b"".join(parts)
+
+            parser = EnvelopeParser()
+            items = []
+            index = 0
+            while index < len(payload):
+                size = rng.randint(1, 40)
+                items.extend(parser.feed(payload[index : index + size]))
+                index += size
+            items.extend(parser.close())
+
+            assert [(item.header, item.body) for item in items] == expected
+            assert all(item.envelope_header == {"event_id": "abc"} for item in items)